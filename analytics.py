@@ -0,0 +1,216 @@
+# Rent-roll analytics for owners.
+#
+# The figures of every contract (dates, rent, management fee, deposit, key
+# money) and the floor area and building of its room are pulled in one
+# projection query into columnar NumPy arrays. The per-building or per-owner,
+# month-by-month rollups are then computed with array operations: a boolean
+# mask of the contracts in force in a month, and np.bincount over the group of
+# each contract to sum a column per group.
+#
+# The arrays are kept per process until the contracts_version or
+# rooms_version counters (stats.py) move. Building names and owners are read
+# on each request (one row per building), so renames and owner changes show
+# up right away.
+import io
+import csv
+import logging
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+
+from app import db
+from models import Contract, Room, Building, Owner
+from stats import get_data_versions
+
+# Longest month-by-month rollup served, in months
+MAX_MONTHS = 36
+
+GROUP_BY = ('building', 'owner')
+
+# Columns of a rollup, in CSV order
+FIGURES = ('contracts', 'rent', 'management_fee', 'monthly_total', 'security_deposit',
+           'key_money', 'floor_area', 'rent_per_sqm')
+
+CSV_HEADER = {
+    'building': ('月', '建物ID', '建物名'),
+    'owner': ('月', 'オーナーID', 'オーナー名'),
+}
+CSV_FIGURE_HEADER = ('契約数', '月額賃料', '管理費', '月額合計', '敷金', '礼金', '面積（㎡）',
+                     '㎡単価')
+
+OPEN_END = date.max.toordinal()
+
+_rent_roll = None
+_rent_roll_version = None
+_rent_roll_lock = threading.Lock()
+
+
+class RentRoll:
+    """Contract figures as columnar arrays, one element per contract"""
+
+    def __init__(self, rows):
+        """`rows` yields (start_date, end_date, rent_amount, management_fee,
+        security_deposit, key_money, floor_area, building_id)."""
+        rows = list(rows)
+        count = len(rows)
+        columns = list(zip(*rows)) if rows else [()] * 8
+
+        def column(values, dtype):
+            # Unset fees, deposits and key money count as zero
+            return np.fromiter((value or 0 for value in values), dtype=dtype, count=count)
+
+        self.start = np.fromiter((day.toordinal() for day in columns[0]), dtype=np.int64,
+                                 count=count)
+        self.end = np.fromiter((day.toordinal() if day else OPEN_END for day in columns[1]),
+                               dtype=np.int64, count=count)
+        self.rent = column(columns[2], np.int64)
+        self.management_fee = column(columns[3], np.int64)
+        self.security_deposit = column(columns[4], np.int64)
+        self.key_money = column(columns[5], np.int64)
+        self.floor_area = column(columns[6], np.float64)
+        self.building_id = column(columns[7], np.int64)
+
+    def __len__(self):
+        return len(self.start)
+
+    def group_keys(self, by, owner_of=None):
+        """The building id, or the owner id from `owner_of` (building id ->
+        owner id), of each contract"""
+        if by == 'building':
+            return self.building_id
+        lookup = np.zeros(max(owner_of, default=0) + 1, dtype=np.int64)
+        lookup[list(owner_of)] = list(owner_of.values())
+        known = self.building_id < len(lookup)
+        return np.where(known, lookup[np.where(known, self.building_id, 0)], 0)
+
+    def rollup(self, keys, months):
+        """Sum the figures per group for each month.
+
+        `months` is a list of first days of months. A contract counts in a
+        month if it is in force on any day of it; its key money counts in the
+        month it starts. Returns (group keys, {figure: array of shape
+        (len(months), number of groups)}).
+        """
+        groups, inverse = np.unique(keys, return_inverse=True)
+        shape = (len(months), len(groups))
+        sums = {name: np.zeros(shape, dtype=np.float64)
+                for name in ('contracts', 'rent', 'management_fee', 'security_deposit',
+                             'key_money', 'floor_area')}
+        for i, first in enumerate(months):
+            first, last = first.toordinal(), _month_end(first).toordinal()
+            in_force = (self.start <= last) & (self.end >= first)
+            group = inverse[in_force]
+            sums['contracts'][i] = np.bincount(group, minlength=len(groups))
+            for name in ('rent', 'management_fee', 'security_deposit', 'floor_area'):
+                sums[name][i] = np.bincount(group, weights=getattr(self, name)[in_force],
+                                            minlength=len(groups))
+            started = (self.start >= first) & (self.start <= last)
+            sums['key_money'][i] = np.bincount(inverse[started],
+                                               weights=self.key_money[started],
+                                               minlength=len(groups))
+        sums['monthly_total'] = sums['rent'] + sums['management_fee']
+        sums['rent_per_sqm'] = _per_sqm(sums['rent'], sums['floor_area'])
+        return groups, sums
+
+
+def _month_end(first):
+    return (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+def month_starts(start=None, months=1):
+    """First days of `months` consecutive months from the month of `start`"""
+    month = (start or date.today()).replace(day=1)
+    starts = [month]
+    for _ in range(months - 1):
+        month = (month + timedelta(days=32)).replace(day=1)
+        starts.append(month)
+    return starts
+
+
+def load_rent_roll():
+    """Read the figures of every contract into a RentRoll"""
+    rows = db.session.query(
+        Contract.start_date, Contract.end_date, Contract.rent_amount, Contract.management_fee,
+        Contract.security_deposit, Contract.key_money, Room.floor_area,
+        Room.building_id).join(Room, Contract.room_id == Room.id)
+    return RentRoll(rows.yield_per(10000))
+
+
+def get_rent_roll():
+    """The rent roll of this process, reloaded after contracts or rooms change"""
+    global _rent_roll, _rent_roll_version
+    # Read the version before the data, so a concurrent change forces a reload
+    version = get_data_versions()
+    with _rent_roll_lock:
+        if _rent_roll is None or _rent_roll_version != version:
+            _rent_roll = load_rent_roll()
+            _rent_roll_version = version
+            logging.info(f"Loaded rent roll of {len(_rent_roll)} contracts")
+        return _rent_roll
+
+
+def _per_sqm(rent, floor_area):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(floor_area > 0, rent / floor_area, 0.0)
+
+
+def _rounded(sums):
+    """The rollup sums as nested lists [month][group] of JSON-ready numbers"""
+    table = {name: np.rint(sums[name]).astype(np.int64).tolist() for name in FIGURES
+             if name not in ('floor_area', 'rent_per_sqm')}
+    table['floor_area'] = np.round(sums['floor_area'], 2).tolist()
+    table['rent_per_sqm'] = np.round(sums['rent_per_sqm'], 1).tolist()
+    return table
+
+
+def rent_roll_report(by='building', start=None, months=1):
+    """Month-by-month rent roll per building or per owner.
+
+    Returns {'by', 'months': ['YYYY-MM', ...], 'groups': [{'id', 'name',
+    'months': [figures, ...]}], 'totals': [figures, ...]}, groups largest
+    rent first. The figures are those in FIGURES; rent_per_sqm is the rent
+    per square metre of floor area under contract.
+    """
+    rent_roll = get_rent_roll()
+    buildings = db.session.query(Building.id, Building.name, Building.owner_id).all()
+    owner_of = {building_id: owner_id for building_id, _, owner_id in buildings}
+    if by == 'owner':
+        names = dict(db.session.query(Owner.id, Owner.name))
+    else:
+        names = {building_id: name for building_id, name, _ in buildings}
+
+    starts = month_starts(start, months)
+    groups, sums = rent_roll.rollup(rent_roll.group_keys(by, owner_of), starts)
+    totals = {name: sums[name].sum(axis=1, keepdims=True) for name in sums}
+    totals['rent_per_sqm'] = _per_sqm(totals['rent'], totals['floor_area'])
+    table, totals = _rounded(sums), _rounded(totals)
+
+    order = np.argsort(-sums['rent'].sum(axis=0), kind='stable').tolist()
+    group_ids = groups.tolist()
+    return {
+        'by': by,
+        'months': [first.strftime('%Y-%m') for first in starts],
+        'groups': [{
+            'id': group_ids[g],
+            'name': names.get(group_ids[g], ''),
+            'months': [{name: table[name][m][g] for name in FIGURES}
+                       for m in range(len(starts))]
+        } for g in order],
+        'totals': [{name: totals[name][m][0] for name in FIGURES} for m in range(len(starts))]
+    }
+
+
+def rent_roll_csv(report):
+    """The rent roll report as CSV, one row per month and group, then totals"""
+    output = io.StringIO()
+    # BOM so that Excel reads the Japanese names correctly
+    output.write('\ufeff')
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADER[report['by']] + CSV_FIGURE_HEADER)
+    for m, month in enumerate(report['months']):
+        for group in report['groups']:
+            writer.writerow([month, group['id'], group['name']] +
+                            [group['months'][m][name] for name in FIGURES])
+        writer.writerow([month, '', '合計'] + [report['totals'][m][name] for name in FIGURES])
+    return output.getvalue()
@@ -49,8 +49,9 @@ with app.app_context():
     import models  # To ensure all models are registered before creating tables
     from routes import *  # Register all routes
     
-    # Create all database tables
-    db.create_all()
+    # Create missing tables and apply pending schema migrations
+    from migrations import upgrade_database
+    upgrade_database()
 
     # Check if admin user exists, if not create one
     from models import User
@@ -0,0 +1,133 @@
+# Streamed ZIP archives of contract PDFs.
+#
+# zipfile writes the archive into an unseekable sink that the response drains
+# after every write, so the archive is never staged on disk or held in memory
+# whatever its size: entries carry data descriptors (and ZIP64 records past
+# 4 GB), PDFs are stored as they are (they are compressed already) and copied
+# ARCHIVE_READ_BYTES at a time.
+#
+# PDFs that are up to date go out first. Missing and stale ones are queued
+# on the render queue (jobs.enqueue_renders) before streaming starts, so the
+# render worker pool does the work, and are added as their jobs finish.
+# Contracts whose render failed, or whose job did not finish within
+# ARCHIVE_RENDER_TIMEOUT seconds, are listed in a text file at the end of the
+# archive.
+import os
+import time
+import logging
+import zipfile
+
+from app import db
+from models import Contract, Room, RenderJob
+from jobs import POLL_INTERVAL, enqueue_renders
+from exporter import ZipStream
+
+# Bytes read from a PDF per write into the archive
+ARCHIVE_READ_BYTES = 1024 * 1024
+
+# Seconds an archive download waits for queued renders
+ARCHIVE_RENDER_TIMEOUT = float(os.environ.get('ARCHIVE_RENDER_TIMEOUT', 600))
+
+# Contract ids per job status query
+ARCHIVE_JOB_QUERY_CHUNK = 1000
+
+FAILED_LIST_NAME = '未生成の契約書.txt'
+
+
+def archive_contracts(building_id, contract_ids=None):
+    """(id, contract number, pdf path, ready) of a building's contracts,
+    optionally only those in contract_ids; ready means the PDF exists and
+    is up to date"""
+    query = db.session.query(Contract.id, Contract.contract_number, Contract.pdf_path,
+                             Contract.pdf_stale_at).filter(Contract.room_id.in_(
+                                 db.select(Room.id).where(Room.building_id == building_id)))
+    if contract_ids:
+        query = query.filter(Contract.id.in_(contract_ids))
+    return [(contract_id, number, pdf_path,
+             bool(pdf_path) and not stale_at and os.path.exists(pdf_path))
+            for contract_id, number, pdf_path, stale_at in query.order_by(Contract.id)]
+
+
+def _entry_name(contract_number):
+    # The same name download_contract_pdf gives the file
+    return f"lease_contract_{contract_number}.pdf"
+
+
+def _write_pdf(archive, sink, name, pdf_path):
+    """Add a PDF to the archive, yielding the archive bytes as they are written"""
+    info = zipfile.ZipInfo(name, date_time=time.localtime(os.path.getmtime(pdf_path))[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    # Known up front so that zipfile writes ZIP64 headers for huge files
+    info.file_size = os.path.getsize(pdf_path)
+    with open(pdf_path, 'rb') as source, archive.open(info, 'w') as entry:
+        while chunk := source.read(ARCHIVE_READ_BYTES):
+            entry.write(chunk)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _latest_job_ids(contract_ids):
+    """Map contract id -> id of its most recent render job"""
+    job_ids = {}
+    for start in range(0, len(contract_ids), ARCHIVE_JOB_QUERY_CHUNK):
+        job_ids.update(db.session.query(RenderJob.contract_id, db.func.max(RenderJob.id)).filter(
+            RenderJob.contract_id.in_(contract_ids[start:start + ARCHIVE_JOB_QUERY_CHUNK])
+        ).group_by(RenderJob.contract_id))
+    return job_ids
+
+
+def _finished_jobs(job_ids):
+    """(job id, status, error, pdf path) of the given jobs that are done or failed"""
+    finished = []
+    for start in range(0, len(job_ids), ARCHIVE_JOB_QUERY_CHUNK):
+        finished.extend(db.session.query(
+            RenderJob.id, RenderJob.status, RenderJob.error, Contract.pdf_path
+        ).join(Contract, RenderJob.contract_id == Contract.id).filter(
+            RenderJob.id.in_(job_ids[start:start + ARCHIVE_JOB_QUERY_CHUNK]),
+            RenderJob.status.in_(('done', 'failed'))))
+    return finished
+
+
+def iter_pdf_archive(contracts):
+    """Stream a ZIP archive of the contracts' PDFs (from archive_contracts)"""
+    numbers = {contract_id: number for contract_id, number, _, _ in contracts}
+    missing = [contract_id for contract_id, _, _, ready in contracts if not ready]
+    failed = {}
+    waiting = {}
+    if missing:
+        # Contracts that already had a pending job keep it
+        enqueue_renders(missing)
+        waiting = {job_id: contract_id
+                   for contract_id, job_id in _latest_job_ids(missing).items()}
+    # End the read transaction: the render workers commit the new paths
+    db.session.commit()
+
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for contract_id, number, pdf_path, ready in contracts:
+            if ready:
+                yield from _write_pdf(archive, sink, _entry_name(number), pdf_path)
+
+        deadline = time.monotonic() + ARCHIVE_RENDER_TIMEOUT
+        while waiting:
+            finished = _finished_jobs(list(waiting))
+            db.session.commit()
+            for job_id, status, error, pdf_path in finished:
+                contract_id = waiting.pop(job_id)
+                if status == 'failed' or not pdf_path or not os.path.exists(pdf_path):
+                    failed[contract_id] = error or 'PDFが見つかりません。'
+                    continue
+                yield from _write_pdf(archive, sink, _entry_name(numbers[contract_id]), pdf_path)
+            if waiting and time.monotonic() >= deadline:
+                for contract_id in waiting.values():
+                    failed[contract_id] = 'PDFの生成が時間内に終わりませんでした。'
+                break
+            if waiting and not finished:
+                time.sleep(POLL_INTERVAL)
+
+        if failed:
+            logging.warning(f"Left {len(failed)} contracts out of a PDF archive")
+            archive.writestr(FAILED_LIST_NAME, ''.join(
+                f"{numbers[contract_id]}: {error}\n"
+                for contract_id, error in sorted(failed.items())))
+    yield sink.drain()
@@ -0,0 +1,83 @@
+"""Benchmark Excel-to-HTML conversion of a heavily formatted, mostly empty sheet.
+
+Real templates often carry formatting far past their content. The sheet built
+here holds a few values near the top but is formatted out to --rows by --cols
+cells; the conversion should cost the same as for the unformatted sheet and
+must not add cells to the workbook.
+
+    python benchmarks/excel_used_range.py [--rows 20000] [--cols 200] [--repeat 3]
+"""
+import os
+import sys
+import time
+import argparse
+from io import BytesIO
+
+import openpyxl
+from openpyxl.styles import Font
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SESSION_SECRET', 'benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402,F401  (utils imports the models)
+from utils import _excel_used_range, iter_excel_html  # noqa: E402
+
+VALUES = {
+    (1, 1): '賃貸借契約書',
+    (3, 2): '{{contract.tenant_name}}',
+    (4, 2): '{{contract.rent_amount}}',
+}
+
+
+def build_template(rows, cols, formatted):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for (row, col), value in VALUES.items():
+        sheet.cell(row=row, column=col, value=value)
+    if formatted:
+        bold = Font(bold=True)
+        # A formatted first column and last row stretch the dimensions
+        for row in range(1, rows + 1):
+            sheet.cell(row=row, column=1).font = bold
+        for col in range(1, cols + 1):
+            sheet.cell(row=rows, column=col).font = bold
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--cols', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for formatted in (False, True):
+        template = build_template(args.rows, args.cols, formatted)
+        workbook = openpyxl.load_workbook(BytesIO(template))
+        sheet = workbook.active
+        stored = len(sheet._cells)
+
+        convert_time, html = timed(lambda: ''.join(iter_excel_html(workbook, 'BENCH')),
+                                   args.repeat)
+        label = f"{args.rows}x{args.cols} formatted" if formatted else "unformatted"
+        print(f"{label:>24}: dimensions {sheet.dimensions}, "
+              f"used range {_excel_used_range(sheet)}")
+        print(f"{'':>24}  conversion {convert_time * 1000:8.1f} ms, {len(html)} chars of HTML, "
+              f"stored cells {stored} -> {len(sheet._cells)}")
+
+
+if __name__ == '__main__':
+    main()
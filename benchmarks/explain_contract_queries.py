@@ -0,0 +1,87 @@
+"""Check that the contract list filters and sorts are served by indexes.
+
+Runs EXPLAIN on the contract list query for each filter and sort order and
+reports how the contracts table is read. Works on SQLite (EXPLAIN QUERY PLAN)
+and PostgreSQL (EXPLAIN with sequential scans disabled, so the planner shows
+whether an index can serve the query even on a small table).
+
+    DATABASE_URL=postgresql://... python benchmarks/explain_contract_queries.py
+
+Exits with status 1 if any query reads contracts without an index.
+"""
+import os
+import sys
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app, db  # noqa: E402
+from utils import build_contract_page_query, encode_contract_cursor  # noqa: E402
+
+CASES = [
+    ('newest first', {}, 'created_at', 'desc'),
+    ('oldest first', {}, 'created_at', 'asc'),
+    ('by start date', {}, 'start_date', 'desc'),
+    ('by rent', {}, 'rent_amount', 'asc'),
+    ('building', {'building_id': 1}, 'created_at', 'desc'),
+    ('owner', {'owner_id': 1}, 'created_at', 'desc'),
+    ('agent', {'agent_id': 1}, 'created_at', 'desc'),
+    ('start date range', {'start_from': date(2024, 4, 1), 'start_to': date(2025, 3, 31)},
+     'start_date', 'asc'),
+    ('rent range', {'rent_min': 50000, 'rent_max': 80000}, 'rent_amount', 'desc'),
+    ('building and start date', {'building_id': 1, 'start_from': date(2024, 4, 1)},
+     'start_date', 'desc'),
+]
+
+
+class _CursorRow:
+    id = 1000
+    created_at = datetime(2025, 1, 1)
+    start_date = date(2025, 1, 1)
+    rent_amount = 70000
+
+
+def explain(query):
+    """Return the plan lines for a query on the current database"""
+    statement = query.statement.compile(dialect=db.engine.dialect,
+                                        compile_kwargs={'literal_binds': True})
+    connection = db.session.connection()
+    if db.engine.dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}")
+        return [row[-1] for row in rows]
+    connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}")]
+
+
+def uses_index(plan):
+    """True unless the plan reads the contracts table sequentially"""
+    for line in plan:
+        if db.engine.dialect.name == 'sqlite':
+            if line.startswith('SCAN contracts') and 'INDEX' not in line:
+                return False
+        elif 'Seq Scan on contracts' in line:
+            return False
+    return True
+
+
+def main():
+    failures = 0
+    with app.app_context():
+        print(f"Database: {db.engine.dialect.name}")
+        for label, filters, sort, order in CASES:
+            for page in ('first', 'next'):
+                after = encode_contract_cursor(_CursorRow, sort) if page == 'next' else None
+                query, _, _ = build_contract_page_query(filters, sort, order, after=after)
+                plan = explain(query.limit(51))
+                db.session.rollback()
+                ok = uses_index(plan)
+                failures += not ok
+                print(f"[{'ok' if ok else 'NO INDEX'}] {label} ({page} page)")
+                for line in plan:
+                    print(f"    {line}")
+    if failures:
+        print(f"{failures} queries read contracts without an index")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
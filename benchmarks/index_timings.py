@@ -0,0 +1,170 @@
+"""Time foreign-key and contract-number lookups before and after their indexes.
+
+Fills a database with a synthetic portfolio (owners, buildings, rooms, agents
+and contracts with special terms), drops the indexes added by migration
+0003_foreign_key_indexes, times the lookups the app makes, rebuilds the
+indexes the way the migration does and times them again.
+
+    python benchmarks/index_timings.py [--contracts 200000] [--repeat 20]
+
+Uses a throwaway SQLite file unless DATABASE_URL is set (use an empty
+PostgreSQL database; the script fills it).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+from datetime import date, datetime, timedelta
+
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ.setdefault('SESSION_SECRET', 'benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import logging  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Owner, Building, Room, RealEstateAgent, User, Contract  # noqa: E402
+from models import ContractTemplate, SpecialTerm, contract_special_terms  # noqa: E402
+from migrations import _foreign_key_indexes  # noqa: E402
+
+FOREIGN_KEY_INDEXES = [
+    'ix_contracts_created_by_id', 'ix_contracts_template_id', 'ix_rooms_building_id',
+    'ix_buildings_owner_id', 'ix_contract_special_terms_special_term_id'
+]
+
+CHUNK_SIZE = 5000
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(db.insert(table), rows[start:start + CHUNK_SIZE])
+
+
+def seed(contracts):
+    """Insert a synthetic portfolio sized around the number of contracts"""
+    random.seed(1)
+    owners = max(10, contracts // 400)
+    buildings = max(20, contracts // 40)
+    rooms = max(100, contracts // 4)
+    now = datetime.utcnow()
+
+    _insert(Owner, [{'name': f'オーナー{i}', 'address': '東京都', 'created_at': now}
+                    for i in range(owners)])
+    _insert(Building, [{
+        'name': f'ビル{i}', 'address': '東京都', 'structure': '鉄筋コンクリート造',
+        'floors': 5, 'total_units': 10, 'building_type': 'マンション',
+        'owner_id': random.randint(1, owners), 'created_at': now
+    } for i in range(buildings)])
+    _insert(Room, [{
+        'room_number': str(100 + i % 50), 'layout': '1K', 'floor_area': 25.0, 'floor': 1,
+        'building_id': random.randint(1, buildings), 'created_at': now
+    } for i in range(rooms)])
+    _insert(RealEstateAgent, [{'name': f'宅建士{i}', 'license_number': f'L{i}', 'created_at': now}
+                              for i in range(100)])
+    _insert(User, [{
+        'username': f'staff{i}', 'email': f'staff{i}@example.com', 'password_hash': '-',
+        'role': 'staff', 'is_active': True, 'created_at': now
+    } for i in range(20)])
+    _insert(ContractTemplate, [{'name': f'テンプレート{i}', 'file_content': '<p></p>',
+                                'file_type': 'html', 'created_at': now} for i in range(20)])
+    _insert(SpecialTerm, [{'title': f'特約{i}', 'content': '-', 'created_at': now}
+                          for i in range(100)])
+    db.session.flush()
+
+    user_ids = [user_id for (user_id, ) in db.session.query(User.id)]
+    start = date(2020, 1, 1)
+    _insert(Contract, [{
+        'contract_number': f"{(start + timedelta(days=i // 100)).strftime('%Y%m%d')}-{i % 100 + 1:04d}",
+        'tenant_name': f'借主{i}', 'tenant_address': '東京都',
+        'start_date': start + timedelta(days=i // 100), 'rent_amount': random.randint(40, 200) * 1000,
+        'room_id': random.randint(1, rooms), 'agent_id': random.randint(1, 100),
+        'created_by_id': random.choice(user_ids), 'template_id': random.randint(1, 20),
+        'created_at': now - timedelta(minutes=i)
+    } for i in range(contracts)])
+    _insert(contract_special_terms, [{
+        'contract_id': contract_id, 'special_term_id': term_id
+    } for contract_id in range(1, contracts + 1)
+      for term_id in random.sample(range(1, 101), 2)])
+    db.session.commit()
+
+
+def drop_indexes():
+    with db.engine.begin() as connection:
+        for name in FOREIGN_KEY_INDEXES:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+def analyze():
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('ANALYZE')
+
+
+def lookups(contract_number_range):
+    """Queries the app runs that go through a foreign key or contract_number"""
+    day = '20210301'
+    if contract_number_range:
+        number_query = Contract.query.filter(Contract.contract_number >= f"{day}-",
+                                             Contract.contract_number < f"{day}.")
+    else:
+        number_query = Contract.query.filter(Contract.contract_number.like(f"{day}%"))
+    return [
+        ('rooms of a building', lambda: Room.query.filter_by(building_id=7).all()),
+        ('buildings of an owner', lambda: Building.query.filter_by(owner_id=3).all()),
+        ('contracts using a template',
+         lambda: Contract.query.filter_by(template_id=5).limit(1).all()),
+        ('contracts created by a user',
+         lambda: db.session.query(db.func.count(Contract.id)).filter_by(created_by_id=2).scalar()),
+        ('contracts with a special term',
+         lambda: db.session.query(db.func.count()).select_from(contract_special_terms).filter(
+             contract_special_terms.c.special_term_id == 42).scalar()),
+        ('next contract number of a day', lambda: number_query.count()),
+    ]
+
+
+def time_lookups(contract_number_range, repeat):
+    results = {}
+    for label, run in lookups(contract_number_range):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+            db.session.rollback()
+        results[label] = statistics.median(timings) * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--contracts', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with app.app_context():
+        print(f"Database: {db.engine.url.render_as_string(hide_password=True)}")
+        if not Contract.query.first():
+            started = time.monotonic()
+            seed(args.contracts)
+            print(f"Seeded {args.contracts} contracts in {time.monotonic() - started:.0f}s")
+
+        drop_indexes()
+        analyze()
+        before = time_lookups(False, args.repeat)
+
+        started = time.monotonic()
+        _foreign_key_indexes()
+        analyze()
+        print(f"Built indexes in {time.monotonic() - started:.1f}s")
+        after = time_lookups(True, args.repeat)
+
+    print(f"\n{'lookup':<32}{'before':>12}{'after':>12}")
+    for label in before:
+        print(f"{label:<32}{before[label]:>10.2f}ms{after[label]:>10.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Time occupancy queries on the interval index against plain SQL.
+
+Fills a database with a synthetic portfolio (rooms with a history of
+back-to-back, fixed-term and open-ended contracts), then times "occupied
+rooms on a day" and the 12-month vacancy calendar for the portfolio and for
+one building, on the OccupancyIndex and as COUNT(DISTINCT room_id) queries.
+
+    python benchmarks/occupancy_timings.py [--rooms 100000] [--repeat 20]
+
+Uses a throwaway SQLite file unless DATABASE_URL is set (use an empty
+PostgreSQL database; the script fills it).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+from datetime import date, datetime, timedelta
+
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ.setdefault('SESSION_SECRET', 'benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import logging  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Owner, Building, Room, RealEstateAgent, User, Contract  # noqa: E402
+from models import ContractTemplate  # noqa: E402
+from occupancy import load_occupancy_index, calendar_days  # noqa: E402
+
+CHUNK_SIZE = 5000
+ROOMS_PER_BUILDING = 20
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(db.insert(table), rows[start:start + CHUNK_SIZE])
+
+
+def seed(rooms):
+    """Insert `rooms` rooms, each with a few years of contracts"""
+    random.seed(1)
+    buildings = max(1, rooms // ROOMS_PER_BUILDING)
+    now = datetime.utcnow()
+    _insert(Owner, [{'name': 'オーナー', 'address': '東京都', 'created_at': now}])
+    _insert(Building, [{
+        'name': f'ビル{i}', 'address': '東京都', 'structure': '鉄筋コンクリート造',
+        'floors': 5, 'total_units': ROOMS_PER_BUILDING, 'building_type': 'マンション',
+        'owner_id': 1, 'created_at': now
+    } for i in range(buildings)])
+    _insert(Room, [{
+        'room_number': str(101 + i % ROOMS_PER_BUILDING), 'layout': '1K', 'floor_area': 25.0,
+        'floor': 1, 'building_id': i // ROOMS_PER_BUILDING + 1, 'created_at': now
+    } for i in range(rooms)])
+    _insert(RealEstateAgent, [{'name': '宅建士', 'license_number': 'L1', 'created_at': now}])
+    _insert(User, [{'username': 'staff', 'email': 'staff@example.com', 'password_hash': '-',
+                    'role': 'staff', 'is_active': True, 'created_at': now}])
+    _insert(ContractTemplate, [{'name': 'テンプレート', 'file_content': '<p></p>',
+                                'file_type': 'html', 'created_at': now}])
+
+    contracts = []
+    horizon = date.today() + timedelta(days=365)
+    for room_id in range(1, rooms + 1):
+        start = date(2018, 1, 1) + timedelta(days=random.randint(0, 300))
+        while start < horizon:
+            end = start + timedelta(days=random.randint(365, 3 * 365))
+            open_ended = end > date.today() and random.random() < 0.3
+            contracts.append({
+                'contract_number': f'B-{len(contracts) + 1}', 'tenant_name': '借主',
+                'tenant_address': '東京都', 'start_date': start,
+                'end_date': None if open_ended else end, 'rent_amount': 80000,
+                'room_id': room_id, 'agent_id': 1, 'created_by_id': 1, 'template_id': 1,
+                'created_at': now
+            })
+            if open_ended:
+                break
+            start = end + timedelta(days=random.randint(1, 90))
+    _insert(Contract, contracts)
+    db.session.commit()
+    return len(contracts)
+
+
+def active_on(day):
+    return db.and_(Contract.start_date <= day,
+                   db.or_(Contract.end_date.is_(None), Contract.end_date >= day))
+
+
+def sql_occupied(day, building_id=None):
+    query = db.session.query(db.func.count(db.distinct(Contract.room_id))).filter(active_on(day))
+    if building_id:
+        query = query.filter(Contract.room_id.in_(
+            db.select(Room.id).where(Room.building_id == building_id)))
+    return query.scalar()
+
+
+def timed(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - started)
+    db.session.rollback()
+    return statistics.median(timings) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with app.app_context():
+        print(f"Database: {db.engine.url.render_as_string(hide_password=True)}")
+        if not Contract.query.first():
+            started = time.monotonic()
+            count = seed(args.rooms)
+            print(f"Seeded {args.rooms} rooms and {count} contracts in "
+                  f"{time.monotonic() - started:.0f}s")
+
+        started = time.perf_counter()
+        index = load_occupancy_index()
+        print(f"Built the portfolio index in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+        today = date.today()
+        days = calendar_days(today)
+        building_id = 7
+        cases = [
+            ('portfolio, today', lambda: index.occupied(today),
+             lambda: sql_occupied(today)),
+            ('portfolio, 12-month calendar', lambda: [index.occupied(day) for day in days],
+             lambda: [sql_occupied(day) for day in days]),
+            ('building, 12-month calendar',
+             lambda: [month['occupied'] for month in
+                      load_occupancy_index(building_id).calendar(today, building_id=building_id)],
+             lambda: [sql_occupied(day, building_id) for day in days]),
+        ]
+
+        print(f"\n{'query':<32}{'index':>12}{'SQL':>12}")
+        for label, indexed, sql in cases:
+            index_ms, index_result = timed(indexed, args.repeat)
+            sql_ms, sql_result = timed(sql, max(1, args.repeat // 4))
+            mark = '' if index_result == sql_result else '  MISMATCH'
+            print(f"{label:<32}{index_ms:>10.2f}ms{sql_ms:>10.2f}ms{mark}")
+
+
+if __name__ == '__main__':
+    main()
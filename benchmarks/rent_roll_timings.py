@@ -0,0 +1,91 @@
+"""Time the 12-month rent roll on NumPy arrays against a Python loop.
+
+Fills a database with the synthetic portfolio of occupancy_timings.py, then
+times the per-building and per-owner month-by-month rollups of analytics.py
+against the same sums computed row by row over ORM contracts.
+
+    python benchmarks/rent_roll_timings.py [--rooms 100000] [--repeat 5]
+
+Uses a throwaway SQLite file unless DATABASE_URL is set (use an empty
+PostgreSQL database; the script fills it).
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ.setdefault('SESSION_SECRET', 'benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import logging  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Contract  # noqa: E402
+from analytics import load_rent_roll, rent_roll_report, month_starts, _month_end  # noqa: E402
+from occupancy_timings import seed  # noqa: E402
+
+
+def python_rent_roll(by, months):
+    """The prototype: rent per group and month, one contract at a time"""
+    totals = {}
+    for contract in Contract.query:
+        building = contract.room.building
+        key = building.id if by == 'building' else building.owner_id
+        for first in months:
+            last = _month_end(first)
+            if contract.start_date <= last and (contract.end_date is None
+                                                or contract.end_date >= first):
+                totals[key, first] = totals.get((key, first), 0) + contract.rent_amount
+    return totals
+
+
+def numpy_rent_roll(by, months):
+    report = rent_roll_report(by, months[0], len(months))
+    return {(group['id'], first): month['rent']
+            for group in report['groups']
+            for first, month in zip(months, group['months']) if month['rent']}
+
+
+def timed(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - started)
+    db.session.rollback()
+    return statistics.median(timings) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with app.app_context():
+        print(f"Database: {db.engine.url.render_as_string(hide_password=True)}")
+        if not Contract.query.first():
+            started = time.monotonic()
+            count = seed(args.rooms)
+            print(f"Seeded {args.rooms} rooms and {count} contracts in "
+                  f"{time.monotonic() - started:.0f}s")
+
+        started = time.perf_counter()
+        load_rent_roll()
+        print(f"Loaded the rent roll arrays in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+        months = month_starts(months=12)
+        print(f"\n{'12-month rollup':<24}{'NumPy':>12}{'Python':>14}")
+        for by in ('building', 'owner'):
+            numpy_ms, numpy_result = timed(lambda: numpy_rent_roll(by, months), args.repeat)
+            python_ms, python_result = timed(lambda: python_rent_roll(by, months), 1)
+            mark = '' if numpy_result == python_result else '  MISMATCH'
+            print(f"{'per ' + by:<24}{numpy_ms:>10.1f}ms{python_ms:>12.0f}ms{mark}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Benchmark Word placeholder substitution on a generated 30-page template.
+
+Compares the old approach (scan every paragraph once per placeholder and
+reassign ``para.text``) with the indexed, run-aware engine in placeholders.py.
+
+    python benchmarks/word_placeholders.py [--pages 30] [--repeat 5]
+"""
+import os
+import sys
+import time
+import argparse
+from io import BytesIO
+
+import docx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from placeholders import index_word_placeholders, fill_word_placeholders  # noqa: E402
+
+REPLACE_DICT = {
+    '{{contract.contract_number}}': '20260401-0001',
+    '{{contract.tenant_name}}': '山田太郎',
+    '{{contract.tenant_address}}': '東京都新宿区西新宿1-1-1',
+    '{{contract.start_date}}': '2026年04月01日',
+    '{{contract.end_date}}': '2028年03月31日',
+    '{{contract.rent_amount}}': '85,000円',
+    '{{contract.security_deposit}}': '170,000円',
+    '{{contract.key_money}}': '85,000円',
+    '{{contract.management_fee}}': '5,000円',
+    '{{owner.name}}': '佐藤花子',
+    '{{owner.address}}': '東京都渋谷区神南1-2-3',
+    '{{building.name}}': 'メゾン西新宿',
+    '{{building.address}}': '東京都新宿区西新宿1-1-1',
+    '{{room.room_number}}': '203',
+    '{{room.layout}}': '1LDK',
+    '{{agent.name}}': '鈴木一郎',
+    '{{agent.license_number}}': '東京都知事(3)第12345号',
+}
+
+BODY_TEXT = '本契約に定めのない事項については、民法その他の法令及び慣習に従い、甲乙誠意をもって協議し解決するものとする。'
+
+# Roughly 40 paragraphs and one table per page
+PARAGRAPHS_PER_PAGE = 40
+
+
+def build_template(pages):
+    doc = docx.Document()
+    placeholders = list(REPLACE_DICT)
+    for page in range(pages):
+        doc.add_heading(f'第{page + 1}条', level=2)
+        for line in range(PARAGRAPHS_PER_PAGE):
+            para = doc.add_paragraph(BODY_TEXT)
+            if line % 20 == 0:
+                placeholder = placeholders[(page + line) % len(placeholders)]
+                # Split the placeholder across three runs, as Word often does
+                para.add_run('（')
+                para.add_run(placeholder[:5]).bold = True
+                para.add_run(placeholder[5:12])
+                para.add_run(placeholder[12:] + '）')
+        table = doc.add_table(rows=6, cols=4)
+        for row_idx, row in enumerate(table.rows):
+            for cell_idx, cell in enumerate(row.cells):
+                if row_idx == 0 and cell_idx == 1:
+                    cell.text = placeholders[page % len(placeholders)]
+                else:
+                    cell.text = '項目'
+        doc.add_page_break()
+
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def legacy_fill(doc, replace_dict):
+    for para in doc.paragraphs:
+        for placeholder, value in replace_dict.items():
+            if placeholder in para.text:
+                para.text = para.text.replace(placeholder, value)
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for para in cell.paragraphs:
+                    for placeholder, value in replace_dict.items():
+                        if placeholder in para.text:
+                            para.text = para.text.replace(placeholder, value)
+
+
+def document_text(doc):
+    parts = [para.text for para in doc.paragraphs]
+    for table in doc.tables:
+        for row in table.rows:
+            parts.extend(cell.text for cell in row.cells)
+    return '\n'.join(parts)
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    template = build_template(args.pages)
+    print(f"Template: {args.pages} pages, {len(template) / 1024:.0f} KiB")
+
+    index_time, index = timed(lambda: index_word_placeholders(template), 1)
+    print(f"Index build (once per upload): {index_time * 1000:.1f} ms, "
+          f"{len(index)} paragraphs with placeholders")
+
+    def run_legacy():
+        doc = docx.Document(BytesIO(template))
+        legacy_fill(doc, REPLACE_DICT)
+        return doc
+
+    def run_indexed():
+        doc = docx.Document(BytesIO(template))
+        fill_word_placeholders(doc, index, REPLACE_DICT)
+        return doc
+
+    load_time, _ = timed(lambda: docx.Document(BytesIO(template)), args.repeat)
+    legacy_time, legacy_doc = timed(run_legacy, args.repeat)
+    indexed_time, indexed_doc = timed(run_indexed, args.repeat)
+
+    print(f"Document load:            {load_time * 1000:8.1f} ms")
+    print(f"Legacy substitution:      {(legacy_time - load_time) * 1000:8.1f} ms")
+    print(f"Indexed substitution:     {(indexed_time - load_time) * 1000:8.1f} ms")
+
+    legacy_text = document_text(legacy_doc)
+    indexed_text = document_text(indexed_doc)
+    print(f"Output text identical:    {legacy_text == indexed_text}")
+    leftover = sum(indexed_text.count(placeholder) for placeholder in REPLACE_DICT)
+    print(f"Unreplaced placeholders:  {leftover}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# Streaming exports of contracts, buildings and rooms as CSV or Excel.
+#
+# Each export is a single projection query over the joined tables, read with
+# yield_per so that rows come from a server-side cursor (PostgreSQL) in
+# batches of CHUNK_ROWS and never all at once. CSV is written a batch at a
+# time into the chunked response; its header line goes out before the query
+# runs. Excel files are streamed the same way: the .xlsx package (a ZIP) is
+# written by zipfile into a ZipStream that the response drains after every
+# batch, with the worksheet XML generated row by row (inline strings, so no
+# shared string table has to be built first). openpyxl's writer cannot do
+# this, since it only adds a sheet to the package once the workbook is saved.
+#
+# Building and room exports use the column labels of the bulk import
+# (importer.py), so an exported file can be edited and imported again.
+import io
+import csv
+import json
+import zipfile
+from datetime import date, datetime
+from functools import partial
+from xml.sax.saxutils import escape
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+from app import db
+from models import Contract, Room, Building, Owner, RealEstateAgent
+from utils import filter_contracts
+from importer import import_columns
+
+# Rows fetched and written per chunk
+CHUNK_ROWS = 1000
+
+EXPORT_KINDS = {'contracts': '契約書', 'buildings': '建物', 'rooms': '部屋'}
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+_CONTRACT_COLUMNS = [
+    ('ID', Contract.id),
+    ('契約番号', Contract.contract_number),
+    ('借主名', Contract.tenant_name),
+    ('借主住所', Contract.tenant_address),
+    ('借主電話番号', Contract.tenant_phone),
+    ('借主メールアドレス', Contract.tenant_email),
+    ('契約開始日', Contract.start_date),
+    ('契約終了日', Contract.end_date),
+    ('月額賃料（円）', Contract.rent_amount),
+    ('管理費（円）', Contract.management_fee),
+    ('敷金（円）', Contract.security_deposit),
+    ('礼金（円）', Contract.key_money),
+    ('建物名', Building.name),
+    ('建物住所', Building.address),
+    ('部屋番号', Room.room_number),
+    ('間取り', Room.layout),
+    ('床面積（m²）', Room.floor_area),
+    ('オーナー名', Owner.name),
+    ('宅建士', RealEstateAgent.name),
+    ('宅建士免許番号', RealEstateAgent.license_number),
+    ('作成日時', Contract.created_at),
+]
+
+
+def _model_columns(kind, model):
+    """(label, column) of the bulk import columns that are stored on the model"""
+    return [(label, getattr(model, name)) for name, label, _ in import_columns(kind)
+            if name in model.__table__.columns and not name.endswith('_id')]
+
+
+def _plain(row):
+    return list(row)
+
+
+def _room_row(amenities, row):
+    # Amenity flags as 1/0, and the custom amenities (stored as JSON) as the
+    # comma-separated list the import takes
+    row = [int(value) if isinstance(value, bool) else value for value in row]
+    if row[amenities]:
+        row[amenities] = ', '.join(json.loads(row[amenities]))
+    return row
+
+
+def export_query(kind, filters=None):
+    """Column labels, select statement and row conversion of an export.
+
+    Contract exports take the contract list filters; room exports take a
+    building_id filter.
+    """
+    filters = filters or {}
+    if kind == 'contracts':
+        labels, columns = zip(*_CONTRACT_COLUMNS)
+        statement = db.select(*columns).select_from(Contract).join(
+            Room, Contract.room_id == Room.id).join(
+            Building, Room.building_id == Building.id).join(
+            Owner, Building.owner_id == Owner.id).join(
+            RealEstateAgent, Contract.agent_id == RealEstateAgent.id)
+        statement = filter_contracts(statement, **filters).order_by(Contract.id)
+        return labels, statement, _plain
+
+    if kind == 'buildings':
+        labels, columns = zip(*([('ID', Building.id)] + _model_columns('buildings', Building) +
+                                [('オーナー名', Owner.name)]))
+        statement = db.select(*columns).join(Owner, Building.owner_id == Owner.id).order_by(
+            Building.id)
+        return labels, statement, _plain
+
+    labels, columns = zip(*([('ID', Room.id), ('建物名', Building.name)] +
+                            _model_columns('rooms', Room)))
+    statement = db.select(*columns).join(Building, Room.building_id == Building.id)
+    if filters.get('building_id'):
+        statement = statement.where(Room.building_id == filters['building_id'])
+    amenities = [column.key for column in columns].index('custom_amenities')
+    return labels, statement.order_by(Room.building_id, Room.id), partial(_room_row, amenities)
+
+
+def _iter_rows(statement, convert):
+    """Converted rows of a statement, in lists of up to CHUNK_ROWS"""
+    result = db.session.execute(statement.execution_options(yield_per=CHUNK_ROWS))
+    try:
+        for rows in result.partitions():
+            yield [convert(row) for row in rows]
+    finally:
+        result.close()
+
+
+def iter_csv(kind, filters=None):
+    """Stream an export as CSV text chunks, starting with the header"""
+    labels, statement, convert = export_query(kind, filters)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def drain():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    # BOM so that Excel reads the Japanese text correctly
+    buffer.write('\ufeff')
+    writer.writerow(labels)
+    yield drain()
+    for rows in _iter_rows(statement, convert):
+        writer.writerows(rows)
+        yield drain()
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only, unseekable file collecting zipfile output until drained.
+
+    zipfile writes entries with data descriptors to an unseekable file, so
+    an archive can be sent while it is being written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+_XLSX_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_XLSX_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_XLSX_DOC_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        f'<Relationships xmlns="{_XLSX_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{_XLSX_DOC_REL}/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'),
+    'xl/_rels/workbook.xml.rels': (
+        f'<Relationships xmlns="{_XLSX_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{_XLSX_DOC_REL}/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        f'<Relationship Id="rId2" Type="{_XLSX_DOC_REL}/styles" Target="styles.xml"/>'
+        '</Relationships>'),
+    # Cell styles: 0 general, 1 date (format 14), 2 date and time (format 22)
+    'xl/styles.xml': (
+        f'<styleSheet xmlns="{_XLSX_MAIN_NS}">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '</cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'),
+}
+
+
+def _xlsx_cell(ref, value):
+    """One worksheet cell as XML ('' for an empty cell)"""
+    if value is None or value == '':
+        return ''
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"><v>{value!r}</v></c>'
+    if isinstance(value, datetime):
+        return f'<c r="{ref}" s="2"><v>{to_excel(value)!r}</v></c>'
+    if isinstance(value, date):
+        return f'<c r="{ref}" s="1"><v>{to_excel(value)!r}</v></c>'
+    text = escape(ILLEGAL_CHARACTERS_RE.sub('', str(value)))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_rows(rows, first_row, letters):
+    return ''.join(
+        f'<row r="{number}">' + ''.join(
+            _xlsx_cell(f'{letter}{number}', value) for letter, value in zip(letters, row)) +
+        '</row>'
+        for number, row in enumerate(rows, start=first_row))
+
+
+def iter_xlsx(kind, filters=None):
+    """Stream an export as an .xlsx file, a batch of CHUNK_ROWS rows at a time"""
+    labels, statement, convert = export_query(kind, filters)
+    letters = [get_column_letter(index) for index in range(1, len(labels) + 1)]
+    sheet_name = escape(EXPORT_KINDS[kind], {'"': '&quot;'})
+    stream = ZipStream()
+
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as package:
+        for name, xml in _XLSX_PARTS.items():
+            package.writestr(name, _XML_DECLARATION + xml)
+        package.writestr('xl/workbook.xml', _XML_DECLARATION + (
+            f'<workbook xmlns="{_XLSX_MAIN_NS}" xmlns:r="{_XLSX_DOC_REL}"><sheets>'
+            f'<sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets></workbook>'))
+
+        with package.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write((_XML_DECLARATION + f'<worksheet xmlns="{_XLSX_MAIN_NS}"><sheetData>' +
+                         _xlsx_rows([labels], 1, letters)).encode('utf-8'))
+            yield stream.drain()
+            next_row = 2
+            for rows in _iter_rows(statement, convert):
+                sheet.write(_xlsx_rows(rows, next_row, letters).encode('utf-8'))
+                next_row += len(rows)
+                yield stream.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield stream.drain()
+
+
+def export_filename(kind, export_format):
+    return f"{kind}_{date.today():%Y%m%d}.{export_format}"
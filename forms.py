@@ -3,7 +3,9 @@ from wtforms import StringField, PasswordField, BooleanField, SubmitField, Selec
 from wtforms import TextAreaField, DateField, FloatField, IntegerField, HiddenField, FileField
 from wtforms import SelectMultipleField, widgets
 from wtforms.validators import DataRequired, Email, Length, EqualTo, Optional, ValidationError
+from wtforms.validators import NumberRange
 from models import User, RealEstateAgent, Owner, Room, Building
+from pdf_forms import validate_pdf_settings, validate_pdf_template
 
 
 class LoginForm(FlaskForm):
@@ -248,7 +250,8 @@ class ContractForm(FlaskForm):
         # Populate the template dropdown
         self.template_id.choices = [
             (template.id, template.name)
-            for template in ContractTemplate.query.all()
+            for template in ContractTemplate.query.with_entities(
+                ContractTemplate.id, ContractTemplate.name)
         ]
 
         # Populate the special terms checkboxes
@@ -271,7 +274,8 @@ class ContractTemplateForm(FlaskForm):
     """Contract template form"""
     name = StringField('テンプレート名', validators=[DataRequired(), Length(max=100)])
     description = TextAreaField('説明', validators=[Optional()])
-    file_content = TextAreaField('テンプレート内容（HTMLのみ）', validators=[Optional()])
+    file_content = TextAreaField('テンプレート内容（HTML、またはPDFのフィールド設定JSON）',
+                                 validators=[Optional()])
     is_default = BooleanField('デフォルトテンプレート', default=False)
 
     file_type = SelectField('ファイル形式',
@@ -291,6 +295,12 @@ class ContractTemplateForm(FlaskForm):
         if self.file_type.data == 'html' and not field.data:
             raise ValidationError('HTML形式の場合はテンプレート内容を入力してください。')
 
+        # PDFの場合はフィールド・オーバーレイ設定（JSON）を確認
+        if self.file_type.data == 'pdf':
+            error = validate_pdf_settings(field.data)
+            if error:
+                raise ValidationError(error)
+
     def validate_template_file(self, field):
         # HTML以外の場合はファイルのアップロードが必要
         if self.file_type.data != 'html' and not field.data:
@@ -309,3 +319,151 @@ class ContractTemplateForm(FlaskForm):
             elif self.file_type.data == 'pdf' and not filename.endswith(
                     '.pdf'):
                 raise ValidationError('PDF形式のファイル(.pdf)をアップロードしてください。')
+
+            # PDFは記入できるファイルか確認（パスワード保護されたものは不可）
+            if self.file_type.data == 'pdf':
+                error = validate_pdf_template(field.data.read())
+                field.data.seek(0)
+                if error:
+                    raise ValidationError(error)
+
+
+class BulkRegenerateForm(FlaskForm):
+    """Filter form for bulk PDF regeneration"""
+    template_id = SelectField('契約書テンプレート', coerce=int, validators=[Optional()])
+    building_id = SelectField('建物', coerce=int, validators=[Optional()])
+    owner_id = SelectField('オーナー', coerce=int, validators=[Optional()])
+    start_from = DateField('契約開始日（から）', validators=[Optional()], format='%Y-%m-%d')
+    start_to = DateField('契約開始日（まで）', validators=[Optional()], format='%Y-%m-%d')
+    refreeze = BooleanField('契約書の記載内容を最新の登録データで更新する', default=False)
+    submit = SubmitField('PDFを一括再生成')
+
+    def __init__(self, *args, **kwargs):
+        super(BulkRegenerateForm, self).__init__(*args, **kwargs)
+        from models import ContractTemplate
+
+        # 0 means "no filter" for every dropdown
+        self.template_id.choices = [(0, 'すべて')] + [
+            (template.id, template.name)
+            for template in ContractTemplate.query.with_entities(
+                ContractTemplate.id, ContractTemplate.name)
+        ]
+        self.building_id.choices = [(0, 'すべて')] + [
+            (building.id, building.name) for building in Building.query.all()
+        ]
+        self.owner_id.choices = [(0, 'すべて')] + [(owner.id, owner.name)
+                                                 for owner in Owner.query.all()]
+
+
+class ImportForm(FlaskForm):
+    """Bulk import of owners, buildings or rooms from a CSV or Excel file"""
+    kind = SelectField('データの種類',
+                       choices=[('owners', 'オーナー'), ('buildings', '建物'), ('rooms', '部屋')],
+                       validators=[DataRequired()])
+    import_file = FileField('ファイル（CSV / Excel）', validators=[DataRequired()])
+    encoding = SelectField('文字コード（CSVの場合）',
+                           choices=[('utf-8-sig', 'UTF-8'), ('cp932', 'Shift_JIS')],
+                           default='utf-8-sig')
+    dry_run = BooleanField('検証のみ（登録しない）')
+    submit = SubmitField('インポート')
+
+    def validate_import_file(self, field):
+        if not field.data.filename.lower().endswith(('.csv', '.xlsx')):
+            raise ValidationError('CSV形式(.csv)またはExcel形式(.xlsx)のファイルをアップロードしてください。')
+
+
+class ContractFilterForm(FlaskForm):
+    """Filter and sort form for the contract list (GET parameters)"""
+
+    class Meta:
+        csrf = False
+
+    building_id = SelectField('建物', coerce=int, default=0, validators=[Optional()])
+    owner_id = SelectField('オーナー', coerce=int, default=0, validators=[Optional()])
+    agent_id = SelectField('宅建士', coerce=int, default=0, validators=[Optional()])
+    start_from = DateField('契約開始日（から）', validators=[Optional()], format='%Y-%m-%d')
+    start_to = DateField('契約開始日（まで）', validators=[Optional()], format='%Y-%m-%d')
+    rent_min = IntegerField('月額賃料（から）', validators=[Optional()])
+    rent_max = IntegerField('月額賃料（まで）', validators=[Optional()])
+    sort = SelectField('並び順',
+                       choices=[('created_at', '作成日'), ('start_date', '契約開始日'),
+                                ('rent_amount', '月額賃料')],
+                       default='created_at')
+    order = SelectField('順序', choices=[('desc', '降順'), ('asc', '昇順')], default='desc')
+
+    def __init__(self, *args, **kwargs):
+        super(ContractFilterForm, self).__init__(*args, **kwargs)
+
+        # 0 means "no filter" for every dropdown
+        self.building_id.choices = [(0, 'すべて')] + [
+            (building.id, building.name)
+            for building in Building.query.with_entities(Building.id, Building.name)
+        ]
+        self.owner_id.choices = [(0, 'すべて')] + [
+            (owner.id, owner.name)
+            for owner in Owner.query.with_entities(Owner.id, Owner.name)
+        ]
+        self.agent_id.choices = [(0, 'すべて')] + [
+            (agent.id, agent.name)
+            for agent in RealEstateAgent.query.with_entities(RealEstateAgent.id,
+                                                             RealEstateAgent.name)
+        ]
+
+    def filters(self):
+        """The filters to apply, as keyword arguments for get_contract_page"""
+        return {
+            'building_id': self.building_id.data or None,
+            'owner_id': self.owner_id.data or None,
+            'agent_id': self.agent_id.data or None,
+            'start_from': self.start_from.data,
+            'start_to': self.start_to.data,
+            'rent_min': self.rent_min.data,
+            'rent_max': self.rent_max.data,
+        }
+
+
+class ExpiringContractsForm(FlaskForm):
+    """Filter form for the expiring contract finder (GET parameters)"""
+
+    class Meta:
+        csrf = False
+
+    days = IntegerField('満了までの日数', default=60,
+                        validators=[Optional(), NumberRange(min=1, max=365)])
+    building_id = SelectField('建物', coerce=int, default=0, validators=[Optional()])
+    agent_id = SelectField('宅建士', coerce=int, default=0, validators=[Optional()])
+
+    def __init__(self, *args, **kwargs):
+        super(ExpiringContractsForm, self).__init__(*args, **kwargs)
+
+        # 0 means "no filter" for every dropdown
+        self.building_id.choices = [(0, 'すべて')] + [
+            (building.id, building.name)
+            for building in Building.query.with_entities(Building.id, Building.name)
+        ]
+        self.agent_id.choices = [(0, 'すべて')] + [
+            (agent.id, agent.name)
+            for agent in RealEstateAgent.query.with_entities(RealEstateAgent.id,
+                                                             RealEstateAgent.name)
+        ]
+
+    def filters(self):
+        """The filters to apply, as keyword arguments for find_expiring_contracts"""
+        return {
+            'days': self.days.data or 60,
+            'building_id': self.building_id.data or None,
+            'agent_id': self.agent_id.data or None,
+        }
+
+
+class RenewContractsForm(FlaskForm):
+    """Batch renewal of the contracts selected in the expiring contract finder"""
+    contract_ids = SelectMultipleField('更新する契約', coerce=int, validate_choice=False)
+    term_months = IntegerField('更新後の契約期間（月）',
+                               validators=[Optional(), NumberRange(min=1, max=120)],
+                               default=24)
+    submit = SubmitField('選択した契約を更新')
+
+    def validate_contract_ids(self, field):
+        if not field.data:
+            raise ValidationError('更新する契約を選択してください。')
@@ -0,0 +1,52 @@
+# Gunicorn settings, read from the working directory on start.
+#
+# The PDF render worker pool (jobs.py) runs as one `flask render-workers`
+# process next to the web workers, started and stopped with the server, so
+# web workers never fork render processes themselves. Set
+# RENDER_WORKERS_WITH_GUNICORN=0 when the pool runs as a separate service.
+import os
+import sys
+import subprocess
+
+# Building PDF archives (archives.py) wait up to ARCHIVE_RENDER_TIMEOUT for
+# queued renders and then stream for as long as the archive takes, and the
+# CSV/Excel exports (exporter.py) stream hundreds of thousands of rows. A
+# sync worker is killed once a request outlasts `timeout`, truncating the
+# download, so requests run on threads: a gthread worker keeps heartbeating
+# while its threads stream. The timeout is still kept above the render wait
+# plus the time to stream a large archive. Never deploy these downloads on
+# sync workers; on_starting refuses to start with them.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get(
+    'GUNICORN_TIMEOUT', float(os.environ.get('ARCHIVE_RENDER_TIMEOUT', 600)) + 3600))
+# Let running downloads finish on restarts
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 300))
+
+_render_workers = None
+
+
+def on_starting(server):
+    # gunicorn switches sync to gthread by itself when threads > 1
+    if server.cfg.worker_class.__name__ == 'SyncWorker':
+        raise SystemExit("Streaming downloads need a threaded worker class; "
+                         "sync workers cut them off after the timeout")
+
+
+def when_ready(server):
+    global _render_workers
+    if os.environ.get('RENDER_WORKERS_WITH_GUNICORN', '1') == '0':
+        return
+    # A fresh interpreter, so the master never imports the app
+    _render_workers = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'main', 'render-workers'])
+    server.log.info(f"Started render workers (pid {_render_workers.pid})")
+
+
+def on_exit(server):
+    if _render_workers and _render_workers.poll() is None:
+        _render_workers.terminate()
+        try:
+            _render_workers.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            _render_workers.kill()
@@ -0,0 +1,326 @@
+# Bulk import of owners, buildings and rooms from CSV or Excel files.
+#
+# The file is read one row at a time (csv.reader over the upload, or an
+# openpyxl read-only workbook), so memory does not grow with its size. Each
+# row is checked by the same form class as the add pages (OwnerForm,
+# BuildingForm, RoomForm): one form instance is built per import and
+# re-processed for every row. Valid rows are collected in batches of
+# BATCH_SIZE and written with one executemany INSERT per batch, or with COPY
+# on PostgreSQL. Invalid rows are skipped and reported with their row number.
+#
+# Columns are matched by the form's field labels (建物名, 住所, ...) or field
+# names. Buildings name their owner, and rooms their building, by name or id.
+# Structure, roof and building type values that are not one of the form's
+# choices are stored as free text, as the その他 option of the add page does.
+import io
+import csv
+import json
+import logging
+import zipfile
+from datetime import date, datetime
+
+import click
+from openpyxl import load_workbook
+from werkzeug.datastructures import MultiDict
+from wtforms import BooleanField, HiddenField, SubmitField
+from wtforms.fields.core import UnboundField
+from wtforms.validators import DataRequired
+
+from app import app, db
+from models import Owner, Building, Room
+from forms import OwnerForm, BuildingForm, RoomForm
+from stats import record_bulk_insert
+
+# Rows per INSERT (or COPY) statement
+BATCH_SIZE = 1000
+
+# Row errors kept for the report; later ones are only counted
+MAX_REPORTED_ERRORS = 500
+
+CSV_ENCODINGS = {'utf-8-sig': 'UTF-8', 'cp932': 'Shift_JIS'}
+
+# What can be imported: label, model, form, and the parent a row refers to
+IMPORT_KINDS = {
+    'owners': ('オーナー', Owner, OwnerForm, None),
+    'buildings': ('建物', Building, BuildingForm, ('owner_id', Owner, 'オーナー名')),
+    'rooms': ('部屋', Room, RoomForm, ('building_id', Building, '建物名')),
+}
+
+# Select fields whose other values are stored as free text via a custom_ field
+_FREE_TEXT_CHOICES = ('structure', 'roof_structure', 'building_type')
+
+# Cell values taken as a checked amenity
+_TRUE_VALUES = {'1', 'true', 'yes', 'y', '○', '◯', '有', 'あり', 'はい'}
+
+
+def import_columns(kind):
+    """(field name, column label, required) of each column of an import"""
+    _, _, form_class, _ = IMPORT_KINDS[kind]
+    columns = []
+    for name, field in vars(form_class).items():
+        if not isinstance(field, UnboundField) or field.field_class in (SubmitField, HiddenField):
+            continue
+        validators = field.kwargs.get('validators') or []
+        required = any(isinstance(validator, DataRequired) for validator in validators)
+        columns.append((name, field.args[0], required))
+    return columns
+
+
+def _column_map(kind, headers):
+    """Field name of each header (None for unknown columns)"""
+    names = {}
+    for name, label, _ in import_columns(kind):
+        names[name] = names[label] = name
+    parent = IMPORT_KINDS[kind][3]
+    if parent:
+        names.setdefault(parent[2], parent[0])
+    return [names.get(header) for header in headers]
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _rows_with_header(rows):
+    """Yield (row number, header list, cell list) for each non-empty row after the header"""
+    headers = None
+    for number, row in enumerate(rows, start=1):
+        cells = [_cell(value) for value in row]
+        if not any(cells):
+            continue
+        if headers is None:
+            headers = cells
+            continue
+        yield number, headers, cells
+
+
+def iter_rows(stream, filename, encoding='utf-8-sig'):
+    """Rows of a CSV or .xlsx file as (row number, headers, cells), one at a time"""
+    if filename.lower().endswith('.xlsx'):
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            yield from _rows_with_header(workbook.active.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+    else:
+        text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+        yield from _rows_with_header(csv.reader(text))
+
+
+def _parent_lookup(model):
+    """Ids of the parent rows, and their ids by name"""
+    ids = set()
+    by_name = {}
+    for parent_id, name in db.session.query(model.id, model.name):
+        ids.add(parent_id)
+        by_name.setdefault(name, []).append(parent_id)
+    return ids, by_name
+
+
+def _resolve_parent(value, ids, by_name):
+    """The parent id a cell names, or an error message"""
+    if not value:
+        return None, 'この項目は必須です。'
+    matches = by_name.get(value, [])
+    if len(matches) == 1:
+        return matches[0], None
+    if len(matches) > 1:
+        return None, f'「{value}」という名前が複数あります。IDで指定してください。'
+    if value.isdigit() and int(value) in ids:
+        return int(value), None
+    return None, f'「{value}」が見つかりません。'
+
+
+def _formdata(form, fields):
+    """Form data for a row, mapping booleans and free-text choices like the add pages"""
+    formdata = MultiDict()
+    for name, value in fields.items():
+        field = form[name]
+        if isinstance(field, BooleanField):
+            if value.lower() in _TRUE_VALUES:
+                formdata[name] = 'y'
+        elif name in _FREE_TEXT_CHOICES and value and \
+                value not in [choice for choice, _ in field.choices]:
+            formdata[name] = 'その他'
+            formdata.setdefault(f'custom_{name}', value)
+        elif value:
+            formdata[name] = value
+    return formdata
+
+
+def _choice_value(form, name):
+    value = form[name].data
+    custom = form[f'custom_{name}'].data
+    return custom if value == 'その他' and custom else (value or None)
+
+
+def _row_values(kind, form):
+    """Column values of a validated row, as the add pages would store them"""
+    if kind == 'owners':
+        return {
+            'name': form.name.data,
+            'address': form.address.data,
+            'phone': form.phone.data or None,
+            'email': form.email.data or None,
+            'notes': form.notes.data or None,
+        }
+    if kind == 'buildings':
+        return {
+            'name': form.name.data,
+            'address': form.address.data,
+            'structure': _choice_value(form, 'structure'),
+            'roof_structure': _choice_value(form, 'roof_structure'),
+            'floors': form.floors.data,
+            'total_units': form.total_units.data,
+            'building_type': _choice_value(form, 'building_type'),
+            'construction_date': form.construction_date.data,
+            'notes': form.notes.data or None,
+            'owner_id': form.owner_id.data,
+        }
+    custom_amenities = [item.strip() for item in (form.custom_amenities.data or '').split(',')
+                        if item.strip()]
+    values = {field.name: field.data for field in form if field.name.startswith('has_')}
+    values.update({
+        'room_number': form.room_number.data,
+        'layout': form.layout.data,
+        'floor_area': form.floor_area.data,
+        'floor': form.floor.data,
+        'custom_amenities': json.dumps(custom_amenities) if custom_amenities else None,
+        'notes': form.notes.data or None,
+        'building_id': form.building_id.data,
+    })
+    return values
+
+
+def _insert_batch(model, rows):
+    """Insert rows (dicts with the same keys) with COPY on PostgreSQL, or executemany"""
+    table = model.__table__
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        columns = list(rows[0])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            # None is written as an unquoted empty field, which COPY reads as NULL
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                           buffer)
+    else:
+        connection.execute(table.insert(), rows)
+
+
+def import_file(kind, stream, filename, encoding='utf-8-sig', dry_run=False):
+    """Import the owners, buildings or rooms in a CSV or .xlsx file.
+
+    Valid rows are inserted and committed together; invalid rows are skipped.
+    With dry_run, rows are only validated. Returns a report dict: kind, total,
+    imported, failed, errors ([(row number, message)], at most
+    MAX_REPORTED_ERRORS), ignored_columns and dry_run. Raises ValueError if
+    the file cannot be read or lacks a required column.
+    """
+    _, model, form_class, parent = IMPORT_KINDS[kind]
+    report = {'kind': kind, 'total': 0, 'imported': 0, 'failed': 0, 'errors': [],
+              'ignored_columns': [], 'dry_run': dry_run}
+    form = form_class(formdata=None, meta={'csrf': False})
+    if parent:
+        parent_field, parent_model, _ = parent
+        parent_ids, parents_by_name = _parent_lookup(parent_model)
+
+    def fail(number, message):
+        report['failed'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append((number, message))
+
+    now = datetime.utcnow()
+    batch = []
+    columns = None
+    headers = None
+    try:
+        for number, row_headers, cells in iter_rows(stream, filename, encoding):
+            if row_headers is not headers:
+                headers = row_headers
+                columns = _column_map(kind, headers)
+                report['ignored_columns'] = [header for header, name in zip(headers, columns)
+                                             if not name]
+                missing = [label for name, label, required in import_columns(kind)
+                           if required and name not in columns]
+                if missing:
+                    raise ValueError(f"必須の列がありません: {'、'.join(missing)}")
+            report['total'] += 1
+            fields = {name: value for name, value in zip(columns, cells) if name}
+
+            if parent:
+                parent_id, error = _resolve_parent(fields.get(parent_field, ''), parent_ids,
+                                                   parents_by_name)
+                if error:
+                    fail(number, f'{form[parent_field].label.text}: {error}')
+                    continue
+                fields[parent_field] = str(parent_id)
+                # Only the resolved parent needs to pass the select field check
+                form[parent_field].choices = [(parent_id, '')]
+
+            form.process(_formdata(form, fields))
+            if not form.validate():
+                fail(number, ' / '.join(f'{form[name].label.text}: {message}'
+                                        for name, messages in form.errors.items()
+                                        for message in messages))
+                continue
+
+            report['imported'] += 1
+            if not dry_run:
+                batch.append(dict(_row_values(kind, form), created_at=now))
+                if len(batch) >= BATCH_SIZE:
+                    _insert_batch(model, batch)
+                    batch = []
+    except (UnicodeDecodeError, csv.Error, zipfile.BadZipFile) as e:
+        db.session.rollback()
+        raise ValueError(f'ファイルを読み込めませんでした（文字コードまたは形式が正しくありません）: {e}')
+    except ValueError:
+        db.session.rollback()
+        raise
+
+    if dry_run:
+        return report
+    if batch:
+        _insert_batch(model, batch)
+    if report['imported']:
+        record_bulk_insert(model, report['imported'])
+    db.session.commit()
+    logging.info(f"Imported {report['imported']} {kind} from {filename} "
+                 f"({report['failed']} rows skipped)")
+    return report
+
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(list(IMPORT_KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--encoding', type=click.Choice(list(CSV_ENCODINGS)), default='utf-8-sig',
+              help='Encoding of a CSV file.')
+@click.option('--dry-run', is_flag=True, help='Only validate the rows.')
+def import_data_command(kind, path, encoding, dry_run):
+    """Import owners, buildings or rooms from a CSV or .xlsx file."""
+    with open(path, 'rb') as stream:
+        try:
+            report = import_file(kind, stream, path, encoding=encoding, dry_run=dry_run)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    verb = 'Validated' if dry_run else 'Imported'
+    click.echo(f"{verb} {report['imported']}/{report['total']} rows "
+               f"({report['failed']} rows with errors).")
+    if report['ignored_columns']:
+        click.echo(f"Ignored columns: {', '.join(report['ignored_columns'])}")
+    for number, message in report['errors']:
+        click.echo(f"  row {number}: {message}", err=True)
+    if report['failed'] > len(report['errors']):
+        click.echo(f"  ... and {report['failed'] - len(report['errors'])} more", err=True)
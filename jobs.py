@@ -0,0 +1,496 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+from datetime import datetime, timedelta
+
+import click
+
+from app import app, db
+from models import Contract, RenderJob, Room, Building
+from utils import generate_pdf, get_contract_data, get_contract_data_batch, mark_pdf_current
+from utils import release_artifacts, sweep_artifacts, refreeze_contracts
+from renderer import warm_up
+
+# Number of render worker processes per pool
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+
+# Render processes for bulk regeneration: the size of the `regenerate-pdfs`
+# pool, and what the render worker pool grows to while a bulk backlog of at
+# least BULK_QUEUE_THRESHOLD pending jobs is queued (from the admin page)
+BULK_RENDER_WORKERS = int(os.environ.get('BULK_RENDER_WORKERS', os.cpu_count() or 1))
+BULK_QUEUE_THRESHOLD = int(os.environ.get('BULK_QUEUE_THRESHOLD', 100))
+
+# Start a pool inside the web process on the first enqueue. Off by default:
+# the pool runs as its own process via `flask render-workers`, which
+# gunicorn.conf.py starts next to the web server. Only meant for a single
+# process development server.
+RENDER_WORKERS_AUTOSTART = os.environ.get('RENDER_WORKERS_AUTOSTART', '0') == '1'
+
+# Seconds an idle worker waits before polling the queue again
+POLL_INTERVAL = float(os.environ.get('RENDER_POLL_INTERVAL', 1.0))
+
+# Running jobs older than this are considered abandoned by a dead worker
+STALE_JOB_TIMEOUT = timedelta(minutes=10)
+
+# Seconds between sweeps queueing renders of stale PDFs (done by one worker)
+STALE_PDF_SWEEP_INTERVAL = float(os.environ.get('STALE_PDF_SWEEP_INTERVAL', 300))
+
+# Most stale PDFs queued per sweep
+STALE_PDF_SWEEP_LIMIT = int(os.environ.get('STALE_PDF_SWEEP_LIMIT', 500))
+
+_workers = []
+
+
+def enqueue_render(contract_id):
+    """Queue a PDF render for a contract and return the job.
+
+    An already pending job for the same contract is reused so repeated clicks
+    do not render the same document several times.
+    """
+    job = RenderJob.query.filter_by(contract_id=contract_id,
+                                    status='pending').first()
+    if not job:
+        job = RenderJob(contract_id=contract_id, status='pending')
+        db.session.add(job)
+        db.session.commit()
+        logging.info(f"Queued render job {job.id} for contract {contract_id}")
+
+    if RENDER_WORKERS_AUTOSTART:
+        ensure_render_workers()
+    return job
+
+
+def enqueue_renders(contract_ids, chunk_size=1000, start_workers=True):
+    """Queue PDF renders for many contracts with batched inserts.
+
+    Contracts that already have a pending job are skipped. Returns the number
+    of jobs created.
+    """
+    pending = {
+        contract_id
+        for (contract_id, ) in db.session.query(RenderJob.contract_id).filter_by(
+            status='pending')
+    }
+    now = datetime.utcnow()
+    rows = [{
+        'contract_id': contract_id,
+        'status': 'pending',
+        'attempts': 0,
+        'created_at': now
+    } for contract_id in contract_ids if contract_id not in pending]
+
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(db.insert(RenderJob), rows[start:start + chunk_size])
+    db.session.commit()
+    logging.info(f"Queued {len(rows)} render jobs")
+
+    if rows and start_workers and RENDER_WORKERS_AUTOSTART:
+        ensure_render_workers()
+        scale_render_workers()
+    return len(rows)
+
+
+def select_contract_ids(template_id=None, building_id=None, owner_id=None,
+                        start_from=None, start_to=None, stale_only=False):
+    """Return ids of the contracts matching the bulk regeneration filters"""
+    query = db.session.query(Contract.id)
+    if stale_only:
+        query = query.filter(Contract.pdf_stale_at.isnot(None))
+    if building_id or owner_id:
+        query = query.join(Room, Contract.room_id == Room.id)
+    if owner_id:
+        query = query.join(Building, Room.building_id == Building.id)
+
+    if template_id:
+        query = query.filter(Contract.template_id == template_id)
+    if building_id:
+        query = query.filter(Room.building_id == building_id)
+    if owner_id:
+        query = query.filter(Building.owner_id == owner_id)
+    if start_from:
+        query = query.filter(Contract.start_date >= start_from)
+    if start_to:
+        query = query.filter(Contract.start_date <= start_to)
+
+    return [contract_id for (contract_id, ) in query.order_by(Contract.id)]
+
+
+def find_stale_pdf_contract_ids(limit=STALE_PDF_SWEEP_LIMIT):
+    """Return ids of contracts whose existing PDF is stale, oldest edit first.
+
+    Contracts with a render already queued or running, or whose render failed
+    since they went stale, are left out. Stale contracts that never had a PDF
+    are rendered when someone first downloads one.
+    """
+    blocked = db.session.query(RenderJob.id).filter(
+        RenderJob.contract_id == Contract.id,
+        db.or_(RenderJob.status.in_(('pending', 'running')),
+               db.and_(RenderJob.status == 'failed',
+                       RenderJob.created_at >= Contract.pdf_stale_at)))
+    query = db.session.query(Contract.id).filter(
+        Contract.pdf_stale_at.isnot(None), Contract.pdf_path.isnot(None),
+        ~blocked.exists()).order_by(Contract.pdf_stale_at).limit(limit)
+    return [contract_id for (contract_id, ) in query]
+
+
+def sweep_stale_pdfs(limit=STALE_PDF_SWEEP_LIMIT, start_workers=True):
+    """Queue renders for stale PDFs and return the number of jobs created"""
+    contract_ids = find_stale_pdf_contract_ids(limit)
+    if not contract_ids:
+        db.session.rollback()
+        return 0
+    return enqueue_renders(contract_ids, start_workers=start_workers)
+
+
+def get_queue_stats():
+    """Summarize the render queue: counts per status and recent throughput"""
+    counts = dict(
+        db.session.query(RenderJob.status, db.func.count(RenderJob.id)).group_by(
+            RenderJob.status))
+    since = datetime.utcnow() - timedelta(hours=1)
+    finished_last_hour = RenderJob.query.filter(
+        RenderJob.finished_at >= since).count()
+    return {
+        'pending': counts.get('pending', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'per_hour': finished_last_hour
+    }
+
+
+def get_latest_job(contract_id):
+    """Return the most recent render job for a contract, if any"""
+    return RenderJob.query.filter_by(contract_id=contract_id).order_by(
+        RenderJob.id.desc()).first()
+
+
+def claim_next_job():
+    """Atomically move the oldest pending job to running and return its id"""
+    while True:
+        job_id = db.session.query(RenderJob.id).filter_by(
+            status='pending').order_by(RenderJob.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+
+        # Only one worker can win the pending -> running transition
+        claimed = RenderJob.query.filter_by(id=job_id, status='pending').update(
+            {
+                'status': 'running',
+                'started_at': datetime.utcnow(),
+                'attempts': RenderJob.attempts + 1
+            },
+            synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+
+
+def run_job(job_id):
+    """Render the PDF for a claimed job and record the outcome"""
+    job = db.session.get(RenderJob, job_id)
+    if not job:
+        return
+
+    replaced = []
+    try:
+        data = get_contract_data(job.contract_id)
+        if not data:
+            raise ValueError('契約書が見つかりません。')
+        record = data['record']
+        replaced = [record.pdf_path, record.original_file_path]
+        # Rendering errors reach the job row instead of a generic message
+        record.pdf_path = generate_pdf(job.contract_id, data=data, raise_errors=True)
+        mark_pdf_current(data)
+        job.status = 'done'
+        job.error = None
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(RenderJob, job_id)
+        job.status = 'failed'
+        job.error = str(e)
+        logging.error(f"Render job {job_id} failed: {e}")
+
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    if job.status == 'done':
+        # The files of the previous render, unless still in use
+        release_artifacts(replaced)
+    logging.info(f"Render job {job_id} finished with status {job.status}")
+
+
+def requeue_stale_jobs():
+    """Return jobs left running by a crashed worker to the queue"""
+    cutoff = datetime.utcnow() - STALE_JOB_TIMEOUT
+    count = RenderJob.query.filter(RenderJob.status == 'running',
+                                   RenderJob.started_at < cutoff).update(
+                                       {'status': 'pending'},
+                                       synchronize_session=False)
+    db.session.commit()
+    if count:
+        logging.warning(f"Requeued {count} stale render jobs")
+    return count
+
+
+def _worker_main(sweeper=False, burst=False):
+    """Entry point of a render worker process.
+
+    The sweeper worker also queues renders of stale PDFs every
+    STALE_PDF_SWEEP_INTERVAL seconds while the queue is empty. A burst
+    worker (see scale_render_workers) exits once the queue is empty.
+    """
+    last_sweep = 0.0
+    with app.app_context():
+        # Never share the parent's pooled connections across the fork
+        db.engine.dispose(close=False)
+        warm_up()
+        while True:
+            try:
+                job_id = claim_next_job()
+                if job_id is None:
+                    if burst:
+                        return
+                    if sweeper and time.monotonic() - last_sweep >= STALE_PDF_SWEEP_INTERVAL:
+                        last_sweep = time.monotonic()
+                        if sweep_stale_pdfs(start_workers=False):
+                            continue
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                run_job(job_id)
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Render worker error: {e}")
+                time.sleep(POLL_INTERVAL)
+            finally:
+                db.session.remove()
+
+
+def _start_worker(sweeper, burst, daemon):
+    worker = multiprocessing.Process(target=_worker_main,
+                                     args=(sweeper, burst),
+                                     name=f"render-worker-{len(_workers) + 1}",
+                                     daemon=daemon)
+    worker.sweeper = sweeper
+    worker.start()
+    _workers.append(worker)
+    logging.info(f"Started {worker.name} (pid {worker.pid})")
+
+
+def ensure_render_workers(count=None, daemon=True):
+    """Start (or restart) the render worker processes of this process"""
+    count = count or RENDER_WORKERS
+    _workers[:] = [worker for worker in _workers if worker.is_alive()]
+    if not _workers:
+        requeue_stale_jobs()
+
+    while len(_workers) < count:
+        # Exactly one live worker of the pool sweeps for stale PDFs
+        sweeper = not any(getattr(worker, 'sweeper', False) for worker in _workers)
+        _start_worker(sweeper, False, daemon)
+    return _workers
+
+
+def scale_render_workers(daemon=True):
+    """Grow the pool to BULK_RENDER_WORKERS while a bulk backlog is queued.
+
+    The extra workers exit once the queue is empty, so bulk regeneration from
+    the admin page runs on as many processes as `regenerate-pdfs` without
+    holding them between bulk runs. Returns the number of workers started.
+    """
+    _workers[:] = [worker for worker in _workers if worker.is_alive()]
+    if len(_workers) >= BULK_RENDER_WORKERS:
+        return 0
+    pending = RenderJob.query.filter_by(status='pending').count()
+    db.session.rollback()
+    if pending < BULK_QUEUE_THRESHOLD:
+        return 0
+
+    started = min(BULK_RENDER_WORKERS - len(_workers), pending)
+    for _ in range(started):
+        _start_worker(False, True, daemon)
+    logging.info(f"Started {started} burst render workers for {pending} pending jobs")
+    return started
+
+
+def _init_regeneration_worker():
+    """Pool initializer: give each forked process its own DB connections"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+    warm_up()
+
+
+def _regenerate_batch(contract_ids):
+    """Regenerate a batch of contract PDFs inside a pool process.
+
+    The batch's rendering contexts are loaded up front in a constant number
+    of queries. Returns a list of (contract id, error or None).
+    """
+    results = []
+    replaced = []
+    with app.app_context():
+        try:
+            contexts = get_contract_data_batch(contract_ids)
+            for contract_id in contract_ids:
+                data = contexts.get(contract_id)
+                if not data:
+                    results.append((contract_id, '契約書が見つかりません。'))
+                    continue
+                replaced += [data['record'].pdf_path, data['record'].original_file_path]
+                try:
+                    pdf_path = generate_pdf(contract_id, data=data, raise_errors=True)
+                except Exception as e:
+                    results.append((contract_id, str(e)))
+                    continue
+                data['record'].pdf_path = pdf_path
+                mark_pdf_current(data)
+                results.append((contract_id, None))
+            # One commit per batch; committing per contract would expire the
+            # preloaded contexts of the rest of the batch
+            db.session.commit()
+            release_artifacts(replaced)
+        except Exception as e:
+            db.session.rollback()
+            results = [(contract_id, str(e)) for contract_id in contract_ids]
+        finally:
+            db.session.remove()
+    return results
+
+
+def open_regeneration_pool(processes=None):
+    """A process pool for submit_regeneration (use it as a context manager)"""
+    return multiprocessing.Pool(processes or BULK_RENDER_WORKERS,
+                                initializer=_init_regeneration_worker)
+
+
+def submit_regeneration(pool, contract_ids, batch_size=50):
+    """Start regenerating contract PDFs on a pool.
+
+    The batches are handed to the pool right away. Returns an iterator of
+    (contract id, error or None) in the order the renders finish.
+    """
+    batches = [contract_ids[start:start + batch_size]
+               for start in range(0, len(contract_ids), batch_size)]
+    results = pool.imap_unordered(_regenerate_batch, batches)
+    return (result for batch in results for result in batch)
+
+
+def regenerate_contracts(contract_ids, processes=None, batch_size=50):
+    """Regenerate PDFs for many contracts across a process pool.
+
+    Returns a summary with throughput and the failed contract ids.
+    """
+    processes = processes or BULK_RENDER_WORKERS
+    failures = {}
+    done = 0
+    started = time.monotonic()
+
+    # Small enough batches that every process gets work
+    batch_size = max(1, min(batch_size, len(contract_ids) // (processes * 4) or 1))
+
+    with open_regeneration_pool(processes) as pool:
+        for contract_id, error in submit_regeneration(pool, contract_ids, batch_size):
+            done += 1
+            if error:
+                failures[contract_id] = error
+            if done % 500 == 0:
+                elapsed = time.monotonic() - started
+                logging.info(f"Regenerated {done}/{len(contract_ids)} PDFs "
+                             f"({done / elapsed:.1f}/s)")
+
+    elapsed = time.monotonic() - started
+    return {
+        'total': len(contract_ids),
+        'succeeded': len(contract_ids) - len(failures),
+        'failed': failures,
+        'elapsed': elapsed,
+        'per_second': len(contract_ids) / elapsed if elapsed else 0.0
+    }
+
+
+@app.cli.command('regenerate-pdfs')
+@click.option('--template-id', type=int, help='Only contracts using this template.')
+@click.option('--building-id', type=int, help='Only contracts for rooms in this building.')
+@click.option('--owner-id', type=int, help="Only contracts for this owner's buildings.")
+@click.option('--start-from', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Only contracts starting on or after this date.')
+@click.option('--start-to', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Only contracts starting on or before this date.')
+@click.option('--stale', is_flag=True,
+              help='Only contracts whose PDF is out of date after a template edit.')
+@click.option('--refreeze', is_flag=True,
+              help="Replace the contracts' frozen document data with the current data first.")
+@click.option('--processes', type=int, default=None,
+              help='Worker processes (defaults to BULK_RENDER_WORKERS, the number of CPUs).')
+def regenerate_pdfs_command(template_id, building_id, owner_id, start_from,
+                            start_to, stale, refreeze, processes):
+    """Regenerate contract PDFs in bulk across all CPU cores."""
+    contract_ids = select_contract_ids(
+        template_id=template_id,
+        building_id=building_id,
+        owner_id=owner_id,
+        start_from=start_from.date() if start_from else None,
+        start_to=start_to.date() if start_to else None,
+        stale_only=stale)
+    if not contract_ids:
+        click.echo('No matching contracts.')
+        return
+
+    if refreeze:
+        click.echo(f"Refreezing {len(contract_ids)} contract snapshots...")
+        refreeze_contracts(contract_ids)
+        db.session.commit()
+
+    click.echo(f"Regenerating {len(contract_ids)} contract PDFs...")
+    db.session.remove()
+    summary = regenerate_contracts(contract_ids, processes=processes)
+
+    click.echo(f"Done: {summary['succeeded']}/{summary['total']} succeeded in "
+               f"{summary['elapsed']:.1f}s ({summary['per_second']:.1f} PDFs/s)")
+    for contract_id, error in sorted(summary['failed'].items()):
+        click.echo(f"  contract {contract_id}: {error}", err=True)
+
+    removed, freed = sweep_artifacts()
+    click.echo(f"Removed {removed} unused stored files ({freed / 1024 / 1024:.1f} MB).")
+
+
+@app.cli.command('sweep-artifacts')
+@click.option('--grace', type=int, default=None,
+              help='Keep files touched within this many seconds (default ARTIFACT_GRACE_SECONDS).')
+def sweep_artifacts_command(grace):
+    """Delete stored PDFs and documents that no contract refers to."""
+    removed, freed = sweep_artifacts() if grace is None else sweep_artifacts(grace)
+    click.echo(f"Removed {removed} unused stored files ({freed / 1024 / 1024:.1f} MB).")
+
+
+@app.cli.command('sweep-stale-pdfs')
+@click.option('--limit', type=int, default=STALE_PDF_SWEEP_LIMIT,
+              help='Most renders to queue.')
+def sweep_stale_pdfs_command(limit):
+    """Queue renders for contract PDFs made stale by template edits."""
+    count = sweep_stale_pdfs(limit, start_workers=False)
+    click.echo(f"Queued {count} stale PDF renders.")
+
+
+@app.cli.command('render-workers')
+def render_workers_command():
+    """Run the PDF render worker pool in the foreground."""
+    ensure_render_workers(daemon=False)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # Set after the fork so that only this process handles it: gunicorn (or
+    # the service manager) stops the pool with SIGTERM
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        # Restart workers that died and add burst workers for bulk backlogs
+        while True:
+            time.sleep(POLL_INTERVAL)
+            ensure_render_workers(daemon=False)
+            scale_render_workers(daemon=False)
+    except KeyboardInterrupt:
+        for worker in _workers:
+            worker.terminate()
@@ -0,0 +1,270 @@
+# Versioned schema migrations.
+#
+# db.create_all() only creates missing tables; it never adds an index or a
+# column to a table that already exists. Every schema change to an existing
+# table therefore gets a migration here. Migrations run in order, once per
+# database, and are recorded in the schema_migrations table. They are written
+# to be safe on a database that create_all() has just built (IF NOT EXISTS),
+# so a fresh install and an upgraded one end up with the same schema.
+#
+# The app applies pending migrations on startup. Large deployments should run
+# `flask db-upgrade` before rolling out new web processes instead, so long
+# index builds do not hold up worker boot.
+import time
+import logging
+from datetime import datetime
+
+import click
+
+from app import app, db
+
+# Arbitrary key for the PostgreSQL advisory lock serializing migration runs
+MIGRATION_LOCK_ID = 726_300_114
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.String(64), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False, default=datetime.utcnow)
+)
+
+
+def _is_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def create_index(name, table, columns, unique=False):
+    """Create an index if it does not exist yet.
+
+    On PostgreSQL the index is built CONCURRENTLY so the table stays writable
+    while it builds. A concurrent build that failed earlier leaves an invalid
+    index behind, which is dropped and rebuilt.
+    """
+    column_list = ', '.join(columns)
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    started = time.monotonic()
+    if _is_postgresql():
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        with db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            invalid = connection.exec_driver_sql(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = %(name)s AND NOT i.indisvalid", {'name': name}).scalar()
+            if invalid:
+                connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            connection.exec_driver_sql(
+                f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column_list})")
+    else:
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(
+                f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({column_list})")
+    logging.info(f"Index {name} ready in {time.monotonic() - started:.1f}s")
+
+
+def add_column(table, name, definition):
+    """Add a column to an existing table unless it is already there"""
+    columns = {column['name'] for column in db.inspect(db.engine).get_columns(table)}
+    if name in columns:
+        return
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def create_table(model):
+    """Create a model's table (and its indexes) if it does not exist yet"""
+    model.__table__.create(db.engine, checkfirst=True)
+
+
+def _create_tables():
+    # Tables added since the last deploy (and everything, on a new database)
+    db.create_all()
+
+
+def _contract_list_indexes():
+    create_index('ix_contracts_created_at_id', 'contracts', ['created_at', 'id'])
+    create_index('ix_contracts_start_date_id', 'contracts', ['start_date', 'id'])
+    create_index('ix_contracts_rent_amount_id', 'contracts', ['rent_amount', 'id'])
+    create_index('ix_contracts_end_date', 'contracts', ['end_date'])
+    create_index('ix_contracts_room_id_start_date', 'contracts', ['room_id', 'start_date'])
+    create_index('ix_contracts_agent_id_created_at', 'contracts',
+                 ['agent_id', 'created_at', 'id'])
+
+
+def _foreign_key_indexes():
+    create_index('ix_contracts_created_by_id', 'contracts', ['created_by_id'])
+    create_index('ix_contracts_template_id', 'contracts', ['template_id'])
+    create_index('ix_rooms_building_id', 'rooms', ['building_id'])
+    create_index('ix_buildings_owner_id', 'buildings', ['owner_id'])
+    create_index('ix_contract_special_terms_special_term_id', 'contract_special_terms',
+                 ['special_term_id'])
+
+
+def _contract_number_counters():
+    from models import ContractNumberCounter
+    create_table(ContractNumberCounter)
+
+
+def _contract_snapshots():
+    # Existing contracts are frozen lazily, the first time they are rendered
+    add_column('contracts', 'snapshot', 'TEXT')
+
+
+def _contract_dependencies():
+    from models import ContractDependency
+    add_column('contracts', 'pdf_stale_at', 'TIMESTAMP')
+    create_index('ix_contracts_pdf_stale_at', 'contracts', ['pdf_stale_at'])
+    create_table(ContractDependency)
+    # Backfill from the live relations; contracts frozen from now on record
+    # their own dependencies
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM contract_dependencies")
+        connection.exec_driver_sql(
+            "INSERT INTO contract_dependencies (contract_id, entity_type, entity_id) "
+            "SELECT id, 'room', room_id FROM contracts "
+            "UNION ALL SELECT id, 'agent', agent_id FROM contracts "
+            "UNION ALL SELECT id, 'template', template_id FROM contracts "
+            "UNION ALL SELECT c.id, 'building', r.building_id FROM contracts c "
+            "JOIN rooms r ON r.id = c.room_id "
+            "UNION ALL SELECT c.id, 'owner', b.owner_id FROM contracts c "
+            "JOIN rooms r ON r.id = c.room_id JOIN buildings b ON b.id = r.building_id "
+            "UNION ALL SELECT contract_id, 'special_term', special_term_id "
+            "FROM contract_special_terms")
+
+
+def _dashboard_stats():
+    # Filled from the live tables on the first dashboard load
+    from models import DashboardStat
+    create_table(DashboardStat)
+
+
+def _contract_renewals():
+    add_column('contracts', 'renewed_from_id', 'INTEGER REFERENCES contracts (id) ON DELETE SET NULL')
+    # Unique: a contract is renewed at most once, even by concurrent requests
+    create_index('ix_contracts_renewed_from_id', 'contracts', ['renewed_from_id'], unique=True)
+
+
+def _seed_contract_number_counters():
+    # Contract numbers are allocated from the counters alone, so they must
+    # start after every number already used: the highest numeric suffix per
+    # day (compared as a number, 20240101-10000 is above 20240101-9999)
+    from models import ContractNumberCounter
+    last_numbers = {}
+    with db.engine.connect() as connection:
+        for (number, ) in connection.execute(
+                db.text("SELECT contract_number FROM contracts")).yield_per(10000):
+            day, _, sequence = number.partition('-')
+            if len(day) == 8 and day.isdigit() and sequence.isdigit():
+                last_numbers[day] = max(last_numbers.get(day, 0), int(sequence))
+    if not last_numbers:
+        return
+
+    if _is_postgresql():
+        from sqlalchemy.dialects.postgresql import insert
+        greatest = db.func.greatest
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        greatest = db.func.max
+    statement = insert(ContractNumberCounter)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ContractNumberCounter.day],
+        set_={'last_number': greatest(ContractNumberCounter.last_number,
+                                      statement.excluded.last_number)})
+    with db.engine.begin() as connection:
+        connection.execute(statement, [{'day': day, 'last_number': last_number}
+                                       for day, last_number in last_numbers.items()])
+
+
+def _snapshot_outdated_flag():
+    add_column('contracts', 'snapshot_outdated_at', 'TIMESTAMP')
+
+
+
+def _uncompressed_template_files():
+    # Template downloads read file_binary a slice at a time with substr().
+    # PostgreSQL decompresses a compressed TOAST value in full for every
+    # slice; stored EXTERNAL (out of line, uncompressed) it reads only the
+    # chunks a slice covers. Rewriting the values stores the existing ones
+    # that way too.
+    if not _is_postgresql():
+        return
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(
+            "ALTER TABLE contract_templates ALTER COLUMN file_binary SET STORAGE EXTERNAL")
+        connection.exec_driver_sql(
+            "UPDATE contract_templates SET file_binary = file_binary || ''::bytea "
+            "WHERE file_binary IS NOT NULL")
+
+
+# (version, description, function), in the order they must be applied
+MIGRATIONS = [
+    ('0001_create_tables', 'Create missing tables', _create_tables),
+    ('0002_contract_list_indexes', 'Indexes for contract list sorting and filters',
+     _contract_list_indexes),
+    ('0003_foreign_key_indexes', 'Indexes on foreign keys', _foreign_key_indexes),
+    ('0004_contract_number_counters', 'Per-day contract number counters',
+     _contract_number_counters),
+    ('0005_contract_snapshots', 'Frozen document data on contracts', _contract_snapshots),
+    ('0006_contract_dependencies', 'Contract dependency index and stale PDF flag',
+     _contract_dependencies),
+    ('0007_dashboard_stats', 'Materialized dashboard statistics', _dashboard_stats),
+    ('0008_contract_renewals', 'Link renewed contracts to their predecessor',
+     _contract_renewals),
+    ('0009_seed_contract_number_counters', 'Start contract number counters after used numbers',
+     _seed_contract_number_counters),
+    ('0010_snapshot_outdated_flag', 'Flag contracts whose snapshot predates a data edit',
+     _snapshot_outdated_flag),
+    ('0011_uncompressed_template_files', 'Store template files uncompressed for sliced reads',
+     _uncompressed_template_files),
+]
+
+
+def get_applied_migrations():
+    """Versions already applied to the database"""
+    schema_migrations.create(db.engine, checkfirst=True)
+    with db.engine.connect() as connection:
+        return {row[0] for row in connection.execute(db.select(schema_migrations.c.version))}
+
+
+def upgrade_database():
+    """Apply pending migrations and return the versions that were applied"""
+    lock_connection = None
+    if _is_postgresql():
+        # Several web processes may start at once; let one of them migrate
+        lock_connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        lock_connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+
+    applied_now = []
+    try:
+        applied = get_applied_migrations()
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            logging.info(f"Applying migration {version}: {description}")
+            migrate()
+            with db.engine.begin() as connection:
+                connection.execute(schema_migrations.insert().values(
+                    version=version, applied_at=datetime.utcnow()))
+            applied_now.append(version)
+    finally:
+        if lock_connection is not None:
+            lock_connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+            lock_connection.close()
+    return applied_now
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending database migrations."""
+    applied = upgrade_database()
+    if not applied:
+        click.echo('Database is up to date.')
+    for version in applied:
+        click.echo(f"Applied {version}")
+
+
+@app.cli.command('db-status')
+def db_status_command():
+    """List database migrations and whether they are applied."""
+    applied = get_applied_migrations()
+    for version, description, _ in MIGRATIONS:
+        mark = 'x' if version in applied else ' '
+        click.echo(f"[{mark}] {version}  {description}")
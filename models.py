@@ -1,7 +1,7 @@
 from app import db
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 
 class User(UserMixin, db.Model):
     """User model for authentication and user management"""
@@ -76,7 +76,7 @@ class Building(db.Model):
     construction_date = db.Column(db.Date, nullable=True)  # New construction date
     
     # Foreign key
-    owner_id = db.Column(db.Integer, db.ForeignKey('owners.id'), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey('owners.id'), nullable=False, index=True)
     
     # Other fields
     notes = db.Column(db.Text, nullable=True)
@@ -122,7 +122,7 @@ class Room(db.Model):
     custom_amenities = db.Column(db.Text, nullable=True)  # Stored as JSON
     
     # Foreign key
-    building_id = db.Column(db.Integer, db.ForeignKey('buildings.id'), nullable=False)
+    building_id = db.Column(db.Integer, db.ForeignKey('buildings.id'), nullable=False, index=True)
     
     # Other fields
     notes = db.Column(db.Text, nullable=True)
@@ -144,17 +144,35 @@ class ContractTemplate(db.Model):
     description = db.Column(db.Text, nullable=True)
     file_content = db.Column(db.Text, nullable=False)  # HTML/Template content
     file_type = db.Column(db.String(20), nullable=False, default='html')  # html, excel, word, pdf
-    file_binary = db.Column(db.LargeBinary, nullable=True)  # For storing binary content
+    # Uploaded file; deferred so listing templates never loads the blobs
+    file_binary = deferred(db.Column(db.LargeBinary, nullable=True))
     file_name = db.Column(db.String(255), nullable=True)  # Original filename
     is_default = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     contracts = relationship("Contract", back_populates="template")
+    placeholder_index = relationship("ContractTemplateIndex", back_populates="template",
+                                     uselist=False, cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<ContractTemplate {self.name}>'
 
+class ContractTemplateIndex(db.Model):
+    """Placeholder locations parsed from an uploaded Excel/Word template"""
+    __tablename__ = 'contract_template_indexes'
+    
+    template_id = db.Column(db.Integer, db.ForeignKey('contract_templates.id'), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the indexed file_binary
+    data = db.Column(db.Text, nullable=False)  # Stored as JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    template = relationship("ContractTemplate", back_populates="placeholder_index")
+    
+    def __repr__(self):
+        return f'<ContractTemplateIndex for Template {self.template_id}>'
+
 class SpecialTerm(db.Model):
     """Special terms that can be added to contracts"""
     __tablename__ = 'special_terms'
@@ -172,7 +190,8 @@ class SpecialTerm(db.Model):
 contract_special_terms = db.Table(
     'contract_special_terms',
     db.Column('contract_id', db.Integer, db.ForeignKey('contracts.id'), primary_key=True),
-    db.Column('special_term_id', db.Integer, db.ForeignKey('special_terms.id'), primary_key=True)
+    db.Column('special_term_id', db.Integer, db.ForeignKey('special_terms.id'), primary_key=True,
+              index=True)
 )
 
 class Contract(db.Model):
@@ -203,11 +222,22 @@ class Contract(db.Model):
     # Original file path (for Excel, Word, etc.)
     original_file_path = db.Column(db.String(255), nullable=True)
     
+    # Frozen JSON copy of the data the document shows, taken at creation
+    snapshot = db.Column(db.Text, nullable=True)
+    
+    # Set when the contract's template was edited; cleared by the next render
+    pdf_stale_at = db.Column(db.DateTime, nullable=True, index=True)
+    
+    # Set when live data the snapshot was taken from was edited; cleared when
+    # the snapshot is explicitly refrozen
+    snapshot_outdated_at = db.Column(db.DateTime, nullable=True)
+    
     # Foreign keys
     room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=False)
     agent_id = db.Column(db.Integer, db.ForeignKey('agents.id'), nullable=False)
-    created_by_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    template_id = db.Column(db.Integer, db.ForeignKey('contract_templates.id'), nullable=False)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    template_id = db.Column(db.Integer, db.ForeignKey('contract_templates.id'), nullable=False, index=True)
+    renewed_from_id = db.Column(db.Integer, db.ForeignKey('contracts.id', ondelete='SET NULL'), nullable=True, index=True, unique=True)  # Contract this one renews
     
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -219,7 +249,77 @@ class Contract(db.Model):
     created_by = relationship("User", back_populates="contracts")
     template = relationship("ContractTemplate", back_populates="contracts")
     special_terms = db.relationship('SpecialTerm', secondary=contract_special_terms,
-                                    lazy='subquery', backref=db.backref('contracts', lazy=True))
+                                    lazy='select', backref=db.backref('contracts', lazy=True))
+    
+    # Keyset pagination and the contract list filters/sorts walk these indexes
+    # (room_id and agent_id lookups use the composite ones)
+    __table_args__ = (
+        db.Index('ix_contracts_created_at_id', 'created_at', 'id'),
+        db.Index('ix_contracts_start_date_id', 'start_date', 'id'),
+        db.Index('ix_contracts_rent_amount_id', 'rent_amount', 'id'),
+        db.Index('ix_contracts_end_date', 'end_date'),
+        db.Index('ix_contracts_room_id_start_date', 'room_id', 'start_date'),
+        db.Index('ix_contracts_agent_id_created_at', 'agent_id', 'created_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<Contract {self.contract_number} for {self.tenant_name}>'
+
+class ContractNumberCounter(db.Model):
+    """Last contract number handed out per day (see allocate_contract_numbers)"""
+    __tablename__ = 'contract_number_counters'
+    
+    day = db.Column(db.String(8), primary_key=True)  # YYYYMMDD
+    last_number = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<ContractNumberCounter {self.day}: {self.last_number}>'
+
+class ContractDependency(db.Model):
+    """An entity whose data a contract's document shows (see mark_pdfs_stale)"""
+    __tablename__ = 'contract_dependencies'
+    
+    contract_id = db.Column(db.Integer, db.ForeignKey('contracts.id', ondelete='CASCADE'), primary_key=True)
+    entity_type = db.Column(db.String(20), primary_key=True)  # owner, building, room, agent, special_term, template
+    entity_id = db.Column(db.Integer, primary_key=True)
+    
+    # Relationships
+    contract = relationship("Contract", backref=db.backref('dependencies', lazy=True, cascade="all, delete-orphan"))
+    
+    # Edits look up the contracts depending on one entity
+    __table_args__ = (
+        db.Index('ix_contract_dependencies_entity', 'entity_type', 'entity_id'),
+    )
+    
+    def __repr__(self):
+        return f'<ContractDependency {self.contract_id} -> {self.entity_type} {self.entity_id}>'
+
+class DashboardStat(db.Model):
+    """A dashboard figure kept up to date incrementally (see stats.py)"""
+    __tablename__ = 'dashboard_stats'
+    
+    name = db.Column(db.String(40), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    as_of = db.Column(db.Date, nullable=True)  # Day a date-dependent figure is valid for
+    
+    def __repr__(self):
+        return f'<DashboardStat {self.name}: {self.value}>'
+
+class RenderJob(db.Model):
+    """Queued PDF render job for a contract"""
+    __tablename__ = 'render_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, db.ForeignKey('contracts.id', ondelete='CASCADE'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    contract = relationship("Contract", backref=db.backref('render_jobs', lazy=True, cascade="all, delete-orphan"))
+    
+    def __repr__(self):
+        return f'<RenderJob {self.id} for Contract {self.contract_id} ({self.status})>'
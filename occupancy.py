@@ -0,0 +1,181 @@
+# Room occupancy: which rooms are under a contract on a given day.
+#
+# OccupancyIndex is an interval index over the contracts' start and end
+# dates. Each room's contracts are merged into disjoint occupied periods (an
+# open-ended contract runs to date.max), so the number of rooms occupied on a
+# day is the number of periods started by then minus the number already
+# ended: two bisections on sorted lists, per building or for the portfolio.
+#
+# A building's index is loaded from its rooms' contracts when asked for (a
+# few indexed rows). The portfolio index is built once per process; when the
+# contracts_version or rooms_version counters (stats.py) move, it is rebuilt
+# in a background thread while the previous one keeps answering, so portfolio
+# figures may lag a change by the few seconds a rebuild of a large portfolio
+# takes.
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+
+from app import app, db
+from models import Contract, Room
+from stats import get_data_versions
+
+# Default length of the vacancy calendar, in months
+CALENDAR_MONTHS = 12
+
+OPEN_END = date.max.toordinal()
+
+_portfolio_index = None
+_portfolio_version = None
+_portfolio_rebuilding = False
+_portfolio_lock = threading.Lock()
+
+
+class OccupancyIndex:
+    """Occupied periods of a set of rooms, with per-building timelines"""
+
+    def __init__(self, rooms, contracts):
+        """`rooms` yields (room_id, building_id); `contracts` yields
+        (room_id, start_date, end_date) ordered by room and start date."""
+        self.building_of = dict(rooms)
+        self.periods = {}
+        for room_id, start_date, end_date in contracts:
+            if room_id not in self.building_of:
+                continue
+            start = start_date.toordinal()
+            end = end_date.toordinal() if end_date else OPEN_END
+            periods = self.periods.setdefault(room_id, [])
+            if periods and start <= periods[-1][1] + 1:
+                # Overlapping or back-to-back contracts: one occupied period
+                periods[-1][1] = max(periods[-1][1], end)
+            else:
+                periods.append([start, end])
+
+        self.room_counts = {None: len(self.building_of)}
+        for building_id in self.building_of.values():
+            self.room_counts[building_id] = self.room_counts.get(building_id, 0) + 1
+        # Sorted period starts and ends for all rooms (None) and, once asked
+        # for, per building
+        self.timelines = {None: self._build_timeline(self.periods.values())}
+
+    @staticmethod
+    def _build_timeline(room_periods):
+        starts = sorted(start for periods in room_periods for start, _ in periods)
+        ends = sorted(end for periods in room_periods for _, end in periods)
+        return starts, ends
+
+    def _timeline(self, building_id):
+        if building_id not in self.timelines:
+            self.timelines[building_id] = self._build_timeline(
+                [periods for room_id, periods in self.periods.items()
+                 if self.building_of[room_id] == building_id])
+        return self.timelines[building_id]
+
+    def occupied(self, day, building_id=None):
+        """Number of rooms under a contract on a day"""
+        starts, ends = self._timeline(building_id)
+        day = day.toordinal()
+        return bisect_right(starts, day) - bisect_left(ends, day)
+
+    def summary(self, day, building_id=None):
+        """Occupied and vacant room counts on a day"""
+        rooms = self.room_counts.get(building_id, 0)
+        occupied = self.occupied(day, building_id)
+        return {
+            'date': day.isoformat(),
+            'rooms': rooms,
+            'occupied': occupied,
+            'vacant': rooms - occupied,
+            'occupancy_rate': round(occupied * 100 / rooms, 1) if rooms else 0.0
+        }
+
+    def calendar(self, start=None, months=CALENDAR_MONTHS, building_id=None):
+        """Occupancy summaries for each day of calendar_days(start, months)"""
+        return [self.summary(day, building_id) for day in calendar_days(start, months)]
+
+    def room_status(self, room_id, day):
+        """Whether a room is occupied on a day, and until when.
+
+        Returns {'occupied', 'until', 'next_start'}: `until` is the last day
+        of the current occupied period (None if open-ended) and `next_start`
+        the start of the next one for a vacant room (None if none is booked).
+        """
+        day = day.toordinal()
+        for start, end in self.periods.get(room_id, ()):
+            if start <= day <= end:
+                return {'occupied': True, 'next_start': None,
+                        'until': date.fromordinal(end) if end != OPEN_END else None}
+            if start > day:
+                return {'occupied': False, 'until': None,
+                        'next_start': date.fromordinal(start)}
+        return {'occupied': False, 'until': None, 'next_start': None}
+
+    def room_calendar(self, room_id, days):
+        """Occupied (True) or vacant (False) on each of `days`"""
+        periods = self.periods.get(room_id, ())
+        return [any(start <= day.toordinal() <= end for start, end in periods)
+                for day in days]
+
+
+def calendar_days(start=None, months=CALENDAR_MONTHS):
+    """`start` (today by default) followed by the first day of each following month"""
+    start = start or date.today()
+    days = [start]
+    month = start.replace(day=1)
+    for _ in range(months - 1):
+        month = (month + timedelta(days=32)).replace(day=1)
+        days.append(month)
+    return days
+
+
+def load_occupancy_index(building_id=None):
+    """Build the occupancy index of a building, or of every room"""
+    rooms = db.session.query(Room.id, Room.building_id)
+    contracts = db.session.query(Contract.room_id, Contract.start_date, Contract.end_date)
+    if building_id:
+        rooms = rooms.filter(Room.building_id == building_id)
+        contracts = contracts.filter(Contract.room_id.in_(
+            db.select(Room.id).where(Room.building_id == building_id)))
+    return OccupancyIndex(rooms.all(), contracts.order_by(Contract.room_id,
+                                                          Contract.start_date).all())
+
+
+def _build_portfolio_index(version):
+    global _portfolio_index, _portfolio_version
+    index = load_occupancy_index()
+    with _portfolio_lock:
+        _portfolio_index = index
+        _portfolio_version = version
+    logging.info(f"Built occupancy index of {len(index.building_of)} rooms")
+    return index
+
+
+def _rebuild_portfolio_index(version):
+    global _portfolio_rebuilding
+    try:
+        with app.app_context():
+            _build_portfolio_index(version)
+    except Exception as e:
+        logging.error(f"Error rebuilding occupancy index: {e}")
+    finally:
+        _portfolio_rebuilding = False
+
+
+def get_occupancy_index():
+    """The portfolio occupancy index of this process.
+
+    The first call builds it. After a change to contracts or rooms, the
+    previous index is returned while a background thread rebuilds it.
+    """
+    global _portfolio_rebuilding
+    # Read the version before the data, so a concurrent change forces a rebuild
+    version = get_data_versions()
+    with _portfolio_lock:
+        index = _portfolio_index
+        stale = index is not None and _portfolio_version != version
+        if stale and not _portfolio_rebuilding:
+            _portfolio_rebuilding = True
+            threading.Thread(target=_rebuild_portfolio_index, args=(version, ),
+                             name='occupancy-index', daemon=True).start()
+    return index if index is not None else _build_portfolio_index(version)
@@ -0,0 +1,508 @@
+# Filling PDF templates (e.g. the pre-printed MLIT standard lease forms).
+#
+# A PDF template is parsed once into a ParsedPdfTemplate that keeps the
+# resolved AcroForm text fields and page dictionaries in memory. Filling a
+# contract copies only the dictionaries it changes (fields, widgets and pages
+# carrying overlays) and appends them to the untouched template bytes as an
+# incremental update, so unchanged pages are never re-serialized.
+#
+# Per-template settings are JSON stored in the template's file_content:
+#   {"fields":   {"field name": "text with {{placeholders}}"},
+#    "overlays": [{"page": 1, "x": 120, "y": 700, "size": 10,
+#                  "text": "{{contract.tenant_name}}"}]}
+# AcroForm fields named after a placeholder (e.g. "contract.tenant_name") are
+# filled without any settings. Overlay coordinates are PDF points from the
+# bottom-left corner of the page.
+#
+# Encrypted templates that open without a password (permission-only
+# encryption) are rewritten once, unencrypted, when parsed; the incremental
+# updates are appended to that copy. Templates that need a password to open
+# are rejected.
+import re
+import json
+import logging
+from io import BytesIO
+
+from PyPDF2 import PdfReader
+from PyPDF2.errors import PyPdfError
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject,
+                            FloatObject, IndirectObject, NameObject, NumberObject,
+                            TextStringObject)
+
+from placeholders import PLACEHOLDER_PATTERN, _substitute
+
+# Text is drawn with a standard Japanese CID font that PDF viewers provide,
+# so nothing has to be embedded per document
+FONT_RESOURCE = '/FJ1'
+FONT_NAME = '/HeiseiKakuGo-W5'
+DEFAULT_FONT_SIZE = 10
+
+# Field flag marking a multi-line text field
+_MULTILINE_FLAG = 1 << 12
+
+_DA_FONT_SIZE = re.compile(r'([\d.]+)\s+Tf')
+
+
+def load_pdf_settings(file_content):
+    """Parse a PDF template's JSON settings; non-JSON content means none"""
+    if not file_content or not file_content.lstrip().startswith('{'):
+        return {}
+    settings = json.loads(file_content)
+    if not isinstance(settings, dict):
+        raise ValueError('PDF template settings must be a JSON object')
+    return settings
+
+
+def validate_pdf_settings(file_content):
+    """Return an error message for invalid PDF template settings, or None"""
+    try:
+        settings = load_pdf_settings(file_content)
+    except ValueError as e:
+        return f"JSONの形式が正しくありません: {e}"
+
+    fields = settings.get('fields', {})
+    if not isinstance(fields, dict) or \
+            not all(isinstance(value, str) for value in fields.values()):
+        return '"fields" はフィールド名と文字列の組で指定してください。'
+
+    overlays = settings.get('overlays', [])
+    if not isinstance(overlays, list):
+        return '"overlays" は配列で指定してください。'
+    for overlay in overlays:
+        if not isinstance(overlay, dict) or not isinstance(overlay.get('text'), str):
+            return '"overlays" の各要素には "text" が必要です。'
+        for key in ('page', 'x', 'y'):
+            if not isinstance(overlay.get(key), (int, float)):
+                return f'"overlays" の各要素には数値の "{key}" が必要です。'
+        if overlay['page'] < 1:
+            return '"page" は1以上で指定してください。'
+    return None
+
+
+class PasswordRequiredError(ValueError):
+    """The PDF template can only be opened with a password"""
+
+
+def validate_pdf_template(file_binary):
+    """Return an error message for a PDF template that cannot be filled, or None"""
+    try:
+        ParsedPdfTemplate(file_binary)
+    except PasswordRequiredError as e:
+        return str(e)
+    except (PyPdfError, ValueError, KeyError) as e:
+        return f"PDFファイルを読み込めませんでした: {e}"
+    return None
+
+
+def _encode_text(text):
+    """Hex string for UniJIS-UCS2-H: UCS-2 big endian, BMP characters only"""
+    text = ''.join(char if ord(char) <= 0xFFFF else '?' for char in text)
+    return '<' + text.encode('utf-16-be').hex().upper() + '>'
+
+
+def _text_width(text, size):
+    # Matches the font's /W: half-width for ASCII, full-width for the rest
+    return sum(500 if ' ' <= char <= '~' else 1000 for char in text) * size / 1000
+
+
+def _font_objects():
+    """The Type0 font dictionary and its descendants, first one is the font"""
+    descriptor = DictionaryObject({
+        NameObject('/Type'): NameObject('/FontDescriptor'),
+        NameObject('/FontName'): NameObject(FONT_NAME),
+        NameObject('/Flags'): NumberObject(4),
+        NameObject('/FontBBox'): ArrayObject([NumberObject(v) for v in (-92, -250, 1010, 922)]),
+        NameObject('/ItalicAngle'): NumberObject(0),
+        NameObject('/Ascent'): NumberObject(752),
+        NameObject('/Descent'): NumberObject(-221),
+        NameObject('/CapHeight'): NumberObject(737),
+        NameObject('/StemV'): NumberObject(114),
+    })
+    cid_font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/CIDFontType0'),
+        NameObject('/BaseFont'): NameObject(FONT_NAME),
+        NameObject('/CIDSystemInfo'): DictionaryObject({
+            NameObject('/Registry'): TextStringObject('Adobe'),
+            NameObject('/Ordering'): TextStringObject('Japan1'),
+            NameObject('/Supplement'): NumberObject(2),
+        }),
+        NameObject('/DW'): NumberObject(1000),
+        NameObject('/W'): ArrayObject([NumberObject(1), NumberObject(95), NumberObject(500)]),
+    })
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type0'),
+        NameObject('/BaseFont'): NameObject(FONT_NAME),
+        NameObject('/Encoding'): NameObject('/UniJIS-UCS2-H'),
+    })
+    return font, cid_font, descriptor
+
+
+def _stream(data, entries=None):
+    stream = DecodedStreamObject()
+    if entries:
+        stream.update(entries)
+    stream.set_data(data.encode('latin-1') if isinstance(data, str) else data)
+    return stream
+
+
+class ParsedPdfTemplate:
+    """A PDF template parsed once and filled many times"""
+
+    def __init__(self, file_binary):
+        reader = PdfReader(BytesIO(file_binary))
+        if reader.is_encrypted:
+            file_binary = self._decrypted_copy(reader)
+            reader = PdfReader(BytesIO(file_binary))
+        self.data = file_binary
+        self.fields = {}
+        self.pages = []
+
+        self.startxref = self._find_startxref(file_binary)
+        # Updates must use the same kind of cross-reference section
+        self.xref_stream = not file_binary[self.startxref:].lstrip().startswith(b'xref')
+        trailer = reader.trailer
+        # PyPDF2 leaves /Size out of the trailer it reads from an xref stream
+        numbers = [number for entries in reader.xref.values() for number in entries]
+        numbers += list(reader.xref_objStm)
+        self.size = max(int(trailer.get('/Size', 0)), max(numbers, default=0) + 1)
+        self.trailer = DictionaryObject({
+            NameObject(key): trailer.raw_get(key)
+            for key in ('/Root', '/Info', '/ID') if key in trailer
+        })
+
+        # Resolve everything filling needs now; the reader is not used again,
+        # so a cached template can be shared without locking
+        for page in reader.pages:
+            ref = page.indirect_ref
+            resources = page.get('/Resources') or DictionaryObject()
+            fonts = resources.get('/Font') or DictionaryObject()
+            self.pages.append({
+                'ref': ref,
+                'page': DictionaryObject(page),
+                'resources': DictionaryObject(resources),
+                'fonts': DictionaryObject(fonts),
+            })
+
+        acro_form = reader.trailer['/Root'].get('/AcroForm')
+        if acro_form:
+            default_da = acro_form.get('/DA', '')
+            for ref in acro_form.get('/Fields', []):
+                self._collect_fields(ref, '', None, default_da)
+
+    @staticmethod
+    def _decrypted_copy(reader):
+        """The whole document rewritten without encryption.
+
+        Every object is written back under its own number (PyPDF2's writer
+        drops the AcroForm when cloning a document), with object and
+        cross-reference streams replaced by a classic xref table.
+        """
+        if not reader.decrypt(''):
+            raise PasswordRequiredError('パスワードで保護されたPDFテンプレートには記入できません。')
+        logging.warning("PDF template is encrypted; filling an unencrypted rewrite of it")
+
+        keys = {(number, generation) for generation, entries in reader.xref.items()
+                for number in entries}
+        keys.update((number, 0) for number in reader.xref_objStm)
+        encrypt = reader.trailer.raw_get('/Encrypt')
+        if isinstance(encrypt, IndirectObject):
+            keys.discard((encrypt.idnum, encrypt.generation))
+
+        out = BytesIO()
+        out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for number, generation in sorted(keys):
+            if number == 0:
+                continue
+            obj = reader.get_object(IndirectObject(number, generation, reader))
+            if obj is None or (isinstance(obj, DictionaryObject) and
+                               obj.get('/Type') in ('/XRef', '/ObjStm')):
+                continue
+            offsets.append((number, generation, out.tell()))
+            out.write(f"{number} {generation} obj\n".encode('ascii'))
+            obj.write_to_stream(out, None)
+            out.write(b"\nendobj\n")
+
+        xref_offset = out.tell()
+        out.write(b"xref\n0 1\n0000000000 65535 f \n")
+        for run in _IncrementalUpdate._runs(offsets):
+            out.write(f"{run[0][0]} {len(run)}\n".encode('ascii'))
+            for _, generation, offset in run:
+                out.write(f"{offset:010d} {generation:05d} n \n".encode('ascii'))
+        trailer = DictionaryObject({
+            NameObject(key): reader.trailer.raw_get(key)
+            for key in ('/Root', '/Info', '/ID') if key in reader.trailer
+        })
+        trailer[NameObject('/Size')] = NumberObject(max(number for number, _ in keys) + 1)
+        out.write(b"trailer\n")
+        trailer.write_to_stream(out, None)
+        out.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+        return out.getvalue()
+
+    @staticmethod
+    def _find_startxref(data):
+        pos = data.rfind(b'startxref')
+        if pos < 0:
+            raise ValueError('PDF has no startxref')
+        return int(data[pos + len(b'startxref'):].split()[0])
+
+    def _collect_fields(self, ref, parent_name, parent_type, parent_da):
+        if not isinstance(ref, IndirectObject):
+            return
+        field = ref.get_object()
+        name = field.get('/T')
+        full_name = f"{parent_name}.{name}" if parent_name and name else (name or parent_name)
+        field_type = field.get('/FT', parent_type)
+        da = field.get('/DA', parent_da)
+
+        kids = field.get('/Kids', [])
+        child_fields = [kid for kid in kids if '/T' in kid.get_object()]
+        if child_fields:
+            for kid in child_fields:
+                self._collect_fields(kid, full_name, field_type, da)
+            return
+        if field_type != '/Tx' or not full_name:
+            return
+
+        # A terminal field is either merged with its one widget or has
+        # widget annotations as kids
+        widgets = [(kid, DictionaryObject(kid.get_object())) for kid in kids
+                   if isinstance(kid, IndirectObject)] or [(ref, None)]
+        self.fields[full_name] = {
+            'ref': ref,
+            'field': DictionaryObject(field),
+            'widgets': widgets,
+            'da': da,
+            'multiline': bool(int(field.get('/Ff', 0)) & _MULTILINE_FLAG),
+            'quadding': int(field.get('/Q', 0)),
+        }
+
+    def fill(self, field_values, overlays):
+        """Return the template with fields filled and overlays drawn.
+
+        field_values maps field names to text; overlays is a list of
+        {"page", "x", "y", "size", "text"} with final text.
+        """
+        update = _IncrementalUpdate(self)
+        font_ref = None
+
+        def ensure_font():
+            nonlocal font_ref
+            if font_ref is None:
+                font, cid_font, descriptor = _font_objects()
+                cid_font[NameObject('/FontDescriptor')] = update.add(descriptor)
+                font[NameObject('/DescendantFonts')] = ArrayObject([update.add(cid_font)])
+                font_ref = update.add(font)
+            return font_ref
+
+        for name, value in field_values.items():
+            entry = self.fields.get(name)
+            if entry is None:
+                continue
+            field = update.copy(entry['ref'], entry['field'])
+            field[NameObject('/V')] = TextStringObject(value)
+            for widget_ref, widget in entry['widgets']:
+                widget = field if widget is None else update.copy(widget_ref, widget)
+                appearance = self._field_appearance(entry, widget, value, ensure_font())
+                widget[NameObject('/AP')] = DictionaryObject({
+                    NameObject('/N'): update.add(appearance)
+                })
+
+        by_page = {}
+        for overlay in overlays:
+            by_page.setdefault(int(overlay['page']) - 1, []).append(overlay)
+        for page_idx, page_overlays in sorted(by_page.items()):
+            if not 0 <= page_idx < len(self.pages):
+                continue
+            self._draw_overlays(update, self.pages[page_idx], page_overlays, ensure_font())
+
+        return update.write()
+
+    @staticmethod
+    def _field_appearance(entry, widget, value, font_ref):
+        """Normal appearance stream showing the value inside the widget"""
+        rect = [float(v) for v in widget.get('/Rect', [0, 0, 0, 0])]
+        width, height = abs(rect[2] - rect[0]), abs(rect[3] - rect[1])
+        match = _DA_FONT_SIZE.search(str(widget.get('/DA', entry['da']) or ''))
+        size = float(match.group(1)) if match else 0.0
+        lines = value.splitlines() if entry['multiline'] else [value.replace('\n', ' ')]
+        lines = lines or ['']
+        if size <= 0:
+            # Auto size: fit the lines to the box height, capped at 12pt
+            size = max(4.0, min(12.0, (height - 4) / (len(lines) * 1.2)))
+
+        ops = ['/Tx BMC', 'q', 'BT', f"{FONT_RESOURCE} {size:.2f} Tf", '0 g']
+        leading = size * 1.2
+        if entry['multiline']:
+            y = height - 2 - size
+        else:
+            y = (height - size) / 2 + size * 0.2
+        for line in lines:
+            x = 2.0
+            if entry['quadding'] in (1, 2):
+                spare = width - 4 - _text_width(line, size)
+                x += spare / 2 if entry['quadding'] == 1 else spare
+            ops.append(f"1 0 0 1 {x:.2f} {y:.2f} Tm {_encode_text(line)} Tj")
+            y -= leading
+        ops += ['ET', 'Q', 'EMC']
+
+        return _stream('\n'.join(ops), {
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([FloatObject(0), FloatObject(0),
+                                              FloatObject(width), FloatObject(height)]),
+            NameObject('/Resources'): DictionaryObject({
+                NameObject('/Font'): DictionaryObject({NameObject(FONT_RESOURCE): font_ref})
+            }),
+        })
+
+    @staticmethod
+    def _draw_overlays(update, page_entry, overlays, font_ref):
+        """Wrap the page's content in q/Q and append the overlay text"""
+        ops = ['Q', 'q', 'BT', '0 g']
+        for overlay in overlays:
+            size = float(overlay.get('size') or DEFAULT_FONT_SIZE)
+            for line_idx, line in enumerate(str(overlay['text']).splitlines() or ['']):
+                y = float(overlay['y']) - line_idx * size * 1.2
+                ops.append(f"{FONT_RESOURCE} {size:.2f} Tf 1 0 0 1 "
+                           f"{float(overlay['x']):.2f} {y:.2f} Tm {_encode_text(line)} Tj")
+        ops += ['ET', 'Q']
+
+        page = update.copy(page_entry['ref'], page_entry['page'])
+        fonts = DictionaryObject(page_entry['fonts'])
+        fonts[NameObject(FONT_RESOURCE)] = font_ref
+        resources = DictionaryObject(page_entry['resources'])
+        resources[NameObject('/Font')] = fonts
+        page[NameObject('/Resources')] = resources
+
+        contents = page_entry['page'].raw_get('/Contents') \
+            if '/Contents' in page_entry['page'] else None
+        if isinstance(contents, ArrayObject):
+            contents = list(contents)
+        elif contents is not None:
+            contents = [contents]
+        else:
+            contents = []
+        # Isolate the original graphics state so the overlay starts clean
+        page[NameObject('/Contents')] = ArrayObject(
+            [update.add(_stream('q\n'))] + contents + [update.add(_stream('\n'.join(ops)))])
+
+
+class _IncrementalUpdate:
+    """Objects appended to a parsed template as one incremental update"""
+
+    def __init__(self, template):
+        self.template = template
+        self.objects = {}
+        self.next_number = template.size
+
+    def copy(self, ref, obj):
+        """Shallow copy of an existing object that replaces it in the update"""
+        key = (ref.idnum, ref.generation)
+        if key not in self.objects:
+            self.objects[key] = DictionaryObject(obj)
+        return self.objects[key]
+
+    def add(self, obj):
+        """Add a new object and return a reference to it"""
+        key = (self.next_number, 0)
+        self.next_number += 1
+        self.objects[key] = obj
+        return IndirectObject(key[0], key[1], None)
+
+    def write(self):
+        if not self.objects:
+            return self.template.data
+
+        out = BytesIO()
+        out.write(self.template.data)
+        if not self.template.data.endswith(b'\n'):
+            out.write(b'\n')
+
+        offsets = []
+        for (number, generation), obj in sorted(self.objects.items()):
+            offsets.append((number, generation, out.tell()))
+            out.write(f"{number} {generation} obj\n".encode('ascii'))
+            obj.write_to_stream(out, None)
+            out.write(b"\nendobj\n")
+
+        if self.template.xref_stream:
+            xref_offset = self._write_xref_stream(out, offsets)
+        else:
+            xref_offset = self._write_xref_table(out, offsets)
+        out.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode('ascii'))
+        return out.getvalue()
+
+    @staticmethod
+    def _runs(offsets):
+        """Split (number, generation, offset) entries into runs of consecutive numbers"""
+        runs = []
+        for entry in offsets:
+            if runs and runs[-1][-1][0] + 1 == entry[0]:
+                runs[-1].append(entry)
+            else:
+                runs.append([entry])
+        return runs
+
+    def _trailer(self, size):
+        trailer = DictionaryObject(self.template.trailer)
+        trailer[NameObject('/Size')] = NumberObject(size)
+        trailer[NameObject('/Prev')] = NumberObject(self.template.startxref)
+        return trailer
+
+    def _write_xref_table(self, out, offsets):
+        xref_offset = out.tell()
+        out.write(b"xref\n")
+        for run in self._runs(offsets):
+            out.write(f"{run[0][0]} {len(run)}\n".encode('ascii'))
+            for _, generation, offset in run:
+                out.write(f"{offset:010d} {generation:05d} n \n".encode('ascii'))
+        out.write(b"trailer\n")
+        self._trailer(max(self.template.size, self.next_number)).write_to_stream(out, None)
+        return xref_offset
+
+    def _write_xref_stream(self, out, offsets):
+        """Write the update's cross-reference stream, which lists itself too"""
+        number = self.next_number
+        xref_offset = out.tell()
+        offsets = offsets + [(number, 0, xref_offset)]
+        width = max(4, (xref_offset.bit_length() + 7) // 8)
+        rows = b''.join(b'\x01' + offset.to_bytes(width, 'big') + generation.to_bytes(2, 'big')
+                        for _, generation, offset in offsets)
+        index = []
+        for run in self._runs(offsets):
+            index += [NumberObject(run[0][0]), NumberObject(len(run))]
+
+        stream = _stream(rows, self._trailer(max(self.template.size, number + 1)))
+        stream[NameObject('/Type')] = NameObject('/XRef')
+        stream[NameObject('/W')] = ArrayObject(
+            [NumberObject(1), NumberObject(width), NumberObject(2)])
+        stream[NameObject('/Index')] = ArrayObject(index)
+        out.write(f"{number} 0 obj\n".encode('ascii'))
+        stream.write_to_stream(out, None)
+        out.write(b"\nendobj")
+        return xref_offset
+
+
+def fill_pdf_template(parsed, settings, replace_dict):
+    """Fill a parsed PDF template for one contract and return the PDF bytes"""
+    substitute = _substitute(replace_dict)
+
+    field_values = {}
+    configured = settings.get('fields', {})
+    for name in parsed.fields:
+        if name in configured:
+            text = configured[name]
+        elif '{{' + name + '}}' in replace_dict:
+            text = '{{' + name + '}}'
+        else:
+            continue
+        field_values[name] = PLACEHOLDER_PATTERN.sub(substitute, text)
+
+    overlays = [
+        dict(overlay, text=PLACEHOLDER_PATTERN.sub(substitute, overlay['text']))
+        for overlay in settings.get('overlays', [])
+    ]
+    return parsed.fill(field_values, overlays)
@@ -0,0 +1,174 @@
+import re
+from bisect import bisect_right
+from io import BytesIO
+
+# Placeholders in Excel/Word templates, e.g. {{contract.tenant_name}}
+PLACEHOLDER_PATTERN = re.compile(r'\{\{[\w.]+\}\}')
+
+
+def _substitute(replace_dict):
+    def substitute(match):
+        return replace_dict.get(match.group(0), match.group(0))
+    return substitute
+
+
+# ---------- Excel ----------
+
+
+def index_excel_placeholders(file_binary):
+    """Map sheet name -> {cell coordinate: [placeholders]} for an Excel file"""
+    import openpyxl
+
+    index = {}
+    workbook = openpyxl.load_workbook(BytesIO(file_binary), read_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            cells = {}
+            for row in sheet.iter_rows():
+                for cell in row:
+                    if isinstance(cell.value, str) and '{{' in cell.value:
+                        placeholders = sorted(set(PLACEHOLDER_PATTERN.findall(cell.value)))
+                        if placeholders:
+                            cells[cell.coordinate] = placeholders
+            if cells:
+                index[sheet.title] = cells
+    finally:
+        workbook.close()
+    return index
+
+
+def fill_excel_placeholders(workbook, index, replace_dict):
+    """Replace placeholders in the indexed cells, one regex pass per cell"""
+    substitute = _substitute(replace_dict)
+    for sheet_name, cells in index.items():
+        if sheet_name not in workbook.sheetnames:
+            continue
+        sheet = workbook[sheet_name]
+        for coordinate in cells:
+            cell = sheet[coordinate]
+            if isinstance(cell.value, str):
+                cell.value = PLACEHOLDER_PATTERN.sub(substitute, cell.value)
+
+
+# ---------- Word ----------
+#
+# Word splits text into runs wherever formatting (or an editor's revision
+# history) changes, so "{{contract.tenant_name}}" may span several runs. The
+# index records each paragraph that contains a placeholder by location:
+#   ['p', paragraph]                         body paragraph
+#   ['t', table, row, cell, paragraph]       paragraph inside a top-level table
+
+
+def _iter_word_paragraphs(doc):
+    """Yield (location, paragraph) for body and table-cell paragraphs"""
+    for para_idx, para in enumerate(doc.paragraphs):
+        yield ['p', para_idx], para
+
+    seen = set()
+    for table_idx, table in enumerate(doc.tables):
+        for row_idx, row in enumerate(table.rows):
+            for cell_idx, cell in enumerate(row.cells):
+                # Merged cells show up once per grid column; visit them once.
+                # Holding the elements in the set keeps their proxies stable.
+                if cell._tc in seen:
+                    continue
+                seen.add(cell._tc)
+                for para_idx, para in enumerate(cell.paragraphs):
+                    yield ['t', table_idx, row_idx, cell_idx, para_idx], para
+
+
+def _run_starts(texts):
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text)
+    return starts
+
+
+def index_word_placeholders(file_binary):
+    """List the paragraphs (and runs) of a Word file that hold placeholders"""
+    import docx
+
+    doc = docx.Document(BytesIO(file_binary))
+    index = []
+    for location, para in _iter_word_paragraphs(doc):
+        texts = [run.text for run in para.runs]
+        joined = ''.join(texts)
+        if '{{' not in joined:
+            continue
+        matches = list(PLACEHOLDER_PATTERN.finditer(joined))
+        if not matches:
+            continue
+
+        starts = _run_starts(texts)
+        runs = set()
+        for match in matches:
+            first = bisect_right(starts, match.start()) - 1
+            last = bisect_right(starts, match.end() - 1) - 1
+            runs.update(range(first, last + 1))
+        index.append({
+            'location': location,
+            'placeholders': sorted({match.group(0) for match in matches}),
+            'runs': sorted(runs)
+        })
+    return index
+
+
+def _resolve_word_paragraph(doc, location, cache):
+    if location[0] == 'p':
+        if 'paragraphs' not in cache:
+            cache['paragraphs'] = doc.paragraphs
+        return cache['paragraphs'][location[1]]
+
+    _, table_idx, row_idx, cell_idx, para_idx = location
+    key = (table_idx, row_idx)
+    if key not in cache:
+        if 'tables' not in cache:
+            cache['tables'] = doc.tables
+        cache[key] = cache['tables'][table_idx].rows[row_idx].cells
+    return cache[key][cell_idx].paragraphs[para_idx]
+
+
+def fill_paragraph_placeholders(para, replace_dict):
+    """Replace placeholders in one paragraph, keeping each run's formatting.
+
+    The joined run text is scanned once. A replacement goes into the run where
+    its placeholder starts; the rest of a placeholder split across runs is cut
+    from the following runs. Only runs whose text changes are rewritten.
+    """
+    runs = para.runs
+    texts = [run.text for run in runs]
+    matches = list(PLACEHOLDER_PATTERN.finditer(''.join(texts)))
+    if not matches:
+        return
+
+    starts = _run_starts(texts)
+    changed = set()
+    # Work backwards so earlier offsets stay valid while texts are edited
+    for match in reversed(matches):
+        value = replace_dict.get(match.group(0))
+        if value is None:
+            continue
+        first = bisect_right(starts, match.start()) - 1
+        last = bisect_right(starts, match.end() - 1) - 1
+        for run_idx in range(first, last + 1):
+            text = texts[run_idx]
+            low = max(match.start() - starts[run_idx], 0)
+            high = min(match.end() - starts[run_idx], len(text))
+            if run_idx == first:
+                texts[run_idx] = text[:low] + value + text[high:]
+            else:
+                texts[run_idx] = text[:low] + text[high:]
+            changed.add(run_idx)
+
+    for run_idx in changed:
+        runs[run_idx].text = texts[run_idx]
+
+
+def fill_word_placeholders(doc, index, replace_dict):
+    """Replace placeholders in the indexed paragraphs of a Word document"""
+    cache = {}
+    for entry in index:
+        para = _resolve_word_paragraph(doc, entry['location'], cache)
+        fill_paragraph_placeholders(para, replace_dict)
@@ -0,0 +1,202 @@
+# Long-lived WeasyPrint renderer processes. Each renderer loads WeasyPrint,
+# discovers fonts (including the Japanese ones), parses the shared stylesheet
+# and renders a warm-up document once, then serves render requests over its
+# stdin/stdout pipes. It exits after RENDERER_MAX_JOBS documents to bound
+# memory growth and is replaced transparently.
+#
+# This file is also the renderer's entry point, so it must not import the app.
+import os
+import sys
+import struct
+import logging
+import threading
+import subprocess
+
+# Documents a renderer process handles before it is recycled
+RENDERER_MAX_JOBS = int(os.environ.get('RENDERER_MAX_JOBS', 200))
+
+# Render inside a persistent renderer process ('process') or in the calling
+# process ('inline'), e.g. where spawning helpers is not allowed
+PDF_RENDERER = os.environ.get('PDF_RENDERER', 'process')
+
+# Stylesheet applied to every document; gives Japanese text a proper font
+# when the template does not choose one
+BASE_CSS = """
+body {
+    font-family: 'Noto Sans CJK JP', 'Noto Sans JP', 'IPAexGothic', 'IPAGothic',
+                 'Hiragino Sans', 'Yu Gothic', sans-serif;
+}
+"""
+
+WARM_UP_HTML = """<html><body>
+<h1>賃貸借契約書</h1>
+<p>借主・貸主 0123456789 ABCDEFG 〒100-0001 東京都千代田区</p>
+<table border='1'><tr><td>敷金</td><td>100,000円</td></tr></table>
+</body></html>"""
+
+_FRAME_HEADER = struct.Struct('>I')
+
+
+class RenderError(Exception):
+    """Raised when a renderer process fails to produce a PDF"""
+
+
+def _write_frame(stream, payload):
+    stream.write(_FRAME_HEADER.pack(len(payload)))
+    stream.write(payload)
+    stream.flush()
+
+
+def _read_frame(stream):
+    header = stream.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None
+    (length, ) = _FRAME_HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+
+def _load_weasyprint():
+    """Import WeasyPrint and build the font configuration and stylesheet"""
+    import weasyprint
+    from weasyprint.text.fonts import FontConfiguration
+
+    font_config = FontConfiguration()
+    stylesheet = weasyprint.CSS(string=BASE_CSS, font_config=font_config)
+
+    def render(html_content):
+        return weasyprint.HTML(string=html_content).write_pdf(
+            stylesheets=[stylesheet], font_config=font_config)
+
+    return render
+
+
+def serve(stdin, stdout, max_jobs):
+    """Renderer process loop: warm up, then answer up to max_jobs requests"""
+    render = _load_weasyprint()
+    render(WARM_UP_HTML)
+    _write_frame(stdout, b'ready')
+
+    for _ in range(max_jobs):
+        request = _read_frame(stdin)
+        if request is None:
+            return
+        try:
+            pdf = render(request.decode('utf-8'))
+        except Exception as e:
+            _write_frame(stdout, b'error')
+            _write_frame(stdout, str(e).encode('utf-8'))
+        else:
+            _write_frame(stdout, b'ok')
+            _write_frame(stdout, pdf)
+
+
+class Renderer:
+    """Client side of one renderer process, owned by the calling process"""
+
+    def __init__(self, max_jobs=RENDERER_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._process = None
+        self._ready = False
+        self._jobs = 0
+
+    def start(self):
+        """Launch a renderer process; it warms up while we do other work"""
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(self.max_jobs)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        self._ready = False
+        self._jobs = 0
+        logging.info(f"Started renderer process (pid {self._process.pid})")
+
+    def stop(self):
+        if self._process and self._process.poll() is None:
+            self._process.stdin.close()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        self._process = None
+
+    def _ensure_running(self):
+        if (self._process is None or self._process.poll() is not None
+                or self._jobs >= self.max_jobs):
+            self.stop()
+            self.start()
+        if not self._ready:
+            if _read_frame(self._process.stdout) != b'ready':
+                self.stop()
+                raise RenderError('Renderer process failed to start')
+            self._ready = True
+
+    def render(self, html_content):
+        """Render HTML to PDF bytes in the renderer process"""
+        with self._lock:
+            self._ensure_running()
+            try:
+                _write_frame(self._process.stdin, html_content.encode('utf-8'))
+                status = _read_frame(self._process.stdout)
+                payload = _read_frame(self._process.stdout)
+            except OSError as e:
+                self.stop()
+                raise RenderError(f"Renderer process died: {e}")
+            if status is None or payload is None:
+                self.stop()
+                raise RenderError('Renderer process exited unexpectedly')
+
+            self._jobs += 1
+            if self._jobs >= self.max_jobs:
+                # The process exits on its own now; warm up the replacement
+                self.stop()
+                self.start()
+
+            if status != b'ok':
+                raise RenderError(payload.decode('utf-8', errors='replace'))
+            return payload
+
+
+_renderer = None
+_inline_render = None
+
+
+def _forget_renderer():
+    # A forked child must not talk to its parent's renderer pipes
+    global _renderer
+    _renderer = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_renderer)
+
+
+def warm_up():
+    """Start this process's renderer ahead of the first render"""
+    global _renderer, _inline_render
+    if PDF_RENDERER == 'inline':
+        if _inline_render is None:
+            _inline_render = _load_weasyprint()
+            _inline_render(WARM_UP_HTML)
+        return
+    if _renderer is None:
+        _renderer = Renderer()
+        _renderer.start()
+
+
+def render_html(html_content):
+    """Render HTML to PDF bytes using a warm renderer"""
+    warm_up()
+    if PDF_RENDERER == 'inline':
+        return _inline_render(html_content)
+    return _renderer.render(html_content)
+
+
+if __name__ == '__main__':
+    # Keep stray prints from corrupting the response pipe
+    response_stream = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    serve(sys.stdin.buffer, response_stream,
+          int(sys.argv[1]) if len(sys.argv) > 1 else RENDERER_MAX_JOBS)
@@ -0,0 +1,135 @@
+# Contract renewals.
+#
+# find_expiring_contracts lists the contracts ending within N days that have
+# not been renewed yet, walking ix_contracts_end_date. renew_contracts turns
+# a batch of them into new contracts starting the day after the old ones
+# end: the contract numbers come from a single counter update, the new rows
+# and their special terms go out in one flush (multi-row INSERTs on
+# PostgreSQL), their snapshots and dependencies are written together, and the
+# documents are queued for the render workers with enqueue_renders.
+import logging
+from datetime import date, timedelta
+
+from sqlalchemy.orm import aliased, joinedload, load_only, selectinload
+
+from app import db
+from models import Contract, Room, Building, RealEstateAgent
+from utils import filter_contracts, allocate_contract_numbers, freeze_contracts
+from jobs import enqueue_renders
+
+# Default and largest look-ahead of the expiring contract finder, in days
+EXPIRING_DAYS = 60
+MAX_EXPIRING_DAYS = 365
+
+# Usual term of a renewed residential lease (普通借家契約)
+DEFAULT_TERM_MONTHS = 24
+
+
+def add_months(day, months):
+    """The same day `months` later, clamped to the end of shorter months"""
+    month = day.month - 1 + months
+    year, month = day.year + month // 12, month % 12 + 1
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return date(year, month, min(day.day, (next_month - timedelta(days=1)).day))
+
+
+def renewal_dates(contract, term_months=None):
+    """Start and end of a contract's renewal.
+
+    The renewal starts the day after the contract ends and runs for
+    `term_months`, or as long as the contract itself if not given.
+    """
+    start = contract.end_date + timedelta(days=1)
+    if term_months:
+        return start, add_months(start, term_months) - timedelta(days=1)
+    return start, start + (contract.end_date - contract.start_date)
+
+
+def _not_renewed():
+    renewal = aliased(Contract)
+    return ~db.exists().where(renewal.renewed_from_id == Contract.id)
+
+
+def find_expiring_contracts(days=EXPIRING_DAYS, building_id=None, agent_id=None, today=None):
+    """Contracts ending within `days` days that have no renewal yet, soonest first"""
+    today = today or date.today()
+    query = Contract.query.options(
+        load_only(Contract.id, Contract.contract_number, Contract.tenant_name,
+                  Contract.start_date, Contract.end_date, Contract.rent_amount,
+                  Contract.room_id, Contract.agent_id),
+        joinedload(Contract.room).load_only(Room.room_number, Room.building_id).joinedload(
+            Room.building).load_only(Building.name),
+        joinedload(Contract.agent).load_only(RealEstateAgent.name)).filter(
+            Contract.end_date.between(today, today + timedelta(days=days)), _not_renewed())
+    query = filter_contracts(query, building_id=building_id, agent_id=agent_id)
+    return query.order_by(Contract.end_date, Contract.id).all()
+
+
+def group_expiring(contracts):
+    """Group expiring contracts by building and by agent.
+
+    Returns (by_building, by_agent): lists of {'id', 'name', 'contracts'},
+    largest group first.
+    """
+    by_building = {}
+    by_agent = {}
+    for contract in contracts:
+        building = contract.room.building
+        by_building.setdefault(building.id, {'id': building.id, 'name': building.name,
+                                             'contracts': []})['contracts'].append(contract)
+        by_agent.setdefault(contract.agent_id, {'id': contract.agent_id, 'name': contract.agent.name,
+                                                'contracts': []})['contracts'].append(contract)
+
+    def largest_first(group):
+        return -len(group['contracts']), group['name']
+
+    return (sorted(by_building.values(), key=largest_first),
+            sorted(by_agent.values(), key=largest_first))
+
+
+def renew_contracts(contract_ids, created_by_id, term_months=None):
+    """Create renewals of the given contracts and queue their documents.
+
+    Contracts without an end date or already renewed are skipped. Returns the
+    ids of the new contracts.
+    """
+    originals = Contract.query.options(
+        joinedload(Contract.room).joinedload(Room.building).joinedload(Building.owner),
+        joinedload(Contract.agent),
+        selectinload(Contract.special_terms)).filter(
+            Contract.id.in_(contract_ids), Contract.end_date.isnot(None),
+            _not_renewed()).order_by(Contract.id).all()
+    if not originals:
+        return []
+
+    renewals = []
+    for original, number in zip(originals, allocate_contract_numbers(len(originals))):
+        start_date, end_date = renewal_dates(original, term_months)
+        renewals.append(Contract(
+            contract_number=number,
+            tenant_name=original.tenant_name,
+            tenant_address=original.tenant_address,
+            tenant_phone=original.tenant_phone,
+            tenant_email=original.tenant_email,
+            start_date=start_date,
+            end_date=end_date,
+            rent_amount=original.rent_amount,
+            security_deposit=original.security_deposit,
+            key_money=None,  # Paid once, at the original signing
+            management_fee=original.management_fee,
+            custom_special_terms=original.custom_special_terms,
+            room=original.room,
+            agent=original.agent,
+            template_id=original.template_id,
+            created_by_id=created_by_id,
+            renewed_from_id=original.id,
+            special_terms=list(original.special_terms)))
+    db.session.add_all(renewals)
+    db.session.flush()
+    freeze_contracts(renewals)
+    renewal_ids = [renewal.id for renewal in renewals]
+    db.session.commit()
+    logging.info(f"Renewed {len(renewal_ids)} contracts")
+
+    enqueue_renders(renewal_ids)
+    return renewal_ids
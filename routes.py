@@ -1,18 +1,35 @@
 import os
 import json
 import logging
-from datetime import datetime
-from flask import render_template, redirect, url_for, flash, request, jsonify, send_file
+from datetime import date, datetime
+from flask import render_template, redirect, url_for, flash, request, jsonify, send_file, abort
+from flask import Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, load_only
 
 from app import app, db
 from models import User, RealEstateAgent, Owner, Building, Room, Contract
 from models import ContractTemplate, SpecialTerm, contract_special_terms
 from forms import LoginForm, UserForm, RealEstateAgentForm, OwnerForm, BuildingForm
 from forms import RoomForm, ContractForm, SpecialTermForm, ContractTemplateForm
-from utils import generate_pdf, require_admin
+from forms import BulkRegenerateForm, ContractFilterForm, ExpiringContractsForm, RenewContractsForm
+from forms import ImportForm
+from utils import require_admin, invalidate_template_cache, index_template_placeholders
+from utils import is_stored_artifact, release_artifacts, get_template_file_size, iter_template_file
+from utils import get_contract_page, allocate_contract_numbers
+from utils import freeze_contract, refreeze_contracts, load_contract_snapshot, mark_pdfs_stale
+from jobs import enqueue_render, enqueue_renders, get_latest_job, get_queue_stats
+from jobs import select_contract_ids
+from stats import get_dashboard_stats
+from occupancy import CALENDAR_MONTHS, calendar_days, load_occupancy_index, get_occupancy_index
+from renewals import find_expiring_contracts, group_expiring, renew_contracts
+from analytics import GROUP_BY, MAX_MONTHS, rent_roll_report, rent_roll_csv
+from importer import IMPORT_KINDS, import_columns, import_file
+from exporter import EXPORT_KINDS, EXPORT_FORMATS, iter_csv, iter_xlsx, export_filename
+from archives import archive_contracts, iter_pdf_archive
 
 
 # Route for the home page
@@ -55,21 +72,23 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get counts for dashboard statistics
-    contracts_count = Contract.query.count()
-    buildings_count = Building.query.count()
-    rooms_count = Room.query.count()
-    owners_count = Owner.query.count()
+    # Materialized statistics: one read however large the portfolio is
+    stats = get_dashboard_stats()
 
-    # Get recent contracts
-    recent_contracts = Contract.query.order_by(
-        Contract.created_at.desc()).limit(5).all()
+    # Get recent contracts (walks the created_at index, with the rooms joined in)
+    recent_contracts = Contract.query.options(
+        load_only(Contract.id, Contract.contract_number, Contract.tenant_name,
+                  Contract.created_at),
+        joinedload(Contract.room).load_only(Room.room_number).joinedload(
+            Room.building).load_only(Building.name)).order_by(
+                Contract.created_at.desc(), Contract.id.desc()).limit(5).all()
 
     return render_template('dashboard.html',
-                           contracts_count=contracts_count,
-                           buildings_count=buildings_count,
-                           rooms_count=rooms_count,
-                           owners_count=owners_count,
+                           contracts_count=stats['contracts'],
+                           buildings_count=stats['buildings'],
+                           rooms_count=stats['rooms'],
+                           owners_count=stats['owners'],
+                           stats=stats,
                            recent_contracts=recent_contracts)
 
 
@@ -175,6 +194,63 @@ def delete_user(user_id):
     return redirect(url_for('user_management'))
 
 
+@app.route('/admin/regenerate-pdfs', methods=['GET', 'POST'])
+@login_required
+@require_admin
+def bulk_regenerate_pdfs():
+    form = BulkRegenerateForm()
+    if form.validate_on_submit():
+        contract_ids = select_contract_ids(template_id=form.template_id.data,
+                                           building_id=form.building_id.data,
+                                           owner_id=form.owner_id.data,
+                                           start_from=form.start_from.data,
+                                           start_to=form.start_to.data)
+        if not contract_ids:
+            flash('条件に一致する契約書がありません。', 'warning')
+        else:
+            if form.refreeze.data:
+                refreeze_contracts(contract_ids)
+                db.session.commit()
+            # The render workers grow to the `regenerate-pdfs` pool size
+            # (BULK_RENDER_WORKERS) while a backlog this size is queued
+            queued = enqueue_renders(contract_ids)
+            flash(f'{len(contract_ids)}件中{queued}件の契約書のPDF再生成を開始しました。', 'success')
+        return redirect(url_for('bulk_regenerate_pdfs'))
+
+    return render_template('admin/bulk_regenerate.html',
+                           form=form,
+                           stats=get_queue_stats())
+
+
+@app.route('/admin/import', methods=['GET', 'POST'])
+@login_required
+@require_admin
+def bulk_import():
+    form = ImportForm()
+    report = None
+    if form.validate_on_submit():
+        upload = form.import_file.data
+        try:
+            report = import_file(form.kind.data, upload.stream, upload.filename,
+                                 encoding=form.encoding.data, dry_run=form.dry_run.data)
+        except ValueError as e:
+            flash(str(e), 'danger')
+        else:
+            label = IMPORT_KINDS[report['kind']][0]
+            if report['dry_run']:
+                flash(f"{report['total']}件中{report['imported']}件の{label}データに問題はありません。",
+                      'info')
+            else:
+                flash(f"{report['total']}件中{report['imported']}件の{label}データを登録しました。",
+                      'success')
+
+    return render_template('admin/import.html',
+                           form=form,
+                           report=report,
+                           kinds={kind: (spec[0], import_columns(kind))
+                                  for kind, spec in IMPORT_KINDS.items()})
+
+
 # ========== Real Estate Agent Routes ==========
 
 
@@ -216,6 +292,7 @@ def edit_agent(agent_id):
         agent.registration_date = form.registration_date.data
         agent.notes = form.notes.data
 
+        mark_pdfs_stale(agent)
         db.session.commit()
         flash('宅建士情報が更新されました。', 'success')
         return redirect(url_for('agent_list'))
@@ -283,6 +360,7 @@ def edit_owner(owner_id):
         owner.email = form.email.data
         owner.notes = form.notes.data
 
+        mark_pdfs_stale(owner)
         db.session.commit()
         flash('オーナー情報が更新されました。', 'success')
         return redirect(url_for('owner_list'))
@@ -408,6 +486,7 @@ def edit_building(building_id):
         building.notes = form.notes.data
         building.owner_id = form.owner_id.data
 
+        mark_pdfs_stale(building)
         db.session.commit()
         flash('建物情報が更新されました。', 'success')
         return redirect(url_for('building_list'))
@@ -420,9 +499,38 @@ def edit_building(building_id):
 def view_building(building_id):
     building = Building.query.get_or_404(building_id)
     rooms = Room.query.filter_by(building_id=building_id).all()
+
+    # Contract status of each room now and over the coming months
+    occupancy = load_occupancy_index(building_id)
+    today = date.today()
+    days = calendar_days(today)
+    room_status = {room.id: occupancy.room_status(room.id, today) for room in rooms}
+    room_calendar = {room.id: occupancy.room_calendar(room.id, days) for room in rooms}
     return render_template('buildings/view.html',
                            building=building,
-                           rooms=rooms)
+                           rooms=rooms,
+                           room_status=room_status,
+                           room_calendar=room_calendar,
+                           calendar=occupancy.calendar(today, building_id=building_id),
+                           calendar_days=days)
+
+
+@app.route('/buildings/<int:building_id>/contracts.zip')
+@login_required
+def download_building_contracts(building_id):
+    Building.query.get_or_404(building_id)
+    # All of the building's contracts, or only those selected in the contract list
+    contracts = archive_contracts(building_id, request.args.getlist('contract_ids', type=int))
+    if not contracts:
+        flash('ダウンロードできる契約書がありません。', 'warning')
+        return redirect(request.referrer or url_for('view_building', building_id=building_id))
+
+    # Missing PDFs are queued for the render workers and added as they finish
+    response = Response(stream_with_context(iter_pdf_archive(contracts)),
+                        mimetype='application/zip')
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename="building_{building_id}_contracts_{date.today():%Y%m%d}.zip"'
+    return response
 
 
 @app.route('/buildings/delete/<int:building_id>', methods=['POST'])
@@ -545,6 +653,7 @@ def edit_room(room_id):
         room.notes = form.notes.data
         room.building_id = form.building_id.data
 
+        mark_pdfs_stale(room)
         db.session.commit()
         flash('部屋情報が更新されました。', 'success')
         return redirect(url_for('view_building', building_id=room.building_id))
@@ -609,6 +718,7 @@ def edit_special_term(term_id):
         term.content = form.content.data
         term.is_common = form.is_common.data
 
+        mark_pdfs_stale(term)
         db.session.commit()
         flash('特約条項が更新されました。', 'success')
         return redirect(url_for('special_term_list'))
@@ -620,6 +730,7 @@ def edit_special_term(term_id):
 @login_required
 def delete_special_term(term_id):
     term = SpecialTerm.query.get_or_404(term_id)
+    mark_pdfs_stale(term, deleted=True)
 
     # Remove term from all contracts
     stmt = contract_special_terms.delete().where(
@@ -679,7 +790,8 @@ def add_template():
                 elif form.file_type.data == 'word':
                     file_content = 'Word Template'
                 elif form.file_type.data == 'pdf':
-                    file_content = 'PDF Template'
+                    # Keep the field/overlay settings (JSON) if given
+                    file_content = form.file_content.data or 'PDF Template'
 
         # If this is set as default, unset other default templates
         if form.is_default.data:
@@ -695,8 +807,10 @@ def add_template():
                                     file_binary=file_binary,
                                     file_name=file_name,
                                     is_default=form.is_default.data)
+        index_template_placeholders(template)
         db.session.add(template)
         db.session.commit()
+        invalidate_template_cache(template.id)
 
         flash('契約書テンプレートが追加されました。', 'success')
         return redirect(url_for('template_list'))
@@ -782,7 +896,9 @@ def edit_template(template_id):
         file_binary = None
         file_name = None
 
+        mark_pdfs_stale(template)
         db.session.commit()
+        invalidate_template_cache(template.id)
         flash('契約書テンプレートが更新されました。', 'success')
         return redirect(url_for('template_list'))
 
@@ -827,14 +943,11 @@ def download_template(template_id):
         flash('HTMLテンプレートはダウンロードできません。', 'warning')
         return redirect(url_for('template_list'))
 
-    if not template.file_binary or not template.file_name:
+    file_size = get_template_file_size(template.id)
+    if not file_size or not template.file_name:
         flash('テンプレートファイルが見つかりませんでした。', 'danger')
         return redirect(url_for('template_list'))
 
-    # Create temporary file and save binary content
-    from io import BytesIO
-    file_data = BytesIO(template.file_binary)
-
     # Determine MIME type
     mimetype = None
     if template.file_type == 'excel':
@@ -850,10 +963,12 @@ def download_template(template_id):
     elif template.file_type == 'pdf':
         mimetype = 'application/pdf'
 
-    return send_file(file_data,
-                     mimetype=mimetype,
-                     as_attachment=True,
-                     download_name=template.file_name)
+    # Stream the file from the database in chunks instead of loading it whole
+    response = Response(stream_with_context(iter_template_file(template.id, file_size)),
+                        mimetype=mimetype or 'application/octet-stream')
+    response.headers['Content-Length'] = str(file_size)
+    response.headers['Content-Disposition'] = f'attachment; filename="{template.file_name}"'
+    return response
 
 
 @app.route('/templates/delete/<int:template_id>', methods=['POST'])
@@ -868,6 +983,7 @@ def delete_template(template_id):
 
     db.session.delete(template)
     db.session.commit()
+    invalidate_template_cache(template_id)
 
     flash('契約書テンプレートが削除されました。', 'success')
     return redirect(url_for('template_list'))
@@ -879,8 +995,67 @@ def delete_template(template_id):
 @app.route('/contracts')
 @login_required
 def contract_list():
-    contracts = Contract.query.order_by(Contract.created_at.desc()).all()
-    return render_template('contracts/list.html', contracts=contracts)
+    form = ContractFilterForm(request.args)
+    form.validate()
+    contracts, next_cursor, prev_cursor = get_contract_page(
+        filters=form.filters(),
+        sort=form.sort.data,
+        order=form.order.data,
+        after=request.args.get('after'),
+        before=request.args.get('before'))
+
+    # Page links keep the current filters and sort order
+    query_args = {key: value for key, value in request.args.items()
+                  if key not in ('after', 'before') and value}
+    return render_template('contracts/list.html',
+                           form=form,
+                           contracts=contracts,
+                           next_cursor=next_cursor,
+                           prev_cursor=prev_cursor,
+                           query_args=query_args)
+
+
+@app.route('/contracts/expiring')
+@login_required
+def contract_expiring():
+    form = ExpiringContractsForm(request.args)
+    form.validate()
+    contracts = find_expiring_contracts(**form.filters()) if not form.errors else []
+    by_building, by_agent = group_expiring(contracts)
+    return render_template('contracts/expiring.html',
+                           form=form,
+                           renew_form=RenewContractsForm(),
+                           total=len(contracts),
+                           by_building=by_building,
+                           by_agent=by_agent)
+
+
+@app.route('/contracts/renew', methods=['POST'])
+@login_required
+def renew_contracts_batch():
+    form = RenewContractsForm()
+    if not form.validate_on_submit():
+        for errors in form.errors.values():
+            for error in errors:
+                flash(error, 'danger')
+        return redirect(request.referrer or url_for('contract_expiring'))
+
+    try:
+        renewal_ids = renew_contracts(form.contract_ids.data, current_user.id,
+                                      term_months=form.term_months.data)
+    except IntegrityError:
+        # Another user renewed one of the contracts at the same time
+        db.session.rollback()
+        flash('他のユーザーが同じ契約を更新中です。もう一度お試しください。', 'warning')
+        return redirect(request.referrer or url_for('contract_expiring'))
+
+    skipped = len(form.contract_ids.data) - len(renewal_ids)
+    if renewal_ids:
+        flash(f'{len(renewal_ids)}件の更新契約書を作成しました。PDFはバックグラウンドで生成されます。',
+              'success')
+    if skipped:
+        flash(f'{skipped}件の契約は更新済みか契約終了日がないため、スキップしました。', 'warning')
+    return redirect(request.referrer or url_for('contract_expiring'))
 
 
 @app.route('/contracts/create', methods=['GET', 'POST'])
@@ -904,10 +1079,7 @@ def create_contract():
     if form.validate_on_submit():
         logging.info("フォーム検証に成功しました。契約書を作成します。")
         # Generate a unique contract number
-        current_date = datetime.now().strftime('%Y%m%d')
-        count = Contract.query.filter(
-            Contract.contract_number.like(f"{current_date}%")).count() + 1
-        contract_number = f"{current_date}-{count:04d}"
+        contract_number = allocate_contract_numbers()[0]
         
         logging.info(f"生成された契約番号: {contract_number}")
 
@@ -940,21 +1112,16 @@ def create_contract():
                     if term:
                         contract.special_terms.append(term)
             
+            # Freeze the document data as it is right now
+            db.session.flush()
+            freeze_contract(contract)
             db.session.commit()
             logging.info(f"契約書データをDBに保存しました。契約ID: {contract.id}")
 
-            # Generate PDF and store its path
-            pdf_path = generate_pdf(contract.id)
-            if pdf_path:
-                contract.pdf_path = pdf_path
-                db.session.commit()
-                logging.info(f"PDFが生成されました: {pdf_path}")
-                flash('契約書が作成されました。', 'success')
-                return redirect(url_for('view_contract', contract_id=contract.id))
-            else:
-                logging.error("PDFの生成に失敗しました")
-                flash('PDFの生成中にエラーが発生しました。契約は保存されましたが、PDFを再生成してください。', 'warning')
-                return redirect(url_for('view_contract', contract_id=contract.id))
+            # Render the PDF in the background so the request returns right away
+            enqueue_render(contract.id)
+            flash('契約書が作成されました。PDFはバックグラウンドで生成されます。', 'success')
+            return redirect(url_for('view_contract', contract_id=contract.id))
                 
         except Exception as e:
             db.session.rollback()
@@ -973,7 +1140,13 @@ def create_contract():
 @login_required
 def view_contract(contract_id):
     contract = Contract.query.get_or_404(contract_id)
-    return render_template('contracts/view.html', contract=contract)
+    if not contract.snapshot:
+        # Contracts created before snapshots existed are frozen on first view
+        freeze_contract(contract)
+        db.session.commit()
+    return render_template('contracts/view.html',
+                           contract=contract,
+                           document=load_contract_snapshot(contract))
 
 
 @app.route('/contracts/pdf/<int:contract_id>')
@@ -982,14 +1155,16 @@ def download_contract_pdf(contract_id):
     contract = Contract.query.get_or_404(contract_id)
 
     if not contract.pdf_path or not os.path.exists(contract.pdf_path):
-        # Generate or regenerate PDF
-        pdf_path = generate_pdf(contract_id)
-        if not pdf_path:
-            flash('PDFの生成中にエラーが発生しました。', 'danger')
-            return redirect(url_for('view_contract', contract_id=contract_id))
+        # Queue a render and let the contract page poll until it is ready
+        enqueue_render(contract_id)
+        flash('PDFを生成しています。完了するとダウンロードできます。', 'info')
+        return redirect(url_for('view_contract', contract_id=contract_id))
 
-        contract.pdf_path = pdf_path
-        db.session.commit()
+    if contract.pdf_stale_at:
+        # The PDF predates an edit to data it shows; render it again first
+        enqueue_render(contract_id)
+        flash('PDFを最新の内容で再生成しています。完了するとダウンロードできます。', 'info')
+        return redirect(url_for('view_contract', contract_id=contract_id))
 
     # Set a filename for the download
     filename = f"lease_contract_{contract.contract_number}.pdf"
@@ -1042,21 +1217,30 @@ def download_contract_original(contract_id):
 def regenerate_contract_pdf(contract_id):
     contract = Contract.query.get_or_404(contract_id)
 
-    # Delete the old PDF file if it exists
-    if contract.pdf_path and os.path.exists(contract.pdf_path):
+    # Delete the old PDF file if it exists (stored artifacts may be shared)
+    if contract.pdf_path and not is_stored_artifact(contract.pdf_path) \
+            and os.path.exists(contract.pdf_path):
         try:
             os.remove(contract.pdf_path)
         except OSError as e:
             logging.error(f"Error deleting PDF file: {e}")
 
-    # Generate new PDF
-    pdf_path = generate_pdf(contract_id)
-    if pdf_path:
-        contract.pdf_path = pdf_path
-        db.session.commit()
-        flash('PDFが再生成されました。', 'success')
+    # The frozen document data is only replaced when explicitly asked for
+    refreeze = request.form.get('refreeze') == '1'
+    if refreeze:
+        refreeze_contracts([contract_id])
+
+    old_pdf_path = contract.pdf_path
+    contract.pdf_path = None
+    db.session.commit()
+    release_artifacts([old_pdf_path])
+
+    # Queue the new render; the contract page polls the job status
+    enqueue_render(contract_id)
+    if refreeze:
+        flash('最新の登録データで契約書を更新し、PDFの再生成を開始しました。', 'info')
     else:
-        flash('PDFの生成中にエラーが発生しました。', 'danger')
+        flash('PDFの再生成を開始しました。', 'info')
 
     return redirect(url_for('view_contract', contract_id=contract_id))
 
@@ -1066,28 +1250,61 @@ def regenerate_contract_pdf(contract_id):
 def delete_contract(contract_id):
     contract = Contract.query.get_or_404(contract_id)
 
-    # Delete PDF file if it exists
-    if contract.pdf_path and os.path.exists(contract.pdf_path):
+    # Delete PDF file if it exists (stored artifacts may be shared with other contracts)
+    if contract.pdf_path and not is_stored_artifact(contract.pdf_path) \
+            and os.path.exists(contract.pdf_path):
         try:
             os.remove(contract.pdf_path)
         except OSError as e:
             logging.error(f"Error deleting PDF file: {e}")
     
     # Delete original file if it exists
-    if contract.original_file_path and os.path.exists(contract.original_file_path):
+    if contract.original_file_path and not is_stored_artifact(contract.original_file_path) \
+            and os.path.exists(contract.original_file_path):
         try:
             os.remove(contract.original_file_path)
         except OSError as e:
             logging.error(f"Error deleting original file: {e}")
 
-    # Delete the contract
+    # Delete the contract, then its stored files unless other contracts share them
+    stored_paths = [contract.pdf_path, contract.original_file_path]
     db.session.delete(contract)
     db.session.commit()
+    release_artifacts(stored_paths)
 
     flash('契約書が削除されました。', 'success')
     return redirect(url_for('contract_list'))
 
 
+# ========== Export Routes ==========
+
+
+@app.route('/export/<kind>')
+@login_required
+def export_data(kind):
+    export_format = request.args.get('format', 'csv')
+    if kind not in EXPORT_KINDS or export_format not in EXPORT_FORMATS:
+        abort(404)
+
+    filters = None
+    if kind == 'contracts':
+        # The same filters as the contract list
+        form = ContractFilterForm(request.args)
+        form.validate()
+        filters = form.filters()
+    elif kind == 'rooms':
+        filters = {'building_id': request.args.get('building_id', type=int)}
+
+    # Rows are read and sent in chunks while the response is streaming, which
+    # takes minutes for large exports: gunicorn.conf.py keeps this off sync
+    # workers, whose timeout would cut the download short
+    chunks = iter_xlsx(kind, filters) if export_format == 'xlsx' else iter_csv(kind, filters)
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename="{export_filename(kind, export_format)}"'
+    return response
+
+
 # ========== API Routes ==========
 
 
@@ -1191,6 +1408,190 @@ def api_special_term_details(term_id):
     return jsonify(term_data)
 
 
+@app.route('/api/contracts/<int:contract_id>/pdf-status')
+@login_required
+def api_contract_pdf_status(contract_id):
+    contract = Contract.query.get_or_404(contract_id)
+    job = get_latest_job(contract_id)
+
+    pdf_ready = bool(contract.pdf_path and os.path.exists(contract.pdf_path)
+                     and not contract.pdf_stale_at)
+    if job and job.status in ('pending', 'running'):
+        status = job.status
+    elif pdf_ready:
+        status = 'done'
+    elif job and job.status == 'failed':
+        status = 'failed'
+    else:
+        status = 'missing'
+
+    status_data = {
+        'contract_id': contract.id,
+        'job_id': job.id if job else None,
+        'status': status,
+        'error': job.error if job and status == 'failed' else None,
+        'pdf_ready': pdf_ready and status == 'done',
+        'download_url': url_for('download_contract_pdf', contract_id=contract.id)
+    }
+
+    return jsonify(status_data)
+
+
+def _occupancy_request_args():
+    """Parse the date/start, months and building_id arguments of the occupancy APIs"""
+    try:
+        day = request.args.get('date') or request.args.get('start')
+        day = date.fromisoformat(day) if day else date.today()
+        months = int(request.args.get('months', CALENDAR_MONTHS))
+    except ValueError:
+        return None
+    if not 1 <= months <= 36:
+        return None
+    return day, months, request.args.get('building_id', type=int)
+
+
+def _occupancy_index_for(building_id):
+    if building_id:
+        Building.query.get_or_404(building_id)
+        return load_occupancy_index(building_id)
+    return get_occupancy_index()
+
+
+@app.route('/api/occupancy')
+@login_required
+def api_occupancy():
+    args = _occupancy_request_args()
+    if not args:
+        return jsonify({'error': '日付または月数の指定が正しくありません。'}), 400
+    day, _, building_id = args
+
+    occupancy = _occupancy_index_for(building_id)
+    data = occupancy.summary(day, building_id)
+    data['building_id'] = building_id
+    if building_id:
+        data['room_status'] = []
+        for room_id, room_number in db.session.query(Room.id, Room.room_number).filter(
+                Room.building_id == building_id).order_by(Room.room_number):
+            status = occupancy.room_status(room_id, day)
+            data['room_status'].append({
+                'room_id': room_id,
+                'room_number': room_number,
+                'occupied': status['occupied'],
+                'until': status['until'].isoformat() if status['until'] else None,
+                'next_start': status['next_start'].isoformat() if status['next_start'] else None
+            })
+    return jsonify(data)
+
+
+@app.route('/api/occupancy/calendar')
+@login_required
+def api_occupancy_calendar():
+    args = _occupancy_request_args()
+    if not args:
+        return jsonify({'error': '日付または月数の指定が正しくありません。'}), 400
+    start, months, building_id = args
+
+    occupancy = _occupancy_index_for(building_id)
+    return jsonify({
+        'building_id': building_id,
+        'calendar': occupancy.calendar(start, months, building_id)
+    })
+
+
+@app.route('/api/analytics/rent-roll')
+@login_required
+def api_rent_roll():
+    by = request.args.get('by', 'building')
+    try:
+        start = request.args.get('start')
+        start = datetime.strptime(start, '%Y-%m').date() if start else date.today()
+        months = int(request.args.get('months', 1))
+    except ValueError:
+        return jsonify({'error': '開始月または月数の指定が正しくありません。'}), 400
+    if by not in GROUP_BY or not 1 <= months <= MAX_MONTHS:
+        return jsonify({'error': '集計単位または月数の指定が正しくありません。'}), 400
+
+    report = rent_roll_report(by, start, months)
+    if request.args.get('format') == 'csv':
+        response = Response(rent_roll_csv(report), mimetype='text/csv; charset=utf-8')
+        filename = f"rent_roll_{by}_{report['months'][0]}.csv"
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    return jsonify(report)
+
+
+@app.route('/api/contracts/expiring')
+@login_required
+def api_contracts_expiring():
+    form = ExpiringContractsForm(request.args)
+    if not form.validate():
+        return jsonify({'errors': form.errors}), 400
+
+    filters = form.filters()
+    contracts = find_expiring_contracts(**filters)
+    by_building, by_agent = group_expiring(contracts)
+    return jsonify({
+        'days': filters['days'],
+        'total': len(contracts),
+        'by_building': [{
+            'building_id': group['id'],
+            'building_name': group['name'],
+            'count': len(group['contracts']),
+            'contracts': [{
+                'id': contract.id,
+                'contract_number': contract.contract_number,
+                'tenant_name': contract.tenant_name,
+                'room_number': contract.room.room_number,
+                'end_date': contract.end_date.isoformat(),
+                'rent_amount': contract.rent_amount,
+                'agent_id': contract.agent_id,
+                'url': url_for('view_contract', contract_id=contract.id)
+            } for contract in group['contracts']]
+        } for group in by_building],
+        'by_agent': [{
+            'agent_id': group['id'],
+            'agent_name': group['name'],
+            'count': len(group['contracts']),
+            'contract_ids': [contract.id for contract in group['contracts']]
+        } for group in by_agent]
+    })
+
+
+@app.route('/api/contracts')
+@login_required
+def api_contracts():
+    form = ContractFilterForm(request.args)
+    if not form.validate():
+        return jsonify({'errors': form.errors}), 400
+
+    contracts, next_cursor, prev_cursor = get_contract_page(
+        filters=form.filters(),
+        sort=form.sort.data,
+        order=form.order.data,
+        after=request.args.get('after'),
+        before=request.args.get('before'))
+
+    contracts_data = [{
+        'id': contract.id,
+        'contract_number': contract.contract_number,
+        'tenant_name': contract.tenant_name,
+        'building_name': contract.room.building.name,
+        'room_number': contract.room.room_number,
+        'start_date': contract.start_date.strftime('%Y-%m-%d'),
+        'end_date': contract.end_date.strftime('%Y-%m-%d') if contract.end_date else None,
+        'rent_amount': contract.rent_amount,
+        'agent_name': contract.agent.name,
+        'created_at': contract.created_at.isoformat(),
+        'url': url_for('view_contract', contract_id=contract.id)
+    } for contract in contracts]
+
+    return jsonify({
+        'contracts': contracts_data,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor
+    })
+
+
 # ========== Error Handlers ==========
 
 
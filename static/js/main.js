@@ -248,6 +248,42 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // PDF generation status polling (contract detail page)
+    const pdfStatusContainer = document.getElementById('pdf-status');
+    if (pdfStatusContainer) {
+        const pdfStatusMessage = document.getElementById('pdf-status-message');
+        const statusUrl = pdfStatusContainer.dataset.statusUrl;
+        
+        function pollPdfStatus() {
+            fetch(statusUrl)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.status === 'pending' || data.status === 'running') {
+                        pdfStatusContainer.className = 'alert alert-info';
+                        pdfStatusMessage.innerHTML = '<i class="fas fa-spinner fa-spin"></i> PDFを生成しています...';
+                        pdfStatusContainer.style.display = 'block';
+                        setTimeout(pollPdfStatus, 2000);
+                    } else if (data.status === 'done') {
+                        // Only announce completion if we were waiting for it
+                        if (pdfStatusContainer.style.display === 'block') {
+                            pdfStatusContainer.className = 'alert alert-success';
+                            pdfStatusMessage.innerHTML = `<i class="fas fa-check-circle"></i> PDFの生成が完了しました。
+                                <a href="${data.download_url}" class="alert-link">ダウンロード</a>`;
+                        }
+                    } else if (data.status === 'failed') {
+                        pdfStatusContainer.className = 'alert alert-danger';
+                        pdfStatusMessage.textContent = 'PDFの生成中にエラーが発生しました。' + (data.error || '');
+                        pdfStatusContainer.style.display = 'block';
+                    }
+                })
+                .catch(error => {
+                    console.error('Error fetching PDF status:', error);
+                });
+        }
+        
+        pollPdfStatus();
+    }
+
     // Delete confirmation functionality
     const deleteButtons = document.querySelectorAll('.delete-confirm');
     deleteButtons.forEach(button => {
@@ -0,0 +1,237 @@
+# Materialized dashboard statistics.
+#
+# The dashboard reads its figures from the dashboard_stats table instead of
+# counting the portfolio on every page load. Row counts of contracts,
+# buildings, rooms and owners are adjusted by a flush hook in the same
+# transaction as the insert or delete that changes them.
+#
+# Occupancy, the monthly rent roll and the contracts expiring this month
+# depend on today's date as well. They carry the day they are valid for
+# (as_of): contract inserts and deletes adjust them incrementally, and they
+# are recomputed once a day (on the first dashboard load of the day, or by
+# `flask refresh-stats` from cron) or after a contract's dates, rent or room
+# change. `flask refresh-stats` also reconciles the counters with the tables.
+#
+# The same hook bumps version counters when contracts or rooms are added or
+# removed, or a column in VERSIONED_COLUMNS changes. In-process caches of that
+# data (the occupancy index, the rent roll) are keyed on them.
+import logging
+from collections import Counter
+from datetime import date, timedelta
+
+import click
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import Contract, Building, Room, Owner, DashboardStat
+
+# Row counts kept up to date by the flush hook
+COUNTED_MODELS = {Contract: 'contracts', Building: 'buildings', Room: 'rooms', Owner: 'owners'}
+
+# Figures that are only valid for the day in their as_of
+DAILY_STATS = ('occupied_rooms', 'rent_roll', 'expiring_this_month')
+
+# Change counters of the contract and room tables
+VERSION_STATS = {Contract: 'contracts_version', Room: 'rooms_version'}
+
+# Columns the version-keyed caches read. Updates to other columns (PDF paths,
+# snapshots, stale flags, timestamps) leave the versions, and the caches,
+# alone; inserts and deletes always bump them.
+VERSIONED_COLUMNS = {
+    Contract: ('room_id', 'start_date', 'end_date', 'rent_amount', 'management_fee',
+               'security_deposit', 'key_money'),
+    Room: ('building_id', 'floor_area'),
+}
+
+# Contract columns the daily figures are computed from
+_DAILY_STAT_COLUMNS = ('room_id', 'start_date', 'end_date', 'rent_amount')
+
+stats_table = DashboardStat.__table__
+
+
+def _month_bounds(day):
+    first = day.replace(day=1)
+    next_month = (first + timedelta(days=32)).replace(day=1)
+    return first, next_month - timedelta(days=1)
+
+
+def _active_on(day):
+    """Filter for contracts in force on a day"""
+    return db.and_(Contract.start_date <= day,
+                   db.or_(Contract.end_date.is_(None), Contract.end_date >= day))
+
+
+def _is_active(contract, day):
+    return contract.start_date <= day and (contract.end_date is None or contract.end_date >= day)
+
+
+def _compute_counts():
+    return {name: db.session.query(db.func.count()).select_from(model).scalar()
+            for model, name in COUNTED_MODELS.items()}
+
+
+def _compute_daily_stats(day):
+    active = _active_on(day)
+    first, last = _month_bounds(day)
+    return {
+        'occupied_rooms': db.session.query(
+            db.func.count(db.distinct(Contract.room_id))).filter(active).scalar(),
+        'rent_roll': db.session.query(
+            db.func.coalesce(db.func.sum(Contract.rent_amount), 0)).filter(active).scalar(),
+        'expiring_this_month': db.session.query(db.func.count(Contract.id)).filter(
+            Contract.end_date.between(first, last)).scalar(),
+    }
+
+
+def _store_stats(values, as_of=None):
+    for name, value in values.items():
+        db.session.merge(DashboardStat(name=name, value=value, as_of=as_of))
+
+
+def refresh_daily_stats(day=None):
+    """Recompute the date-dependent figures for a day (today by default)"""
+    day = day or date.today()
+    _store_stats(_compute_daily_stats(day), as_of=day)
+    logging.info(f"Refreshed daily dashboard stats for {day}")
+
+
+def refresh_stats(day=None):
+    """Recompute every dashboard figure from the tables"""
+    _store_stats(_compute_counts())
+    refresh_daily_stats(day)
+
+
+def get_dashboard_stats():
+    """Dashboard figures, read from the stats table in one query.
+
+    The daily figures are recomputed first if they are not valid for today.
+    Returns a dict with the row counts, occupied_rooms, occupancy_rate (%),
+    rent_roll and expiring_this_month.
+    """
+    today = date.today()
+    stats = {stat.name: stat for stat in DashboardStat.query}
+    if any(name not in stats for name in COUNTED_MODELS.values()):
+        refresh_stats(today)
+    elif any(name not in stats or stats[name].as_of != today for name in DAILY_STATS):
+        refresh_daily_stats(today)
+    else:
+        return _present(stats)
+    db.session.commit()
+    return _present({stat.name: stat for stat in DashboardStat.query})
+
+
+def get_data_versions():
+    """Current (contracts_version, rooms_version), for keying caches"""
+    names = list(VERSION_STATS.values())
+    versions = dict(db.session.query(DashboardStat.name, DashboardStat.value).filter(
+        DashboardStat.name.in_(names)))
+    missing = [name for name in names if name not in versions]
+    if missing:
+        # Counters start at zero; the flush hook only bumps existing rows
+        try:
+            _store_stats({name: 0 for name in missing})
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Another process created them first
+        return get_data_versions()
+    return tuple(versions[name] for name in names)
+
+
+def record_bulk_insert(model, count):
+    """Apply rows inserted without the ORM (which the flush hook does not
+    see) to the stats, in the current transaction"""
+    connection = db.session.connection()
+    deltas = {}
+    if model in COUNTED_MODELS:
+        deltas[COUNTED_MODELS[model]] = count
+    if model in VERSION_STATS:
+        deltas[VERSION_STATS[model]] = 1
+    for name, delta in deltas.items():
+        connection.execute(stats_table.update().where(stats_table.c.name == name).values(
+            value=stats_table.c.value + delta))
+    if model is Contract:
+        connection.execute(stats_table.update().where(stats_table.c.name.in_(DAILY_STATS)).values(
+            as_of=None))
+
+
+def _present(stats):
+    values = {name: stat.value for name, stat in stats.items()}
+    rooms = values['rooms']
+    values['occupancy_rate'] = values['occupied_rooms'] * 100 / rooms if rooms else 0.0
+    return values
+
+
+def _columns_changed(obj, keys):
+    state = db.inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _load_deleted_contracts(session, flush_context, instances):
+    # The after_flush hook reads the columns of deleted contracts; load any
+    # expired ones while the rows still exist
+    for obj in session.deleted:
+        if isinstance(obj, Contract):
+            obj.start_date
+
+
+@event.listens_for(db.session, 'after_flush')
+def _update_stats_after_flush(session, flush_context):
+    """Apply the flush's inserts and deletes to the stats, in its transaction"""
+    deltas = Counter()
+    changed = [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]
+    today = date.today()
+    first, last = _month_bounds(today)
+
+    # Active contracts added (+) or removed (-) per room, for occupancy
+    room_changes = {}
+    for obj in list(session.new) + list(session.deleted):
+        if type(obj) in VERSION_STATS:
+            deltas[VERSION_STATS[type(obj)]] = 1
+    for obj in session.dirty:
+        if type(obj) in VERSION_STATS and _columns_changed(obj, VERSIONED_COLUMNS[type(obj)]):
+            deltas[VERSION_STATS[type(obj)]] = 1
+
+    for obj, sign in changed:
+        name = COUNTED_MODELS.get(type(obj))
+        if not name:
+            continue
+        deltas[name] += sign
+        if name != 'contracts':
+            continue
+        if obj.end_date and first <= obj.end_date <= last:
+            deltas['expiring_this_month'] += sign
+        if _is_active(obj, today):
+            deltas['rent_roll'] += sign * obj.rent_amount
+            room_changes[obj.room_id] = room_changes.get(obj.room_id, 0) + sign
+
+    connection = session.connection()
+    if room_changes:
+        active_now = dict(connection.execute(
+            db.select(Contract.room_id, db.func.count()).where(
+                Contract.room_id.in_(room_changes), _active_on(today)).group_by(
+                    Contract.room_id)).all())
+        for room_id, change in room_changes.items():
+            after = active_now.get(room_id, 0)
+            deltas['occupied_rooms'] += (after > 0) - (after - change > 0)
+
+    for name, delta in deltas.items():
+        if delta:
+            connection.execute(stats_table.update().where(stats_table.c.name == name).values(
+                value=stats_table.c.value + delta))
+
+    if any(isinstance(obj, Contract) and _columns_changed(obj, _DAILY_STAT_COLUMNS)
+           for obj in session.dirty):
+        # Recomputed on the next dashboard load
+        connection.execute(stats_table.update().where(stats_table.c.name.in_(DAILY_STATS)).values(
+            as_of=None))
+
+
+@app.cli.command('refresh-stats')
+def refresh_stats_command():
+    """Recompute the dashboard statistics (run daily, after midnight)."""
+    refresh_stats()
+    db.session.commit()
+    for stat in DashboardStat.query.order_by(DashboardStat.name):
+        click.echo(f"{stat.name}: {stat.value}")
@@ -1,14 +1,28 @@
 import os
+import html
+import json
+import time
+import hashlib
 import tempfile
 import logging
-from functools import wraps
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from functools import lru_cache, wraps
+from types import SimpleNamespace
 from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache
+from sqlalchemy.orm import joinedload, load_only, selectinload
 import weasyprint
 
 from app import app, db
+from renderer import BASE_CSS, render_html
+from placeholders import index_excel_placeholders, fill_excel_placeholders
+from placeholders import index_word_placeholders, fill_word_placeholders
+from pdf_forms import ParsedPdfTemplate, fill_pdf_template, load_pdf_settings
 from models import Contract, Room, Building, Owner, RealEstateAgent, SpecialTerm, ContractTemplate
+from models import ContractTemplateIndex, ContractNumberCounter, ContractDependency
 
 def require_admin(f):
     """Decorator to require admin role for a view"""
@@ -20,83 +34,738 @@ def require_admin(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def get_contract_data(contract_id):
-    """Get all data needed for the contract PDF generation"""
-    contract = Contract.query.get(contract_id)
-    if not contract:
-        logging.error(f"Contract with ID {contract_id} not found")
-        return None
-    
-    room = Room.query.get(contract.room_id)
-    if not room:
-        logging.error(f"Room with ID {contract.room_id} not found")
+# Compiled HTML contract templates, keyed by (template id, content hash).
+# The in-process LRU avoids re-parsing on every render; the on-disk bytecode
+# cache is shared by all gunicorn workers on the host so a fresh worker only
+# has to load the compiled code instead of compiling the source again.
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', 64))
+TEMPLATE_BYTECODE_DIR = os.path.join(tempfile.gettempdir(), 'lease_contracts', 'jinja_bytecode')
+os.makedirs(TEMPLATE_BYTECODE_DIR, exist_ok=True)
+
+_template_env = Environment(bytecode_cache=FileSystemBytecodeCache(TEMPLATE_BYTECODE_DIR))
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+def get_compiled_template(template):
+    """Return the compiled Jinja2 template for an HTML ContractTemplate"""
+    source = template.file_content or ''
+    content_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    key = (template.id, content_hash)
+
+    with _template_cache_lock:
+        compiled = _template_cache.get(key)
+        if compiled is not None:
+            _template_cache.move_to_end(key)
+            return compiled
+
+    # Look the compiled code up in the shared bytecode cache before compiling
+    name = f"contract_template_{template.id}_{content_hash}"
+    bytecode_cache = _template_env.bytecode_cache
+    bucket = bytecode_cache.get_bucket(_template_env, name, None, source)
+    if bucket.code is None:
+        bucket.code = _template_env.compile(source, name)
+        bytecode_cache.set_bucket(bucket)
+    compiled = _template_env.template_class.from_code(
+        _template_env, bucket.code, _template_env.make_globals(None))
+
+    with _template_cache_lock:
+        _template_cache[key] = compiled
+        _template_cache.move_to_end(key)
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return compiled
+
+# Parsed PDF templates, keyed the same way; filling a contract only adds its
+# own fields and overlays on top of the shared parse
+_pdf_template_cache = OrderedDict()
+
+def get_parsed_pdf_template(template):
+    """Return the parsed form of a PDF ContractTemplate"""
+    key = (template.id, hashlib.sha256(template.file_binary).hexdigest())
+
+    with _template_cache_lock:
+        parsed = _pdf_template_cache.get(key)
+        if parsed is not None:
+            _pdf_template_cache.move_to_end(key)
+            return parsed
+
+    parsed = ParsedPdfTemplate(template.file_binary)
+
+    with _template_cache_lock:
+        _pdf_template_cache[key] = parsed
+        _pdf_template_cache.move_to_end(key)
+        while len(_pdf_template_cache) > TEMPLATE_CACHE_SIZE:
+            _pdf_template_cache.popitem(last=False)
+    return parsed
+
+def invalidate_template_cache(template_id):
+    """Drop the compiled versions of a template after its content changed"""
+    with _template_cache_lock:
+        for cache in (_template_cache, _pdf_template_cache):
+            for key in [key for key in cache if key[0] == template_id]:
+                del cache[key]
+
+# Template files are read from the database in slices of this size when
+# downloaded, so a large upload is never held in memory as a whole. On
+# PostgreSQL the column is stored uncompressed (migration 0011), so each
+# slice reads only its own part of the value
+TEMPLATE_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+def get_template_file_size(template_id):
+    """Size in bytes of a template's uploaded file (None if there is none)"""
+    return db.session.query(db.func.length(ContractTemplate.file_binary)).filter(
+        ContractTemplate.id == template_id).scalar()
+
+def iter_template_file(template_id, size, chunk_size=TEMPLATE_DOWNLOAD_CHUNK_SIZE):
+    """Yield a template's uploaded file in chunks read straight from the database"""
+    for offset in range(0, size, chunk_size):
+        chunk = db.session.query(
+            db.func.substr(ContractTemplate.file_binary, offset + 1, chunk_size)).filter(
+                ContractTemplate.id == template_id).scalar()
+        if not chunk:
+            return
+        yield bytes(chunk)
+
+# Generated documents live in a content-addressed artifact store: nothing is
+# written per contract, identical documents share one file, and downloads are
+# streamed straight from it. Rendered PDFs are addressed by a hash of the HTML
+# that produced them, so identical HTML skips WeasyPrint entirely.
+ARTIFACT_DIR = os.path.join(tempfile.gettempdir(), 'lease_contracts', 'artifacts')
+PDF_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'lease_contracts', 'pdf_cache')
+
+# Write the intermediate HTML of every render to lease_contracts/debug
+PDF_DEBUG_ARTIFACTS = os.environ.get('PDF_DEBUG_ARTIFACTS') == '1'
+DEBUG_ARTIFACT_DIR = os.path.join(tempfile.gettempdir(), 'lease_contracts', 'debug')
+
+def _write_atomic(path, data):
+    """Publish a file atomically so concurrent workers never read a partial one"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _reuse_stored(path):
+    """Touch an existing store file so sweeps leave it alone; False if it is missing"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def store_artifact(data, extension):
+    """Store generated file contents and return their path in the artifact store"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(ARTIFACT_DIR, digest[:2], f"{digest}{extension}")
+    if not _reuse_stored(path):
+        _write_atomic(path, data)
+    return path
+
+def is_stored_artifact(path):
+    """True for files in the shared stores, which must never be deleted per contract"""
+    path = os.path.abspath(path)
+    return any(path.startswith(os.path.join(store, ''))
+               for store in (ARTIFACT_DIR, PDF_CACHE_DIR))
+
+def write_debug_artifact(filename, content):
+    """Keep an intermediate file for debugging when PDF_DEBUG_ARTIFACTS is set"""
+    if not PDF_DEBUG_ARTIFACTS:
+        return
+    os.makedirs(DEBUG_ARTIFACT_DIR, exist_ok=True)
+    with open(os.path.join(DEBUG_ARTIFACT_DIR, filename), 'w', encoding='utf-8') as f:
+        f.write(content)
+
+def render_pdf(html_content):
+    """Render HTML to PDF in memory and return the stored PDF's path"""
+    renderer_version = getattr(weasyprint, '__version__', '')
+    digest = hashlib.sha256(
+        f"{renderer_version}\0{BASE_CSS}\0{html_content}".encode('utf-8')).hexdigest()
+    pdf_path = os.path.join(PDF_CACHE_DIR, digest[:2], f"{digest}.pdf")
+
+    if _reuse_stored(pdf_path):
+        logging.debug(f"PDF cache hit ({digest})")
+        return pdf_path
+
+    _write_atomic(pdf_path, render_html(html_content))
+    return pdf_path
+
+# Files in the stores that no contract refers to any more are deleted, but
+# only once untouched for this long: a render may have written (or reused) a
+# file whose path is not committed to its contract yet. A contract left with
+# a missing file renders it again on the next download.
+ARTIFACT_GRACE_SECONDS = int(os.environ.get('ARTIFACT_GRACE_SECONDS', 600))
+
+def _referenced_paths(paths=None):
+    """Paths referenced by any contract (only looking for `paths` if given)"""
+    query = db.session.query(Contract.pdf_path, Contract.original_file_path)
+    if paths is not None:
+        query = query.filter(db.or_(Contract.pdf_path.in_(paths),
+                                    Contract.original_file_path.in_(paths)))
+    referenced = set()
+    for row in query.execution_options(yield_per=10000):
+        referenced.update(row)
+    return referenced
+
+def _remove_unused(path, cutoff):
+    """Delete a store file not modified since cutoff and return its size (0 if kept)"""
+    try:
+        if os.path.getmtime(path) > cutoff:
+            return 0
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logging.error(f"Error deleting stored file {path}: {e}")
+        return 0
+
+def release_artifacts(paths, grace=ARTIFACT_GRACE_SECONDS):
+    """Delete the store files among `paths` that no contract refers to any more.
+
+    Call after committing the change that dropped the references.
+    """
+    paths = {path for path in paths if path and is_stored_artifact(path)}
+    if not paths:
+        return 0
+    cutoff = time.time() - grace
+    unused = paths - _referenced_paths(paths)
+    return sum(1 for path in unused if _remove_unused(path, cutoff))
+
+def sweep_artifacts(grace=ARTIFACT_GRACE_SECONDS):
+    """Delete every store file no contract refers to; returns (files, bytes)"""
+    referenced = _referenced_paths()
+    cutoff = time.time() - grace
+    removed = freed = 0
+    for store in (ARTIFACT_DIR, PDF_CACHE_DIR):
+        for directory, _, filenames in os.walk(store):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                # Leftover .tmp files of interrupted writes go as well
+                if path not in referenced:
+                    size = _remove_unused(path, cutoff)
+                    if size:
+                        removed += 1
+                        freed += size
+    logging.info(f"Swept {removed} unused stored files ({freed} bytes)")
+    return removed, freed
+
+def index_template_placeholders(template):
+    """Parse where a template's placeholders are and store it as its index"""
+    if not template.file_binary:
         return None
-    
-    building = Building.query.get(room.building_id)
-    if not building:
-        logging.error(f"Building with ID {room.building_id} not found")
+    if template.file_type == 'excel':
+        data = index_excel_placeholders(template.file_binary)
+    elif template.file_type == 'word':
+        data = index_word_placeholders(template.file_binary)
+    else:
         return None
-    
-    owner = Owner.query.get(building.owner_id)
-    if not owner:
-        logging.error(f"Owner with ID {building.owner_id} not found")
+
+    content_hash = hashlib.sha256(template.file_binary).hexdigest()
+    if template.placeholder_index:
+        template.placeholder_index.content_hash = content_hash
+        template.placeholder_index.data = json.dumps(data, ensure_ascii=False)
+    else:
+        template.placeholder_index = ContractTemplateIndex(
+            content_hash=content_hash, data=json.dumps(data, ensure_ascii=False))
+    return data
+
+def get_placeholder_index(template):
+    """Return a template's placeholder index, rebuilding it if it is stale"""
+    index = template.placeholder_index
+    if index and template.file_binary and \
+            index.content_hash == hashlib.sha256(template.file_binary).hexdigest():
+        return json.loads(index.data)
+    logging.info(f"Indexing placeholders of template {template.id}")
+    return index_template_placeholders(template)
+
+# Each contract keeps a frozen JSON snapshot of everything its document shows
+# (tenant and terms, room, building, owner, agent, special terms), taken when
+# it is created. Rendering and the contract page read the snapshot, so a
+# contract's document stays as it was signed whatever is edited later, and a
+# re-render is a single-row fetch. A snapshot is only taken again through
+# refreeze_contracts, on an explicit request (the contract page's update
+# button, or --refreeze on a bulk regeneration).
+SNAPSHOT_VERSION = 1
+
+# Live-data columns that are not part of the document
+_SNAPSHOT_EXCLUDE = {'snapshot', 'pdf_path', 'original_file_path', 'notes', 'pdf_stale_at',
+                     'snapshot_outdated_at'}
+
+def _live_context_options():
+    """Loader options that bring in the live data a snapshot is built from"""
+    return [
+        joinedload(Contract.room).joinedload(Room.building).joinedload(Building.owner),
+        joinedload(Contract.agent),
+        selectinload(Contract.special_terms),
+    ]
+
+def _dump_columns(obj):
+    values = {}
+    for column in obj.__table__.columns:
+        if column.key in _SNAPSHOT_EXCLUDE:
+            continue
+        value = getattr(obj, column.key)
+        values[column.key] = value.isoformat() if hasattr(value, 'isoformat') else value
+    return values
+
+def _load_columns(model, values):
+    """Attribute-style copy of dumped columns with dates restored"""
+    restored = {}
+    for key, value in values.items():
+        column = model.__table__.columns.get(key)
+        if value is not None and column is not None:
+            if isinstance(column.type, db.DateTime):
+                value = datetime.fromisoformat(value)
+            elif isinstance(column.type, db.Date):
+                value = date.fromisoformat(value)
+        restored[key] = value
+    return SimpleNamespace(**restored)
+
+@lru_cache(maxsize=1024)
+def _parse_custom_amenities(custom_amenities):
+    try:
+        return tuple(json.loads(custom_amenities))
+    except json.JSONDecodeError:
+        logging.error(f"Error parsing custom amenities JSON: {custom_amenities}")
+        return ()
+
+def build_contract_snapshot(contract):
+    """Serialize the document data of a contract from the live tables"""
+    room = contract.room
+    building = room.building if room else None
+    owner = building.owner if building else None
+    if not (room and building and owner and contract.agent):
+        logging.error(f"Contract {contract.id} is missing its room, building, owner or agent")
         return None
-    
-    agent = RealEstateAgent.query.get(contract.agent_id)
-    if not agent:
-        logging.error(f"Agent with ID {contract.agent_id} not found")
+
+    return json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'contract': _dump_columns(contract),
+        'room': _dump_columns(room),
+        'building': _dump_columns(building),
+        'owner': _dump_columns(owner),
+        'agent': _dump_columns(contract.agent),
+        'special_terms': [{'id': term.id, 'title': term.title, 'content': term.content}
+                          for term in contract.special_terms],
+        'custom_amenities': list(_parse_custom_amenities(room.custom_amenities))
+                            if room.custom_amenities else [],
+    }, ensure_ascii=False, separators=(',', ':'))
+
+def _dependency_rows(contract):
+    room = contract.room
+    rows = [('room', room.id), ('building', room.building_id),
+            ('owner', room.building.owner_id), ('agent', contract.agent_id),
+            ('template', contract.template_id)]
+    rows += [('special_term', term.id) for term in contract.special_terms]
+    return [{'contract_id': contract.id, 'entity_type': entity_type, 'entity_id': entity_id}
+            for entity_type, entity_id in rows]
+
+def freeze_contract(contract):
+    """Store the contract's snapshot and its dependencies; call once its relations are set"""
+    freeze_contracts([contract])
+    return contract.snapshot
+
+def freeze_contracts(contracts):
+    """Freeze many contracts, rewriting their dependencies in two statements"""
+    rows = []
+    for contract in contracts:
+        contract.snapshot = build_contract_snapshot(contract)
+        if contract.snapshot:
+            rows.extend(_dependency_rows(contract))
+    frozen = [contract.id for contract in contracts if contract.snapshot]
+    if frozen:
+        db.session.execute(db.delete(ContractDependency).where(
+            ContractDependency.contract_id.in_(frozen)))
+        db.session.execute(db.insert(ContractDependency), rows)
+
+def refreeze_contracts(contract_ids, chunk_size=500):
+    """Replace the snapshots of contracts with their current live data.
+
+    Only for an explicit request to update the documents; the caller commits
+    and renders them again. Returns the number of contracts refrozen.
+    """
+    refrozen = 0
+    for start in range(0, len(contract_ids), chunk_size):
+        contracts = Contract.query.options(*_live_context_options()).filter(
+            Contract.id.in_(contract_ids[start:start + chunk_size])).all()
+        freeze_contracts(contracts)
+        for contract in contracts:
+            if contract.snapshot:
+                contract.snapshot_outdated_at = None
+                refrozen += 1
+    logging.info(f"Refroze the snapshots of {refrozen} contracts")
+    return refrozen
+
+def load_contract_snapshot(contract):
+    """The contract's document data, shaped like the models.
+
+    Returns a contract-like object whose room.building.owner, agent and
+    special_terms come from the snapshot, so HTML templates written against
+    the models keep working. None if the contract has no snapshot.
+    """
+    if not contract.snapshot:
         return None
-    
-    # Get all special terms for this contract
-    special_terms = contract.special_terms
-    
-    # Parse custom amenities JSON
-    custom_amenities = []
-    if room.custom_amenities:
-        try:
-            import json
-            custom_amenities = json.loads(room.custom_amenities)
-        except json.JSONDecodeError:
-            logging.error(f"Error parsing custom amenities JSON: {room.custom_amenities}")
-    
-    # Get the contract template
-    template = ContractTemplate.query.get(contract.template_id)
-    if not template:
+    data = json.loads(contract.snapshot)
+    document = _load_columns(Contract, data['contract'])
+    document.room = _load_columns(Room, data['room'])
+    document.room.building = _load_columns(Building, data['building'])
+    document.room.building.owner = _load_columns(Owner, data['owner'])
+    document.agent = _load_columns(RealEstateAgent, data['agent'])
+    document.special_terms = [SimpleNamespace(**term) for term in data['special_terms']]
+    document.custom_amenities = data['custom_amenities']
+    return document
+
+def _contract_context(contract):
+    """The rendering context of a contract, read from its snapshot"""
+    if not contract.template:
         logging.error(f"Template with ID {contract.template_id} not found")
         return None
-    
+    stale_at = contract.pdf_stale_at
+    if not contract.snapshot:
+        # Contracts created before snapshots existed are frozen on first use;
+        # existing snapshots are never replaced here
+        logging.info(f"Freezing snapshot of contract {contract.id}")
+        if not freeze_contract(contract):
+            return None
+
+    document = load_contract_snapshot(contract)
     return {
-        'contract': contract,
-        'room': room,
-        'building': building,
-        'owner': owner,
-        'agent': agent,
-        'special_terms': special_terms,
-        'custom_amenities': custom_amenities,
-        'template': template
+        'record': contract,
+        'contract': document,
+        'room': document.room,
+        'building': document.room.building,
+        'owner': document.room.building.owner,
+        'agent': document.agent,
+        'special_terms': document.special_terms,
+        'custom_amenities': document.custom_amenities,
+        'template': contract.template,
+        'stale_at': stale_at
     }
 
-def generate_pdf(contract_id):
-    """Generate a PDF for the contract and return the file path"""
-    data = get_contract_data(contract_id)
+def get_contract_data(contract_id):
+    """Get all data needed for the contract PDF generation.
+
+    One query: the contract row (with its snapshot) and its template.
+    """
+    contract = Contract.query.options(
+        joinedload(Contract.template).undefer(ContractTemplate.file_binary)).filter(
+            Contract.id == contract_id).first()
+    if not contract:
+        logging.error(f"Contract with ID {contract_id} not found")
+        return None
+    return _contract_context(contract)
+
+def get_contract_data_batch(contract_ids):
+    """Load the rendering contexts of many contracts in two queries.
+
+    Each distinct template (with its file) is loaded once. Returns
+    {contract id: context}; missing or incomplete contracts are left out.
+    """
+    contracts = Contract.query.options(
+        selectinload(Contract.template).undefer(ContractTemplate.file_binary)).filter(
+            Contract.id.in_(contract_ids)).all()
+
+    unfrozen = [contract.id for contract in contracts if not contract.snapshot]
+    if unfrozen:
+        # Pull the live data of the contracts to be frozen in one go
+        Contract.query.options(*_live_context_options()).filter(
+            Contract.id.in_(unfrozen)).all()
+
+    contexts = {}
+    for contract in contracts:
+        data = _contract_context(contract)
+        if data:
+            contexts[contract.id] = data
+    return contexts
+
+# contract_dependencies entity types, and the columns of each entity that are
+# not part of any document (snapshot exclusions aside)
+DEPENDENCY_TYPES = {
+    Owner: 'owner', Building: 'building', Room: 'room', RealEstateAgent: 'agent',
+    SpecialTerm: 'special_term', ContractTemplate: 'template'
+}
+_DEPENDENCY_IGNORED = {
+    'special_term': {'is_common', 'created_at'},
+    'template': {'name', 'description', 'file_name', 'is_default', 'created_at'},
+}
+
+def _column_changed(history):
+    """True if a column's pending change is more than '' <-> None from a form"""
+    if not history.has_changes():
+        return False
+    old = history.deleted[0] if history.deleted else None
+    new = history.added[0] if history.added else None
+    return (None if old == '' else old) != (None if new == '' else new)
+
+def mark_pdfs_stale(entity, deleted=False):
+    """Flag the contracts whose documents show `entity` after an edit.
+
+    Call before committing an edit (or deleting the entity, with
+    deleted=True). Nothing is flagged unless a column the documents use has
+    changed. A template edit sets pdf_stale_at: the PDFs are re-rendered
+    from their snapshots on the next download or by the stale PDF sweeper.
+    Any other edit only sets snapshot_outdated_at, since the documents keep
+    the data they were frozen with until refrozen on request. Returns the
+    number of contracts.
+    """
+    entity_type = DEPENDENCY_TYPES[type(entity)]
+    if not deleted:
+        ignored = _SNAPSHOT_EXCLUDE | _DEPENDENCY_IGNORED.get(entity_type, set())
+        state = db.inspect(entity)
+        changed = [attr.key for attr in state.mapper.column_attrs
+                   if attr.key not in ignored and _column_changed(state.attrs[attr.key].history)]
+        if not changed:
+            return 0
+
+    flag = 'pdf_stale_at' if entity_type == 'template' else 'snapshot_outdated_at'
+    count = Contract.query.filter(Contract.id.in_(
+        db.select(ContractDependency.contract_id).where(
+            ContractDependency.entity_type == entity_type,
+            ContractDependency.entity_id == entity.id))).update(
+                {flag: datetime.utcnow()}, synchronize_session=False)
+    if count:
+        logging.info(f"Set {flag} on {count} contracts after a change to {entity_type} {entity.id}")
+    return count
+
+def mark_pdf_current(data):
+    """Clear the stale flag of a contract rendered from `data`.
+
+    The flag is left alone if another edit marked the contract stale again
+    while it was rendering.
+    """
+    if data['stale_at'] is None:
+        return
+    Contract.query.filter(Contract.id == data['record'].id,
+                          Contract.pdf_stale_at == data['stale_at']).update(
+                              {'pdf_stale_at': None}, synchronize_session=False)
+
+def allocate_contract_numbers(count=1, day=None):
+    """Reserve `count` consecutive contract numbers for a day and return them.
+
+    Numbers look like YYYYMMDD-0001. A single INSERT ... ON CONFLICT DO UPDATE
+    on the day's counter row hands them out atomically, so concurrent workers
+    never draw the same number. The counters are the only source: numbers
+    used before they existed were seeded by migration 0009. Reservations
+    commit on their own; a number whose contract is never saved is simply
+    skipped.
+    """
+    day = day or datetime.now().strftime('%Y%m%d')
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    statement = insert(ContractNumberCounter).values(
+        day=day, last_number=count).on_conflict_do_update(
+            index_elements=[ContractNumberCounter.day],
+            set_={'last_number': ContractNumberCounter.last_number + count}).returning(
+                ContractNumberCounter.last_number)
+
+    with db.engine.begin() as connection:
+        last_number = connection.execute(statement).scalar()
+    return [f"{day}-{number:04d}" for number in range(last_number - count + 1, last_number + 1)]
+
+# Contracts shown per page of the contract list
+CONTRACTS_PER_PAGE = int(os.environ.get('CONTRACTS_PER_PAGE', 50))
+
+# Sortable columns of the contract list and how their cursor values parse.
+# Each sort is paired with the contract id so the order is total.
+CONTRACT_SORTS = {
+    'created_at': (Contract.created_at, datetime.fromisoformat),
+    'start_date': (Contract.start_date, date.fromisoformat),
+    'rent_amount': (Contract.rent_amount, int),
+}
+
+def encode_contract_cursor(contract, sort='created_at'):
+    """Opaque list position of a contract: its (sort value, id) key"""
+    value = getattr(contract, sort)
+    value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+    return f"{value}_{contract.id}"
+
+def decode_contract_cursor(cursor, sort='created_at'):
+    """Parse a cursor from encode_contract_cursor; None if it is malformed"""
+    try:
+        value, contract_id = cursor.rsplit('_', 1)
+        return CONTRACT_SORTS[sort][1](value), int(contract_id)
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+def _keyset_filter(column, value, contract_id, descending):
+    """Rows after (value, contract_id) in the given direction"""
+    if descending:
+        return db.or_(column < value,
+                      db.and_(column == value, Contract.id < contract_id))
+    return db.or_(column > value,
+                  db.and_(column == value, Contract.id > contract_id))
+
+def filter_contracts(query, building_id=None, owner_id=None, agent_id=None,
+                     start_from=None, start_to=None, rent_min=None, rent_max=None):
+    """Apply the contract list filters to a query on Contract.
+
+    Building and owner filters become room id subqueries, so they use the
+    contracts (room_id, ...) index and leave the main query free to join.
+    """
+    if building_id:
+        query = query.filter(Contract.room_id.in_(
+            db.select(Room.id).where(Room.building_id == building_id)))
+    if owner_id:
+        query = query.filter(Contract.room_id.in_(
+            db.select(Room.id).join(Building, Room.building_id == Building.id).where(
+                Building.owner_id == owner_id)))
+    if agent_id:
+        query = query.filter(Contract.agent_id == agent_id)
+    if start_from:
+        query = query.filter(Contract.start_date >= start_from)
+    if start_to:
+        query = query.filter(Contract.start_date <= start_to)
+    if rent_min is not None:
+        query = query.filter(Contract.rent_amount >= rent_min)
+    if rent_max is not None:
+        query = query.filter(Contract.rent_amount <= rent_max)
+    return query
+
+def build_contract_page_query(filters=None, sort='created_at', order='desc',
+                              after=None, before=None):
+    """The query behind get_contract_page; returns (query, cursor key, backwards)"""
+    if sort not in CONTRACT_SORTS:
+        sort = 'created_at'
+    column = CONTRACT_SORTS[sort][0]
+    descending = order != 'asc'
+
+    query = Contract.query.options(
+        load_only(Contract.id, Contract.contract_number, Contract.tenant_name,
+                  Contract.start_date, Contract.end_date, Contract.rent_amount,
+                  Contract.created_at),
+        joinedload(Contract.room).load_only(Room.room_number).joinedload(
+            Room.building).load_only(Building.name),
+        joinedload(Contract.agent).load_only(RealEstateAgent.name))
+    query = filter_contracts(query, **(filters or {}))
+
+    key = decode_contract_cursor(before, sort) if before else decode_contract_cursor(after, sort)
+    backwards = bool(before and key)
+    if key:
+        # Going backwards walks the opposite direction from the cursor
+        query = query.filter(_keyset_filter(column, key[0], key[1], descending != backwards))
+
+    if descending != backwards:
+        query = query.order_by(column.desc(), Contract.id.desc())
+    else:
+        query = query.order_by(column.asc(), Contract.id.asc())
+    return query, key, backwards
+
+def get_contract_page(filters=None, sort='created_at', order='desc', after=None,
+                      before=None, per_page=CONTRACTS_PER_PAGE):
+    """One page of the contract list, filtered and sorted in SQL.
+
+    Pages are read with keyset pagination: `after` / `before` are cursors of
+    the last / first row of the page the user comes from. The page is a single
+    query that loads only the columns the list shows, with the room, building
+    and agent joined in. Returns (contracts, next_cursor, prev_cursor).
+    """
+    if sort not in CONTRACT_SORTS:
+        sort = 'created_at'
+    query, key, backwards = build_contract_page_query(filters, sort, order, after, before)
+
+    # One extra row tells whether there is another page in this direction
+    contracts = query.limit(per_page + 1).all()
+    more = len(contracts) > per_page
+    contracts = contracts[:per_page]
+    if backwards:
+        contracts.reverse()
+
+    if not contracts:
+        return contracts, None, None
+    has_next = more if not backwards else True
+    has_prev = more if backwards else bool(key)
+    next_cursor = encode_contract_cursor(contracts[-1], sort) if has_next else None
+    prev_cursor = encode_contract_cursor(contracts[0], sort) if has_prev else None
+    return contracts, next_cursor, prev_cursor
+
+TABLE_OPEN = "<table border='1' style='border-collapse: collapse; width: 100%;'>"
+
+def _excel_used_range(sheet):
+    """Return (min_row, min_col, max_row, max_col) of cells holding values.
+
+    sheet.dimensions also counts cells that only carry formatting, which in
+    real templates can stretch to thousands of empty rows and columns. Only
+    the cells the sheet has stored are looked at: iter_rows creates a cell
+    at every coordinate it visits, so scanning the dimensions with it would
+    grow with the formatted size and fill the sheet with empty cells.
+    """
+    min_row = min_col = max_row = max_col = None
+    for (row, col), cell in sheet._cells.items():
+        if cell.value is None or cell.value == '':
+            continue
+        if min_row is None:
+            min_row, min_col, max_row, max_col = row, col, row, col
+            continue
+        min_row, max_row = min(min_row, row), max(max_row, row)
+        min_col, max_col = min(min_col, col), max(max_col, col)
+    if min_row is None:
+        return None
+    return min_row, min_col, max_row, max_col
+
+def iter_excel_html(workbook, contract_number):
+    """Yield the HTML representation of a filled Excel workbook in chunks"""
+    escape = html.escape
+    yield "<html><body>"
+    yield f"<h1>賃貸借契約書: {escape(contract_number)}</h1>"
+
+    for sheet in workbook.worksheets:
+        yield f"<h2>{escape(sheet.title)}</h2>"
+        yield TABLE_OPEN
+        used_range = _excel_used_range(sheet)
+        if used_range:
+            min_row, min_col, max_row, max_col = used_range
+            for row in sheet.iter_rows(min_row=min_row, min_col=min_col,
+                                       max_row=max_row, max_col=max_col,
+                                       values_only=True):
+                yield "<tr>" + "".join(
+                    f"<td style='padding: 5px;'>{escape(str(value)) if value is not None else ''}</td>"
+                    for value in row) + "</tr>"
+        yield "</table><br>"
+
+    yield "</body></html>"
+
+def iter_word_html(doc, contract_number):
+    """Yield the HTML representation of a filled Word document in chunks"""
+    escape = html.escape
+    yield "<html><body>"
+    yield f"<h1>賃貸借契約書: {escape(contract_number)}</h1>"
+
+    # Add each paragraph
+    for para in doc.paragraphs:
+        text = para.text
+        if text.strip():
+            yield f"<p>{escape(text)}</p>"
+
+    # Add tables
+    for table in doc.tables:
+        yield TABLE_OPEN
+        for row in table.rows:
+            yield "<tr>" + "".join(
+                f"<td style='padding: 5px;'>{escape(' '.join(p.text for p in cell.paragraphs))}</td>"
+                for cell in row.cells) + "</tr>"
+        yield "</table><br>"
+
+    yield "</body></html>"
+
+def generate_pdf(contract_id, data=None, raise_errors=False):
+    """Generate a PDF for the contract and return the file path.
+
+    `data` is the contract's context from get_contract_data_batch, if the
+    caller has already loaded it. Errors are logged and None is returned,
+    unless raise_errors is set (the render jobs record the exception).
+    """
+    data = data or get_contract_data(contract_id)
     if not data:
         return None
     
-    # Create a temporary directory for PDF generation
-    pdf_dir = os.path.join(tempfile.gettempdir(), 'lease_contracts')
-    os.makedirs(pdf_dir, exist_ok=True)
-    
-    # Create a filename for the PDF
-    pdf_filename = f"contract_{data['contract'].contract_number}.pdf"
-    pdf_path = os.path.join(pdf_dir, pdf_filename)
-    
-    # Also create paths for original format files
-    original_dir = os.path.join(pdf_dir, 'originals')
-    os.makedirs(original_dir, exist_ok=True)
-    
     try:
         template = data['template']
         contract = data['contract']
+        record = data['record']
         
         # Create a more comprehensive replacement dictionary for all template types
         replace_dict = {
@@ -131,8 +800,7 @@ def generate_pdf(contract_id):
         # Handle different template types
         if template.file_type == 'html':
             # HTML template - Use Jinja2 to render the HTML template
-            template_content = template.file_content
-            jinja_template = Template(template_content)
+            jinja_template = get_compiled_template(template)
             html_content = jinja_template.render(
                 contract=data['contract'],
                 room=data['room'],
@@ -144,12 +812,10 @@ def generate_pdf(contract_id):
             )
             
             # Save HTML file for reference
-            html_path = os.path.join(original_dir, f"contract_{contract.contract_number}.html")
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
+            write_debug_artifact(f"contract_{contract.contract_number}.html", html_content)
             
-            # Generate PDF with WeasyPrint
-            weasyprint.HTML(string=html_content).write_pdf(pdf_path)
+            # Generate PDF with WeasyPrint (or reuse an identical earlier render)
+            pdf_path = render_pdf(html_content)
             
         elif template.file_type == 'excel':
             # Excel template processing
@@ -158,57 +824,31 @@ def generate_pdf(contract_id):
             
             # Load the Excel template
             if not template.file_binary:
-                logging.error("Excel template has no binary data")
-                return None
+                raise ValueError('Excelテンプレートのファイルがありません。')
             
             workbook = openpyxl.load_workbook(BytesIO(template.file_binary))
-            sheet = workbook.active
             
-            # Replace placeholders in all cells
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                for row in sheet.rows:
-                    for cell in row:
-                        if cell.value and isinstance(cell.value, str):
-                            for placeholder, value in replace_dict.items():
-                                if placeholder in cell.value:
-                                    cell.value = cell.value.replace(placeholder, value)
+            # Replace placeholders only in the cells the template index lists,
+            # with a single regex pass per cell
+            fill_excel_placeholders(workbook, get_placeholder_index(template), replace_dict)
             
-            # Save to a temporary Excel file
-            excel_path = os.path.join(original_dir, f"contract_{contract.contract_number}.xlsx")
-            workbook.save(excel_path)
+            # Keep the filled Excel file in the artifact store
+            excel_buffer = BytesIO()
+            workbook.save(excel_buffer)
+            excel_path = store_artifact(excel_buffer.getvalue(), '.xlsx')
             
             # For Excel to PDF conversion, we'll use WeasyPrint with an HTML table representation
-            # First, convert Excel to HTML table
-            html_content = "<html><body>"
-            html_content += f"<h1>賃貸借契約書: {contract.contract_number}</h1>"
-            
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                html_content += f"<h2>{sheet_name}</h2>"
-                html_content += "<table border='1' style='border-collapse: collapse; width: 100%;'>"
-                
-                # Process all rows and cells
-                for row in sheet.rows:
-                    html_content += "<tr>"
-                    for cell in row:
-                        value = cell.value if cell.value is not None else ""
-                        html_content += f"<td style='padding: 5px;'>{value}</td>"
-                    html_content += "</tr>"
-                html_content += "</table><br>"
-            
-            html_content += "</body></html>"
+            # First, convert Excel to HTML table (streamed over the used range only)
+            html_content = ''.join(iter_excel_html(workbook, contract.contract_number))
             
             # Save intermediate HTML
-            html_path = os.path.join(original_dir, f"contract_{contract.contract_number}_excel.html")
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
+            write_debug_artifact(f"contract_{contract.contract_number}_excel.html", html_content)
             
-            # Generate PDF with WeasyPrint
-            weasyprint.HTML(string=html_content).write_pdf(pdf_path)
+            # Generate PDF with WeasyPrint (or reuse an identical earlier render)
+            pdf_path = render_pdf(html_content)
             
             # Also save the Excel file as an attachment with the contract
-            contract.original_file_path = excel_path
+            record.original_file_path = excel_path
             
         elif template.file_type == 'word':
             # Word template processing
@@ -217,90 +857,48 @@ def generate_pdf(contract_id):
             
             # Load the Word template
             if not template.file_binary:
-                logging.error("Word template has no binary data")
-                return None
+                raise ValueError('Wordテンプレートのファイルがありません。')
                 
             doc = docx.Document(BytesIO(template.file_binary))
             
-            # Replace placeholders in paragraphs
-            for para in doc.paragraphs:
-                for placeholder, value in replace_dict.items():
-                    if placeholder in para.text:
-                        para.text = para.text.replace(placeholder, value)
+            # Replace placeholders only in the indexed paragraphs, run by run,
+            # so formatting survives and split placeholders are handled
+            fill_word_placeholders(doc, get_placeholder_index(template), replace_dict)
             
-            # Replace placeholders in tables
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        for para in cell.paragraphs:
-                            for placeholder, value in replace_dict.items():
-                                if placeholder in para.text:
-                                    para.text = para.text.replace(placeholder, value)
-            
-            # Save to a temporary Word file
-            docx_path = os.path.join(original_dir, f"contract_{contract.contract_number}.docx")
-            doc.save(docx_path)
+            # Keep the filled Word file in the artifact store
+            docx_buffer = BytesIO()
+            doc.save(docx_buffer)
+            docx_path = store_artifact(docx_buffer.getvalue(), '.docx')
             
             # For Word to PDF conversion, we'll use the same approach as Excel
             # Convert Word to HTML representation
-            html_content = "<html><body>"
-            html_content += f"<h1>賃貸借契約書: {contract.contract_number}</h1>"
-            
-            # Add each paragraph
-            for para in doc.paragraphs:
-                if para.text.strip():
-                    html_content += f"<p>{para.text}</p>"
-            
-            # Add tables
-            for table in doc.tables:
-                html_content += "<table border='1' style='border-collapse: collapse; width: 100%;'>"
-                for row in table.rows:
-                    html_content += "<tr>"
-                    for cell in row.cells:
-                        cell_text = " ".join([p.text for p in cell.paragraphs])
-                        html_content += f"<td style='padding: 5px;'>{cell_text}</td>"
-                    html_content += "</tr>"
-                html_content += "</table><br>"
-            
-            html_content += "</body></html>"
+            html_content = ''.join(iter_word_html(doc, contract.contract_number))
             
             # Save intermediate HTML
-            html_path = os.path.join(original_dir, f"contract_{contract.contract_number}_word.html")
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
+            write_debug_artifact(f"contract_{contract.contract_number}_word.html", html_content)
             
-            # Generate PDF with WeasyPrint
-            weasyprint.HTML(string=html_content).write_pdf(pdf_path)
+            # Generate PDF with WeasyPrint (or reuse an identical earlier render)
+            pdf_path = render_pdf(html_content)
             
             # Also save the Word file as an attachment with the contract
-            contract.original_file_path = docx_path
+            record.original_file_path = docx_path
             
         elif template.file_type == 'pdf':
-            # PDF template processing with PyPDF2
-            from io import BytesIO
-            import PyPDF2
-            
-            # Load the PDF template
+            # PDF template processing: fill AcroForm fields and text overlays
             if not template.file_binary:
-                logging.error("PDF template has no binary data")
-                return None
+                raise ValueError('PDFテンプレートのファイルがありません。')
             
-            # For now, we'll create a copy of the PDF template
-            # In a real implementation, you might use reportlab to add text overlays to the PDF
-            pdf_template_path = os.path.join(original_dir, f"template_{template.id}.pdf")
-            with open(pdf_template_path, 'wb') as f:
-                f.write(template.file_binary)
+            # The template is parsed once per process; each contract only
+            # appends its filled fields and overlays as an incremental update
+            parsed = get_parsed_pdf_template(template)
+            settings = load_pdf_settings(template.file_content)
+            pdf_path = store_artifact(fill_pdf_template(parsed, settings, replace_dict), '.pdf')
             
-            # Copy the template to the output PDF path
-            with open(pdf_path, 'wb') as f:
-                f.write(template.file_binary)
-            
-            # Store the source PDF path for reference
-            contract.original_file_path = pdf_template_path
+            # Store the source PDF path for reference (one shared copy)
+            record.original_file_path = store_artifact(template.file_binary, '.pdf')
                 
         else:
-            logging.error(f"Unsupported template type: {template.file_type}")
-            return None
+            raise ValueError(f'未対応のテンプレート形式です: {template.file_type}')
             
         # If we got this far, the PDF was generated
         logging.info(f"Successfully generated PDF for contract {contract_id} at {pdf_path}")
@@ -310,4 +908,6 @@ def generate_pdf(contract_id):
         logging.error(f"Error generating PDF: {str(e)}")
         import traceback
         logging.error(traceback.format_exc())
+        if raise_errors:
+            raise
         return None